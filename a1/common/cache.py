@@ -0,0 +1,116 @@
+import threading, time, sys, itertools
+from collections import OrderedDict
+
+# An in-memory cache of full (unsorted) query results, so that rerunning a query with a different sort or limit does not read the table again.
+
+def cache_key(predicates, to_display):
+    '''
+    Builds the key a query's results are cached under.
+    The order predicates were entered in does not matter, and neither does the order of the attributes displayed.
+    :param predicates list: The predicates of the query
+    :param to_display str: A comma-separated list of attributes read, or None for every attribute
+    :return: A hashable key
+    '''
+    filter_key = ' and '.join(sorted(str(predicate) for predicate in predicates))
+    projection_key = ','.join(sorted(set(to_display.split(',')))) if to_display else '*'
+    return filter_key, projection_key
+
+def estimate_size(movies):
+    '''
+    Approximates the memory held by a list of results, counting every attribute name and value
+    '''
+    if hasattr(movies, 'nbytes'):
+        #results stored column by column (see common/columns.py) measure themselves
+        return movies.nbytes()
+    size = sys.getsizeof(movies)
+    for movie in movies:
+        size += sys.getsizeof(movie)
+        for key, value in movie.items():
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+class ResultCache:
+    '''
+    A thread-safe LRU cache of query results. Entries expire after ttl seconds, and the least recently used entries are
+    evicted once there are more than max_entries, or they hold more than max_bytes between them.
+    '''
+    def __init__(self, max_entries=32, max_bytes=64 * 1024 * 1024, ttl=300):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''
+        :return: The cached results, or None if they are missing or have expired
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, movies):
+        '''
+        Caches a query's results, evicting the least recently used entries until the cache is within its bounds.
+        Results larger than the whole cache are not stored.
+        '''
+        size = estimate_size(movies)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.monotonic(), movies, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        #callers hold the lock
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def record(self, key, pages, combine=None):
+        '''
+        Yields pages as they are read, caching the results once the last page has been read.
+        Nothing is cached if reading stops early, and results stop being collected once they outgrow the cache.
+        :param pages iterable: The pages of results, each a list
+        :param combine function: Combines the pages into the results cached, by default they are joined into one list
+        '''
+        read = []
+        size = 0
+        for page in pages:
+            if read is not None:
+                read.append(page)
+                size += estimate_size(page)
+                if size > self.max_bytes:
+                    read = None
+            yield page
+        if read is not None:
+            self.put(key, combine(read) if combine else list(itertools.chain.from_iterable(read)))
+
+    def clear(self):
+        '''
+        Drops every entry, used whenever the table is written to
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def report(self):
+        '''
+        Prints the hit and miss counters alongside the cache's current size
+        '''
+        with self.lock:
+            print('Result cache: {} hit(s), {} miss(es), {} entries ({:.1f} KB)'.format(self.hits, self.misses, len(self.entries), self.bytes / 1024))
@@ -0,0 +1,105 @@
+import json, os, threading, time, itertools
+
+# Records how far a bulk load has got, so that an interrupted load can be resumed instead of starting over.
+# Progress is an offset into the source file: every item before it has been written.
+
+def source_signature(filename):
+    '''
+    Identifies the source file a checkpoint was recorded against
+    '''
+    return {'path': os.path.abspath(filename), 'size': os.path.getsize(filename)}
+
+def enumerate_from(items, offset=0):
+    '''
+    Pairs every item with its offset in the source, skipping the items before offset
+    :param items iterable: The items read from the source
+    :param offset int: The offset of the first item to yield
+    '''
+    return itertools.islice(enumerate(items), offset, None)
+
+class Checkpoint:
+    '''
+    Thread-safe progress of a bulk load, saved to a JSON file.
+    Batches complete in any order, so the saved offset only advances past items whose batches, and every batch before
+    them, have been written.
+    '''
+    def __init__(self, filename, source, version=None, interval=2.0):
+        '''
+        :param filename str: The file the checkpoint is saved to
+        :param source str: The file being loaded
+        :param version str: Identifies the table being loaded, so a checkpoint for a table that has since been recreated is ignored
+        :param interval float: The minimum number of seconds between saves
+        '''
+        self.lock = threading.Lock()
+        self.filename = filename
+        self.source = source_signature(source)
+        self.version = version
+        self.interval = interval
+        self.offset = 0
+        self.done = set()
+        self.last_save = 0.0
+
+    def read(self):
+        '''
+        :return: A dict holding the saved offset and whether the load completed, or None if there is no checkpoint for this source and table
+        '''
+        try:
+            with open(self.filename) as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return None
+        if state.get('source') != self.source or state.get('version') != self.version:
+            return None
+        return {'offset': state.get('offset', 0), 'complete': state.get('complete', False)}
+
+    def start(self, offset=0):
+        '''
+        Records that a load has started (or resumed) at offset
+        '''
+        with self.lock:
+            self.offset = offset
+            self.done = set()
+            self.save(False)
+
+    def complete(self, offsets):
+        '''
+        Records that the items at offsets have been written
+        :param offsets list: The offsets of the items in a batch that was fully written
+        '''
+        with self.lock:
+            self.done.update(offsets)
+            advanced = False
+            while self.offset in self.done:
+                self.done.remove(self.offset)
+                self.offset += 1
+                advanced = True
+            if advanced and time.monotonic() - self.last_save >= self.interval:
+                self.save(False)
+
+    def finish(self, complete=True):
+        '''
+        Saves the final state of a load
+        :param complete bool: False if some batches failed, so the load should be resumed from the saved offset
+        '''
+        with self.lock:
+            self.save(complete)
+
+    def save(self, complete):
+        #callers hold the lock; the file is replaced atomically so an interrupted save never leaves a corrupt checkpoint
+        state = {'source': self.source, 'version': self.version, 'offset': self.offset, 'complete': complete}
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temp, self.filename)
+        self.last_save = time.monotonic()
+
+def collect_keys(keys):
+    '''
+    Collects the distinct row keys of every partition, which are the items each partition should hold once loaded
+    :param keys iterable: (partition key, row key) pairs read from the source
+    :return: A dict mapping each partition key to its set of row keys
+    '''
+    partitions = {}
+    for partition, row in keys:
+        partitions.setdefault(partition, set()).add(row)
+    return partitions
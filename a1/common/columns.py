@@ -0,0 +1,371 @@
+import array, math, sys, decimal, operator
+
+# Holds query results column by column instead of as one dict (or Entity) per result.
+# Numbers are decoded once into typed arrays and repeated strings are interned, so large results take less memory and
+# sorting compares plain numbers instead of converting every value on every comparison.
+
+#NumPy is optional: when it is installed, filters and sorts are evaluated over whole columns at once
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#marks a missing value in an integer column, NaN marks one in a float column
+missing_int = -2 ** 63
+typecodes = {'int': 'q', 'float': 'd'}
+dtypes = {'q': 'int64', 'd': 'float64'}
+comparisons = {'eq': operator.eq, 'ne': operator.ne, 'gt': operator.gt, 'ge': operator.ge, 'lt': operator.lt, 'le': operator.le}
+
+def plain(value):
+    #Azure wraps typed properties in an EntityProperty holding the value
+    return getattr(value, 'value', value)
+
+def exact_number(value):
+    '''
+    Converts a filter value into a number that a whole column can be compared against.
+    Filter values are Decimals, which are compared against each result's value converted to a Decimal, so a fraction is
+    only used if it converts to a float and back without changing.
+    :return: An int or float, or None if the value cannot be compared this way
+    '''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, decimal.Decimal) and value.is_finite():
+        if value == value.to_integral_value():
+            return int(value)
+        number = float(value)
+        return number if decimal.Decimal(repr(number)) == value else None
+    return None
+
+class Row:
+    '''
+    A read-only view of a single result, so a filter can be evaluated without building a dict
+    '''
+    def __init__(self, results, index):
+        self.results = results
+        self.index = index
+
+    def __contains__(self, attribute):
+        return self.results.value(attribute, self.index) is not None
+
+    def __getitem__(self, attribute):
+        value = self.results.value(attribute, self.index)
+        if value is None:
+            raise KeyError(attribute)
+        return value
+
+class ResultColumns:
+    '''
+    A page (or the whole) of a query's results, stored as one column per attribute.
+    It can be used like a list of dicts: iterating, indexing, and len work as they do on a page of results.
+    '''
+    def __init__(self, types=None, rows=()):
+        '''
+        :param types dict: Maps attributes to 'int' or 'float' (stored in typed arrays), or 'category' (interned strings).
+                           Any other attribute is stored as it was read.
+        :param rows iterable: The results to decode, each a dict or Entity keyed by attribute
+        '''
+        self.types = types or {}
+        self.columns = {}
+        self.count = 0
+        #whether filters and sorts can be evaluated a column at a time, see match and lexsort
+        self.vectorized = numpy is not None
+        for row in rows:
+            self.append(row)
+
+    def new_column(self, attribute):
+        #the column is filled with missing values for the results already stored
+        typecode = typecodes.get(self.types.get(attribute))
+        self.columns[attribute] = array.array(typecode) if typecode else []
+        self.pad(attribute, self.count)
+
+    def pad(self, attribute, count):
+        column = self.columns[attribute]
+        if isinstance(column, list):
+            column.extend([None] * count)
+        else:
+            column.extend(array.array(column.typecode, [missing_int if column.typecode == 'q' else math.nan]) * count)
+
+    def store(self, attribute, value):
+        '''
+        Appends a value to an attribute's column, None being a missing value.
+        If a value cannot be stored in a typed array, the column is converted into a list of the values as they were read.
+        '''
+        column = self.columns[attribute]
+        value = plain(value)
+        if isinstance(column, list):
+            if self.types.get(attribute) == 'category' and type(value) is str:
+                value = sys.intern(value)
+            column.append(value)
+        elif value is None:
+            column.append(missing_int if column.typecode == 'q' else math.nan)
+        else:
+            try:
+                column.append(int(value) if column.typecode == 'q' else float(value))
+            except (TypeError, ValueError, OverflowError):
+                self.columns[attribute] = [self.value(attribute, i) for i in range(self.count)] + [value]
+
+    def append(self, row):
+        '''
+        Decodes a single result
+        :param row dict: The result, keyed by attribute
+        '''
+        for attribute in row.keys():
+            if attribute not in self.columns:
+                self.new_column(attribute)
+        for attribute in list(self.columns.keys()):
+            self.store(attribute, row.get(attribute))
+        self.count += 1
+
+    def merge(self, other):
+        '''
+        Appends every result of another ResultColumns, copying whole columns where their types match
+        '''
+        for attribute in other.columns.keys() - self.columns.keys():
+            self.new_column(attribute)
+        for attribute in list(self.columns.keys()):
+            column = self.columns[attribute]
+            theirs = other.columns.get(attribute)
+            if theirs is None:
+                self.pad(attribute, other.count)
+            elif type(column) is type(theirs) and getattr(column, 'typecode', None) == getattr(theirs, 'typecode', None):
+                column.extend(theirs)
+            else:
+                for i in range(other.count):
+                    self.store(attribute, other.value(attribute, i))
+        self.count += other.count
+
+    def value(self, attribute, index):
+        '''
+        :return: The value of an attribute for a single result, or None if the result does not have it
+        '''
+        column = self.columns.get(attribute)
+        if column is None:
+            return None
+        value = column[index]
+        if isinstance(column, list):
+            return value
+        if column.typecode == 'q':
+            return None if value == missing_int else value
+        return None if math.isnan(value) else value
+
+    def row(self, index):
+        '''
+        :return: A single result as a dict holding the attributes it has
+        '''
+        row = {}
+        for attribute in self.columns:
+            value = self.value(attribute, index)
+            if value is not None:
+                row[attribute] = value
+        return row
+
+    def take(self, indices):
+        '''
+        :param indices list: The positions of the results to keep, in the order they are kept (a list or NumPy array)
+        :return: A new ResultColumns holding only those results
+        '''
+        taken = ResultColumns(self.types)
+        if numpy is not None:
+            indices = numpy.asarray(indices, dtype=numpy.intp)
+            positions = indices.tolist()
+        else:
+            positions = indices
+        for attribute, column in self.columns.items():
+            if isinstance(column, list):
+                taken.columns[attribute] = [column[i] for i in positions]
+            elif numpy is not None:
+                taken.columns[attribute] = array.array(column.typecode, self.vector(attribute)[indices].tobytes())
+            else:
+                taken.columns[attribute] = array.array(column.typecode, (column[i] for i in positions))
+        taken.count = len(positions)
+        return taken
+
+    def where(self, predicate):
+        '''
+        :param predicate function: Called with a Row for every result
+        :return: The results the predicate is true for
+        '''
+        return self.take([i for i in range(self.count) if predicate(Row(self, i))])
+
+    def compress(self, mask):
+        '''
+        :param mask numpy.ndarray: One boolean per result, see match
+        :return: The results the mask is true for
+        '''
+        return self.take(numpy.flatnonzero(mask))
+
+    def values(self, attribute):
+        '''
+        Iterates over an attribute's values, None being a missing value
+        '''
+        column = self.columns.get(attribute)
+        if column is None:
+            return iter([None] * self.count)
+        if isinstance(column, list):
+            return iter(column)
+        if column.typecode == 'q':
+            return (None if value == missing_int else value for value in column)
+        return (None if math.isnan(value) else value for value in column)
+
+    def vector(self, attribute):
+        '''
+        A NumPy view of an int or float column, holding missing_int or NaN for missing values.
+        The view shares the column's memory, so it must not be kept once more results are appended.
+        '''
+        column = self.columns[attribute]
+        return numpy.frombuffer(column, dtype=dtypes[column.typecode])
+
+    def present(self, attribute):
+        '''
+        :return: A NumPy array of booleans, true for the results that have the attribute
+        '''
+        column = self.columns.get(attribute)
+        if column is None:
+            return numpy.zeros(self.count, dtype=bool)
+        if isinstance(column, list):
+            return numpy.fromiter((value is not None for value in column), dtype=bool, count=self.count)
+        if column.typecode == 'q':
+            return self.vector(attribute) != missing_int
+        return ~numpy.isnan(self.vector(attribute))
+
+    def match(self, attribute, test, operator=None, operand=None):
+        '''
+        Tests an attribute of every result at once, results missing the attribute never matching.
+        Comparisons of int and float columns against numbers are evaluated on the whole column by NumPy, and anything else
+        is tested once per distinct value.
+        :param test function: Called with a value (never None), returning True if it matches
+        :param operator str: If the test is a comparison, one of eq, ne, gt, ge, lt, le, between, or in
+        :param operand: The value compared against, a (low, high) pair for between, or a list of values for in
+        :return: A NumPy array of booleans, one per result
+        '''
+        column = self.columns.get(attribute)
+        if column is None:
+            return numpy.zeros(self.count, dtype=bool)
+        if not isinstance(column, list) and operator is not None:
+            operands = list(operand) if operator in ['between', 'in'] else [operand]
+            numbers = [exact_number(value) for value in operands]
+            if None not in numbers:
+                vector = self.vector(attribute)
+                try:
+                    if operator == 'between':
+                        matched = (vector >= numbers[0]) & (vector <= numbers[1])
+                    elif operator == 'in':
+                        matched = numpy.isin(vector, numbers)
+                    else:
+                        matched = comparisons[operator](vector, numbers[0])
+                    return self.present(attribute) & matched
+                except (OverflowError, TypeError):
+                    #the numbers do not fit the column's type, so each value is tested instead
+                    pass
+        outcomes = {}
+
+        def matches(value):
+            if value is None:
+                return False
+            try:
+                outcome = outcomes.get(value)
+            except TypeError:
+                return bool(test(value))
+            if outcome is None:
+                outcome = outcomes[value] = bool(test(value))
+            return outcome
+
+        return numpy.fromiter((matches(value) for value in self.values(attribute)), dtype=bool, count=self.count)
+
+    def order(self, attribute, descending=False):
+        '''
+        Sorts the positions of the results by an attribute, leaving the results themselves where they are.
+        Results missing the attribute come first in ascending order and last in descending order, and results with equal
+        values keep the order they were read in.
+        :return: A list of positions, or a NumPy array of them when NumPy is installed
+        '''
+        column = self.columns.get(attribute)
+        if column is None:
+            return list(range(self.count))
+        if numpy is not None:
+            return self.lexsort(attribute, descending)
+        if isinstance(column, list):
+            is_present = [value is not None for value in column]
+        elif column.typecode == 'q':
+            is_present = [value != missing_int for value in column]
+        else:
+            is_present = [not math.isnan(value) for value in column]
+        present = [i for i in range(self.count) if is_present[i]]
+        absent = [i for i in range(self.count) if not is_present[i]]
+        present.sort(key=column.__getitem__, reverse=descending)
+        return present + absent if descending else absent + present
+
+    def lexsort(self, attribute, descending=False):
+        '''
+        Orders the results with numpy.lexsort, keyed first on whether the attribute is present and then on its value.
+        Values that are not numbers are replaced by their rank among the column's distinct values, so only the distinct
+        values are compared in Python.
+        '''
+        column = self.columns[attribute]
+        present = self.present(attribute)
+        if isinstance(column, list):
+            ranks = {value: rank for rank, value in enumerate(sorted({value for value in column if value is not None}))}
+            codes = numpy.fromiter((ranks.get(value, 0) if value is not None else 0 for value in column), dtype=numpy.int64, count=self.count)
+        else:
+            #missing values are given the same code, so they keep the order they were read in
+            codes = numpy.where(present, self.vector(attribute), 0)
+        #lexsort is stable and sorts by its last key first
+        if descending:
+            return numpy.lexsort((-codes, ~present))
+        return numpy.lexsort((codes, present))
+
+    def sorted(self, attribute, descending=False):
+        return self.take(self.order(attribute, descending))
+
+    def top(self, attribute, k, descending=False):
+        '''
+        :return: The first k results in sort order
+        '''
+        return self.take(self.order(attribute, descending)[:k])
+
+    def nbytes(self):
+        '''
+        Approximates the memory held, counting each interned string once
+        '''
+        size = sys.getsizeof(self.columns)
+        for attribute, column in self.columns.items():
+            size += sys.getsizeof(attribute) + sys.getsizeof(column)
+            if isinstance(column, list):
+                size += sum(sys.getsizeof(value) for value in {id(value): value for value in column}.values())
+        return size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.row(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(range(self.count)[index])
+        return self.row(range(self.count)[index])
+
+def concat(pages, types=None):
+    '''
+    Combines pages of results into a single ResultColumns
+    :param pages iterable: The pages, each a ResultColumns or a list of results
+    '''
+    results = ResultColumns(types)
+    for page in pages:
+        results.merge(page if isinstance(page, ResultColumns) else ResultColumns(types, page))
+    return results
+
+def top_k(pages, k, attribute, descending=False, types=None):
+    '''
+    Selects the first k results in sort order, holding no more than k results plus the page being read
+    :param pages iterable: The pages, each a ResultColumns or a list of results
+    :return: A ResultColumns holding the k results in sort order
+    '''
+    kept = ResultColumns(types)
+    for page in pages:
+        kept.merge(page if isinstance(page, ResultColumns) else ResultColumns(types, page))
+        kept = kept.top(attribute, k, descending)
+    return kept
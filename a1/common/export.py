@@ -0,0 +1,200 @@
+import csv, json, decimal, os
+
+#pyarrow is only needed to export Parquet or Arrow files
+try:
+    import pyarrow, pyarrow.parquet, pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+#results are written through a 1MB buffer rather than a cell at a time
+buffer_size = 1024 * 1024
+#the number of results in each row group of a Parquet file (or record batch of an Arrow file), held until the group is written
+default_row_group_size = 10000
+#the format is picked from the extension of the file written, anything else is written as a CSV
+formats = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+class ExportError(ValueError):
+    pass
+
+def unescape_title(title):
+    '''
+    Restores the characters that had to be replaced in titles to be used as Azure RowKeys
+    '''
+    return title.replace('!f', '/').replace('!q', '?')
+
+def export_format(filename):
+    '''
+    :return: The format a file is written in, one of csv, jsonl, parquet, or arrow
+    :raises ExportError: If the format needs pyarrow and it is not installed
+    '''
+    file_format = formats.get(os.path.splitext(filename)[1].lower(), 'csv')
+    if file_format in ['parquet', 'arrow'] and pyarrow is None:
+        raise ExportError('pyarrow must be installed (pip install pyarrow) to export {} files'.format(file_format.capitalize()))
+    return file_format
+
+def open_exporter(filename, keys, headers=None, transforms={}, types={}, row_group_size=default_row_group_size):
+    '''
+    Opens the exporter for a file's format, see export_format
+    :param types dict: Maps attributes to 'int' or 'float', used by the formats that keep types
+    :param row_group_size int: The number of results in each row group of a Parquet or Arrow file
+    '''
+    file_format = export_format(filename)
+    if file_format == 'jsonl':
+        return JsonLinesExporter(filename, keys, headers, transforms, types)
+    if file_format in ['parquet', 'arrow']:
+        return ArrowExporter(filename, keys, headers, transforms, types, row_group_size, file_format)
+    return CsvExporter(filename, keys, headers, transforms)
+
+def typed_value(value, value_type=None):
+    '''
+    Converts a value read from a table into the type it is exported as
+    :param value_type str: 'int' or 'float', or None to convert Decimals to whichever of the two holds them
+    '''
+    #Azure wraps typed properties in an EntityProperty holding the value
+    value = getattr(value, 'value', value)
+    if value is None:
+        return None
+    if value_type == 'int':
+        return int(value)
+    if value_type == 'float':
+        return float(value)
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+class CsvExporter:
+    '''
+    Writes query results to a CSV file page by page as they arrive, so the full result set never has to be held for the download
+    '''
+    def __init__(self, filename, keys, headers=None, transforms={}):
+        '''
+        :param filename str: The path of the CSV file to write
+        :param keys list: The attributes written for every result, in column order
+        :param headers list: The column names written on the first line, keys by default
+        :param transforms dict: Maps an attribute to a function applied to its value before it is written
+        '''
+        self.filename = filename
+        self.keys = keys
+        self.transforms = transforms
+        self.rows = 0
+        self.file = open(filename, 'w', newline='', buffering=buffer_size)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(headers or keys)
+
+    def to_row(self, movie):
+        row = []
+        for key in self.keys:
+            if key in movie:
+                value = movie[key]
+                row.append(self.transforms[key](value) if key in self.transforms else value)
+            else:
+                row.append('')
+        return row
+
+    def write_rows(self, movies):
+        '''
+        Writes a page of results
+        :param movies iterable: The results, each a dict or Entity keyed by attribute
+        '''
+        rows = [self.to_row(movie) for movie in movies]
+        self.writer.writerows(rows)
+        self.rows += len(rows)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class JsonLinesExporter(CsvExporter):
+    '''
+    Writes query results to a JSON Lines file page by page, one object per result holding the attributes it has.
+    Numbers are written as numbers rather than strings.
+    '''
+    def __init__(self, filename, keys, headers=None, transforms={}, types={}):
+        '''
+        :param types dict: Maps attributes to 'int' or 'float', other numbers are written as whichever of the two holds them
+        '''
+        self.filename = filename
+        self.keys = keys
+        self.headers = headers or keys
+        self.transforms = transforms
+        self.types = types
+        self.rows = 0
+        self.file = open(filename, 'w', buffering=buffer_size)
+
+    def to_object(self, movie):
+        result = {}
+        for key, header in zip(self.keys, self.headers):
+            if key in movie:
+                value = movie[key]
+                result[header] = typed_value(self.transforms[key](value) if key in self.transforms else value, self.types.get(key))
+        return result
+
+    def write_rows(self, movies):
+        '''
+        Writes a page of results
+        :param movies iterable: The results, each a dict or Entity keyed by attribute
+        '''
+        lines = [json.dumps(self.to_object(movie), ensure_ascii=False) + '\n' for movie in movies]
+        self.file.writelines(lines)
+        self.rows += len(lines)
+
+class ArrowExporter(CsvExporter):
+    '''
+    Writes query results to a Parquet or Arrow IPC file with a typed column per attribute.
+    Results are held until row_group_size have arrived, then written as one row group (or record batch).
+    '''
+    def __init__(self, filename, keys, headers=None, transforms={}, types={}, row_group_size=default_row_group_size, file_format='parquet'):
+        '''
+        :param types dict: Maps attributes to 'int' or 'float', every other attribute is written as a string
+        :param file_format str: parquet, or arrow for an Arrow IPC file
+        '''
+        self.filename = filename
+        self.keys = keys
+        self.headers = headers or keys
+        self.transforms = transforms
+        self.types = types
+        self.row_group_size = max(1, row_group_size)
+        self.rows = 0
+        arrow_types = {'int': pyarrow.int64(), 'float': pyarrow.float64()}
+        self.schema = pyarrow.schema([(header, arrow_types.get(types.get(key), pyarrow.string())) for key, header in zip(keys, self.headers)])
+        self.pending = [[] for _ in keys]
+        if file_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(filename, self.schema)
+
+    def write_rows(self, movies):
+        '''
+        Adds a page of results, writing a row group whenever row_group_size results are held
+        :param movies iterable: The results, each a dict or Entity keyed by attribute
+        '''
+        for movie in movies:
+            for key, values in zip(self.keys, self.pending):
+                value = movie[key] if key in movie else None
+                if value is not None and key in self.transforms:
+                    value = self.transforms[key](value)
+                value = typed_value(value, self.types.get(key))
+                values.append(value if value is None or key in self.types else str(value))
+            if len(self.pending[0]) == self.row_group_size:
+                self.write_group()
+
+    def write_group(self):
+        count = len(self.pending[0])
+        if count == 0:
+            return
+        batch = pyarrow.RecordBatch.from_arrays([pyarrow.array(values, type=field.type) for values, field in zip(self.pending, self.schema)], schema=self.schema)
+        if isinstance(self.writer, pyarrow.parquet.ParquetWriter):
+            self.writer.write_batch(batch, row_group_size=self.row_group_size)
+        else:
+            self.writer.write_batch(batch)
+        self.rows += count
+        self.pending = [[] for _ in self.keys]
+
+    def close(self):
+        self.write_group()
+        self.writer.close()
@@ -0,0 +1,495 @@
+import re, decimal
+
+# Tokenizer, parser and compilers for the filter language shared by task2_aws and task2_azure.
+# Filters compile to boto3 conditions, OData filter strings and SQL, and can be evaluated client-side.
+#
+#   filter     := or_expr
+#   or_expr    := and_expr ('or' and_expr)*
+#   and_expr   := not_expr ('and' not_expr)*
+#   not_expr   := 'not' not_expr | '(' filter ')' | predicate
+#   predicate  := attribute op value | attribute 'between' value 'and' value
+#               | attribute 'in' '(' value (',' value)* ')' | attribute 'contains' value
+#               | 'contains' '(' attribute ',' value ')'
+#   op         := eq | ne | gt | ge | gte | lt | le | lte | = | != | <> | < | <= | > | >=
+
+attributes = ['year', 'title', 'directors', 'actors', 'release_date', 'genres', 'image_url', 'running_time_secs', 'plot', 'rank', 'rating']
+numeric_attributes = ['year', 'running_time_secs', 'rank', 'rating']
+attribute_aliases = {'PartitionKey': 'year', 'RowKey': 'title'}
+operator_aliases = {
+    'eq': 'eq', '=': 'eq', '==': 'eq',
+    'ne': 'ne', '!=': 'ne', '<>': 'ne',
+    'gt': 'gt', '>': 'gt',
+    'ge': 'ge', 'gte': 'ge', '>=': 'ge',
+    'lt': 'lt', '<': 'lt',
+    'le': 'le', 'lte': 'le', '<=': 'le'
+}
+keywords = ['and', 'or', 'not', 'between', 'in', 'contains']
+sql_operators = {'eq': '=', 'ne': '<>', 'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<='}
+lower_bounds = ['gt', 'ge']
+upper_bounds = ['lt', 'le']
+
+token_pattern = re.compile(r'''\s*(?:
+    (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")|
+    (?P<number>-?\d+(?:\.\d+)?(?![\w.]))|
+    (?P<symbol><=|>=|<>|!=|==|[=<>(),])|
+    (?P<word>[^\s'"(),=<>!]+)
+)''', re.VERBOSE)
+
+class FilterError(ValueError):
+    pass
+
+class Comparison:
+    def __init__(self, attribute, operator, value):
+        self.attribute = attribute
+        self.operator = operator
+        self.value = value
+
+    def __str__(self):
+        return '{} {} {}'.format(self.attribute, self.operator, render(self.value))
+
+class Between:
+    def __init__(self, attribute, low, high):
+        self.attribute = attribute
+        self.low = low
+        self.high = high
+
+    def __str__(self):
+        return '{} between {} and {}'.format(self.attribute, render(self.low), render(self.high))
+
+class In:
+    def __init__(self, attribute, values):
+        self.attribute = attribute
+        self.values = values
+
+    def __str__(self):
+        return '{} in ({})'.format(self.attribute, ', '.join(render(value) for value in self.values))
+
+class Contains:
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = value
+
+    def __str__(self):
+        return '{} contains {}'.format(self.attribute, render(self.value))
+
+class And:
+    def __init__(self, operands):
+        self.operands = operands
+
+    def __str__(self):
+        return '(' + ' and '.join(str(operand) for operand in self.operands) + ')'
+
+class Or:
+    def __init__(self, operands):
+        self.operands = operands
+
+    def __str__(self):
+        return '(' + ' or '.join(str(operand) for operand in self.operands) + ')'
+
+class Not:
+    def __init__(self, operand):
+        self.operand = operand
+
+    def __str__(self):
+        return 'not ' + str(self.operand)
+
+def render(value):
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return str(value)
+
+def tokenize(text, spans=None):
+    '''
+    Splits a filter into (kind, text) tokens
+    :param spans list: If given, the (start, end) offsets of each token in text are appended to it
+    '''
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = token_pattern.match(text, pos)
+        if not match:
+            raise FilterError('Could not read the filter at \'{}\''.format(text[pos:]))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            quote = value[0]
+            value = value[1:-1].replace(quote * 2, quote)
+        elif kind == 'word' and value.lower() in keywords + list(operator_aliases.keys()):
+            value = value.lower()
+        tokens.append((kind, value))
+        if spans is not None:
+            spans.append(match.span(kind))
+    return tokens
+
+class Parser:
+    def __init__(self, text):
+        self.text = text
+        self.spans = []
+        self.tokens = tokenize(text, self.spans)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise FilterError('The filter ended unexpectedly')
+        self.pos += 1
+        return token
+
+    def expect(self, text):
+        kind, value = self.next()
+        if value != text or kind == 'string':
+            raise FilterError('Expected \'{}\' but found \'{}\''.format(text, value))
+
+    def at(self, *texts):
+        kind, value = self.peek()
+        return kind in ['word', 'symbol'] and value in texts
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek()[0] is not None:
+            raise FilterError('Unexpected \'{}\' in the filter'.format(self.peek()[1]))
+        return node
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.at('or'):
+            self.next()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.at('and'):
+            self.next()
+            operands.append(self.parse_not())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def parse_not(self):
+        if self.at('not'):
+            self.next()
+            return Not(self.parse_not())
+        if self.at('('):
+            self.next()
+            node = self.parse_or()
+            self.expect(')')
+            return node
+        if self.at('contains'):
+            self.next()
+            self.expect('(')
+            attribute = self.parse_attribute()
+            self.expect(',')
+            value = self.parse_value(attribute)
+            self.expect(')')
+            return Contains(attribute, value)
+        return self.parse_predicate()
+
+    def parse_attribute(self):
+        kind, value = self.next()
+        if kind != 'word':
+            raise FilterError('Expected an attribute but found \'{}\''.format(value))
+        value = attribute_aliases.get(value, value)
+        if value not in attributes:
+            raise FilterError('{} is not a valid attribute'.format(value))
+        return value
+
+    def parse_predicate(self):
+        attribute = self.parse_attribute()
+        kind, value = self.next()
+        if value in operator_aliases and kind != 'string':
+            return Comparison(attribute, operator_aliases[value], self.parse_value(attribute))
+        if value == 'between':
+            low = self.parse_value(attribute)
+            self.expect('and')
+            return Between(attribute, low, self.parse_value(attribute))
+        if value == 'in':
+            self.expect('(')
+            values = [self.parse_value(attribute)]
+            while self.at(','):
+                self.next()
+                values.append(self.parse_value(attribute))
+            self.expect(')')
+            return In(attribute, values)
+        if value == 'contains':
+            return Contains(attribute, self.parse_value(attribute))
+        raise FilterError('Expected an operator after {} but found \'{}\''.format(attribute, value))
+
+    def parse_value(self, attribute):
+        kind, value = self.next()
+        if kind == 'symbol':
+            raise FilterError('Expected a value but found \'{}\''.format(value))
+        if kind == 'word' and value in keywords:
+            raise FilterError('Expected a value but found \'{}\''.format(value))
+        if kind == 'word' or (kind == 'number' and attribute not in numeric_attributes):
+            #unquoted values run until the next keyword or symbol, so titles (even ones starting with a number, such as
+            #12 Angry Men) do not need to be quoted. The value is taken from the filter as written, keeping its punctuation.
+            start = self.spans[self.pos - 1][0]
+            while self.peek()[0] in ['word', 'number'] and self.peek()[1] not in keywords:
+                self.next()
+            value = self.text[start:self.spans[self.pos - 1][1]]
+        return coerce_value(attribute, value)
+
+def coerce_value(attribute, value):
+    '''
+    Converts a value entered by the user to the type of the attribute it is compared against
+    :raises FilterError: If a numeric attribute is compared to something that is not a number
+    '''
+    if attribute in numeric_attributes:
+        try:
+            return decimal.Decimal(value)
+        except decimal.InvalidOperation:
+            raise FilterError('{} must be compared to a number, not \'{}\''.format(attribute, value))
+    return str(value)
+
+def parse(text):
+    '''
+    Parses a filter into a tree of predicates
+    :param text str: The filter entered by the user
+    :return: The root of the tree, or None if the filter is blank
+    '''
+    if text is None or text.strip() == '':
+        return None
+    return Parser(text).parse()
+
+def combine(predicates):
+    '''
+    Joins a list of predicates with 'and'
+    :return: A single predicate, or None if the list is empty
+    '''
+    predicates = [predicate for predicate in predicates if predicate is not None]
+    if not predicates:
+        return None
+    return predicates[0] if len(predicates) == 1 else And(predicates)
+
+def conjuncts(node):
+    '''
+    Flattens the top-level 'and's of a filter, each of which can be planned separately
+    '''
+    if node is None:
+        return []
+    if isinstance(node, And):
+        return [predicate for operand in node.operands for predicate in conjuncts(operand)]
+    return [node]
+
+def referenced_attributes(node):
+    '''
+    :return: The set of attributes referenced by a filter
+    '''
+    if node is None:
+        return set()
+    if isinstance(node, (And, Or)):
+        return set().union(*[referenced_attributes(operand) for operand in node.operands])
+    if isinstance(node, Not):
+        return referenced_attributes(node.operand)
+    return {node.attribute}
+
+def map_values(node, transforms):
+    '''
+    Applies a function to every value compared against an attribute, such as cleaning titles into Azure RowKeys
+    :param transforms dict: Maps an attribute to the function applied to its values
+    :return: A new filter
+    '''
+    if isinstance(node, (And, Or)):
+        return type(node)([map_values(operand, transforms) for operand in node.operands])
+    if isinstance(node, Not):
+        return Not(map_values(node.operand, transforms))
+    if node is None or node.attribute not in transforms:
+        return node
+    transform = transforms[node.attribute]
+    if isinstance(node, Between):
+        return Between(node.attribute, transform(node.low), transform(node.high))
+    if isinstance(node, In):
+        return In(node.attribute, [transform(value) for value in node.values])
+    return type(node)(node.attribute, *([node.operator] if isinstance(node, Comparison) else []), transform(node.value))
+
+def to_condition(node, condition_class):
+    '''
+    Compiles a filter into a boto3 condition
+    :param condition_class class: Attr for a FilterExpression, or Key for a KeyConditionExpression
+    '''
+    if isinstance(node, (And, Or)):
+        conditions = [to_condition(operand, condition_class) for operand in node.operands]
+        condition = conditions[0]
+        for other in conditions[1:]:
+            condition = condition & other if isinstance(node, And) else condition | other
+        return condition
+    if isinstance(node, Not):
+        return ~to_condition(node.operand, condition_class)
+    attribute = condition_class(node.attribute)
+    if isinstance(node, Comparison):
+        method = {'eq': 'eq', 'ne': 'ne', 'gt': 'gt', 'ge': 'gte', 'lt': 'lt', 'le': 'lte'}[node.operator]
+        return getattr(attribute, method)(node.value)
+    if isinstance(node, Between):
+        return attribute.between(node.low, node.high)
+    if isinstance(node, In):
+        return attribute.is_in(node.values)
+    return attribute.contains(node.value)
+
+def is_odata_expressible(node):
+    '''
+    Azure Tables only support comparisons joined by and/or/not, so 'contains' has to be evaluated client-side
+    '''
+    if isinstance(node, (And, Or)):
+        return all(is_odata_expressible(operand) for operand in node.operands)
+    if isinstance(node, Not):
+        return is_odata_expressible(node.operand)
+    return not isinstance(node, Contains)
+
+def to_odata(node, names={}, string_attributes=()):
+    '''
+    Compiles a filter into an OData filter string. 'between' and 'in' are expanded into comparisons.
+    :param names dict: Maps attributes to the property names used in the table, such as year to PartitionKey
+    :param string_attributes list: Attributes stored as strings even though they are numeric, such as year in the PartitionKey
+    '''
+    if isinstance(node, (And, Or)):
+        joiner = ' and ' if isinstance(node, And) else ' or '
+        return '(' + joiner.join(to_odata(operand, names, string_attributes) for operand in node.operands) + ')'
+    if isinstance(node, Not):
+        return 'not ' + to_odata(node.operand, names, string_attributes)
+    name = names.get(node.attribute, node.attribute)
+
+    def literal(value):
+        if node.attribute in string_attributes or isinstance(value, str):
+            return render(str(value))
+        #numeric properties are stored as doubles
+        text = str(value)
+        return text if '.' in text else text + '.0'
+
+    if isinstance(node, Comparison):
+        return '{} {} {}'.format(name, node.operator, literal(node.value))
+    if isinstance(node, Between):
+        return '({0} ge {1} and {0} le {2})'.format(name, literal(node.low), literal(node.high))
+    if isinstance(node, In):
+        return '(' + ' or '.join('{} eq {}'.format(name, literal(value)) for value in node.values) + ')'
+    raise FilterError('\'{}\' cannot be evaluated by Azure Tables'.format(node))
+
+def split_odata(predicates, names={}, string_attributes=()):
+    '''
+    Splits a list of predicates into an OData filter for the server and a filter that must be evaluated client-side
+    :return: The OData filter string (empty if there is none), and the client-side filter (None if there is none)
+    '''
+    server = [predicate for predicate in predicates if is_odata_expressible(predicate)]
+    client = [predicate for predicate in predicates if not is_odata_expressible(predicate)]
+    odata = ' and '.join(to_odata(predicate, names, string_attributes) for predicate in server)
+    return odata, combine(client)
+
+def to_sql(node):
+    '''
+    Compiles a filter into a SQL condition over columns named after the attributes
+    :return: The condition (empty if there is none) and the values bound to it
+    '''
+    params = []
+    if node is None:
+        return '', params
+    return sql_condition(node, params), params
+
+def sql_condition(node, params):
+    if isinstance(node, (And, Or)):
+        joiner = ' AND ' if isinstance(node, And) else ' OR '
+        return '(' + joiner.join(sql_condition(operand, params) for operand in node.operands) + ')'
+    if isinstance(node, Not):
+        return '(NOT {})'.format(sql_condition(node.operand, params))
+    if isinstance(node, Comparison):
+        params.append(node.value)
+        return '{} {} ?'.format(node.attribute, sql_operators[node.operator])
+    if isinstance(node, Between):
+        params.extend([node.low, node.high])
+        return '{} BETWEEN ? AND ?'.format(node.attribute)
+    if isinstance(node, In):
+        params.extend(node.values)
+        return '{} IN ({})'.format(node.attribute, ', '.join('?' * len(node.values)))
+    params.append(node.value)
+    return 'instr({}, ?) > 0'.format(node.attribute)
+
+def coerce(item_value, value):
+    '''
+    Converts an item's value so that it can be compared against a filter value.
+    Azure returns years as strings and DynamoDB returns numbers as Decimals.
+    '''
+    if isinstance(value, decimal.Decimal) and not isinstance(item_value, decimal.Decimal):
+        try:
+            return decimal.Decimal(str(item_value))
+        except decimal.InvalidOperation:
+            return None
+    if isinstance(value, str) and not isinstance(item_value, str):
+        return str(item_value)
+    return item_value
+
+def evaluate(node, item, names={}):
+    '''
+    Evaluates a filter against a single result
+    :param item dict: The result, keyed by attribute
+    :param names dict: Maps attributes to the keys used in the result, such as year to PartitionKey
+    :return: True if the result matches the filter
+    '''
+    if node is None:
+        return True
+    if isinstance(node, And):
+        return all(evaluate(operand, item, names) for operand in node.operands)
+    if isinstance(node, Or):
+        return any(evaluate(operand, item, names) for operand in node.operands)
+    if isinstance(node, Not):
+        return not evaluate(node.operand, item, names)
+    key = names.get(node.attribute, node.attribute)
+    if key not in item:
+        return False
+    if isinstance(node, Contains):
+        return str(node.value) in str(item[key])
+    if isinstance(node, In):
+        return any(coerce(item[key], value) == value for value in node.values)
+    if isinstance(node, Between):
+        actual = coerce(item[key], node.low)
+        return actual is not None and node.low <= actual <= node.high
+    actual = coerce(item[key], node.value)
+    if actual is None:
+        return node.operator == 'ne'
+    return {
+        'eq': actual == node.value,
+        'ne': actual != node.value,
+        'gt': actual > node.value,
+        'ge': actual >= node.value,
+        'lt': actual < node.value,
+        'le': actual <= node.value
+    }[node.operator]
+
+def mask(node, results, names={}):
+    '''
+    Evaluates a filter against every result of a ResultColumns at once (see common/columns.py), which requires NumPy.
+    Each comparison is evaluated on a whole column, and the masks are combined with 'and', 'or', and 'not'.
+    :param results ResultColumns: The results
+    :param names dict: Maps attributes to the keys used in the results, such as year to PartitionKey
+    :return: A NumPy array of booleans, true for the results that match the filter, as evaluate would return
+    '''
+    if isinstance(node, (And, Or)):
+        masks = [mask(operand, results, names) for operand in node.operands]
+        combined = masks[0]
+        for operand_mask in masks[1:]:
+            combined = combined & operand_mask if isinstance(node, And) else combined | operand_mask
+        return combined
+    if isinstance(node, Not):
+        return ~mask(node.operand, results, names)
+    key = names.get(node.attribute, node.attribute)
+    #every value is tested as evaluate would test it, unless the comparison can be made on the whole column
+    test = lambda value: evaluate(node, {node.attribute: value})
+    if isinstance(node, Contains):
+        return results.match(key, test)
+    if isinstance(node, In):
+        return results.match(key, test, 'in', node.values)
+    if isinstance(node, Between):
+        return results.match(key, test, 'between', (node.low, node.high))
+    return results.match(key, test, node.operator, node.value)
+
+def select(node, results, names={}):
+    '''
+    Keeps the results of a ResultColumns that match a filter, evaluating the whole page at once when NumPy is installed
+    :return: A ResultColumns holding the results that match
+    '''
+    if node is None:
+        return results
+    if results.vectorized:
+        return results.compress(mask(node, results, names))
+    return results.where(lambda row: evaluate(node, row, names))
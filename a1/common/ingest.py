@@ -0,0 +1,117 @@
+import threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class IngestStats:
+    '''
+    Thread-safe counters shared by every writer worker during a bulk load
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.end = None
+        self.items = 0
+        self.batches = 0
+        self.retries = 0
+        self.capacity = 0.0
+        self.failed = []
+        self.partitions = {}
+
+    def record_batch(self, items, retries=0, capacity=0.0):
+        with self.lock:
+            self.items += items
+            self.batches += 1
+            self.retries += retries
+            self.capacity += float(capacity)
+
+    def record_partition(self, partition, items, seconds):
+        '''
+        Accumulates the number of items and time spent committing batches for a single partition
+        '''
+        with self.lock:
+            totals = self.partitions.setdefault(partition, [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += items
+            totals[2] += seconds
+
+    def record_failure(self, description, error):
+        with self.lock:
+            self.failed.append((description, str(error)))
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def report(self, capacity_label=None):
+        '''
+        Prints the end-of-run throughput report
+        :param capacity_label str: The label used for the capacity total (WCUs, RUs, etc), omitted when None
+        '''
+        elapsed = (self.end or time.perf_counter()) - self.start
+        rate = self.items / elapsed if elapsed > 0 else 0
+        print('\nIngest summary:')
+        print('\tItems written: {}'.format(self.items))
+        print('\tBatches committed: {}'.format(self.batches))
+        print('\tThroughput: {:.1f} items/s over {:.2f}s'.format(rate, elapsed))
+        print('\tRetries: {}'.format(self.retries))
+        if capacity_label:
+            print('\t{}: {:.1f}'.format(capacity_label, self.capacity))
+        if self.partitions:
+            print('\tPer-partition timing (batches, items, seconds):')
+            for partition in sorted(self.partitions.keys()):
+                batches, items, seconds = self.partitions[partition]
+                print('\t\t{}: {} batches, {} items, {:.2f}s'.format(partition, batches, items, seconds))
+        if self.failed:
+            print('\tFailed batches: {}'.format(len(self.failed)))
+            for description, error in self.failed:
+                print('\t\t- {}: {}'.format(description, error))
+
+def chunk(iterable, size):
+    '''
+    Groups an iterable into lists of at most size elements without materialising the iterable
+    :param iterable iterable: The items to group
+    :param size int: The maximum size of each group
+    '''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def group_by_partition(iterable, size, partition_key):
+    '''
+    Groups an iterable into lists of at most size elements that all share the same partition key.
+    Only one partially-filled group per partition is held in memory at a time.
+    :param iterable iterable: The items to group
+    :param size int: The maximum size of each group
+    :param partition_key function: Returns the partition key of an item
+    '''
+    pending = {}
+    for item in iterable:
+        key = partition_key(item)
+        group = pending.setdefault(key, [])
+        group.append(item)
+        if len(group) == size:
+            yield pending.pop(key)
+    for group in pending.values():
+        yield group
+
+def run_batches(batches, writer, workers):
+    '''
+    Runs writer over every batch on a pool of worker threads.
+    At most 2 * workers batches are in flight at once so a lazy batch source is never read far ahead of the writers.
+    :param batches iterable: The batches to be written
+    :param writer function: Called with a single batch, runs on a worker thread
+    :param workers int: The number of writer threads
+    '''
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches:
+            if len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(executor.submit(writer, batch))
+        for future in in_flight:
+            future.result()
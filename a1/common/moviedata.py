@@ -0,0 +1,62 @@
+import json, decimal
+
+read_size = 64 * 1024
+
+def stream_movies(filename, parse_float=decimal.Decimal):
+    '''
+    Incrementally parses a file containing a JSON array, yielding one element at a time.
+    Only the element being decoded and one read buffer are held in memory, so memory use does not grow with the file.
+    :param filename str: The path to the JSON file
+    :param parse_float function: Used to decode floats, Decimal by default so that values can be written to DynamoDB
+    '''
+    decoder = json.JSONDecoder(parse_float=parse_float)
+    with open(filename) as json_file:
+        buffer = ''
+        pos = 0
+        eof = False
+        started = False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            data = json_file.read(read_size)
+            if not data:
+                eof = True
+            buffer = buffer[pos:] + data
+            pos = 0
+
+        while True:
+            #skip whitespace and the array delimiters between elements
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    break
+                fill()
+            if pos >= len(buffer):
+                if started:
+                    raise ValueError('Unexpected end of file in ' + filename)
+                return
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(filename + ' does not contain a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            if buffer[pos] == ',':
+                pos += 1
+                continue
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            #a scalar that ends the buffer may have been cut off, so read more before trusting it
+            if end == len(buffer) and not eof:
+                fill()
+                continue
+            pos = end
+            yield element
@@ -0,0 +1,183 @@
+import sqlite3, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# A local index of the name of every object in every bucket (or blob in every container), kept in an SQLite file so
+# that searching by name does not list the whole account. Names are split into overlapping three-character grams: a
+# search looks up the grams of the text searched for, and only checks the names holding all of them.
+
+gram_size = 3
+#the most grams of the text searched for that are looked up, checking the names that hold them finds the rest
+max_search_grams = 32
+#listings older than this many seconds are refreshed before a search
+default_ttl = 300
+#containers listed at the same time when refreshing, or asked at the same time whether they hold an object
+list_workers = 8
+#sorts after every other character, so a prefix range ends at prefix + max_char
+max_char = '\U0010ffff'
+
+def grams(text):
+    '''
+    :return: The set of distinct substrings of text that are gram_size characters long
+    '''
+    return {text[i:i + gram_size] for i in range(len(text) - gram_size + 1)}
+
+def probe(containers, exists, workers=list_workers):
+    '''
+    Asks every container at once whether it holds an object, and returns as soon as one does
+    :param containers list: The names of the containers to ask
+    :param exists function: Called with a container's name, returns the object's details (such as its size and etag) if it
+                            is in the container and None if not
+    :param workers int: The number of containers asked at the same time
+    :return: A (container, details) pair for the first container to answer that it holds the object, or None if none do.
+             If none do and some could not be asked, the first of their exceptions is raised instead.
+    '''
+    if not containers:
+        return None
+    errors = []
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(containers))))
+    try:
+        futures = {executor.submit(exists, container): container for container in containers}
+        for future in as_completed(futures):
+            try:
+                found = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if found is not None:
+                return futures[future], found
+    finally:
+        #the remaining answers are not needed, so any probes still queued are dropped rather than waited for
+        executor.shutdown(wait=False, cancel_futures=True)
+    if errors:
+        raise errors[0]
+    return None
+
+class NameIndex:
+    '''
+    The names of the objects in each container, and when each container (and the list of containers) was last listed.
+    A refresh only lists the containers whose listing has expired, and only touches the names that were added or removed.
+    '''
+    def __init__(self, filename, ttl=default_ttl):
+        '''
+        :param filename str: The SQLite file the index is kept in
+        :param ttl float: The number of seconds a listing is trusted for
+        '''
+        self.ttl = ttl
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS objects (id INTEGER PRIMARY KEY, container TEXT, name TEXT, folded TEXT, size INTEGER, etag TEXT, UNIQUE (container, name))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS objects_folded ON objects (folded)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS grams (gram TEXT, object INTEGER, PRIMARY KEY (gram, object)) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS containers (name TEXT PRIMARY KEY, listed REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)')
+        self.conn.commit()
+
+    def is_expired(self, listed):
+        return listed is None or time.time() - listed > self.ttl
+
+    def refresh(self, list_containers, list_objects, force=False):
+        '''
+        Lists the containers, and the objects in every container, whose listings have expired
+        :param list_containers function: Returns the name of every container
+        :param list_objects function: Called with a container's name, returns a (name, size, etag) tuple for every object in it.
+                                      Containers are listed on several threads at once.
+        :param force bool: Lists everything, even if it has not expired
+        :return: The number of containers listed
+        '''
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'containers_listed'").fetchone()
+        if force or self.is_expired(row[0] if row else None):
+            names = set(list_containers())
+            known = {name for (name,) in self.conn.execute('SELECT name FROM containers')}
+            for container in known - names:
+                self.remove_container(container)
+            self.conn.executemany('INSERT INTO containers (name, listed) VALUES (?, NULL)', [(name,) for name in names - known])
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('containers_listed', ?)", (time.time(),))
+        expired = [name for name, listed in self.conn.execute('SELECT name, listed FROM containers ORDER BY name') if force or self.is_expired(listed)]
+        with ThreadPoolExecutor(max_workers=list_workers) as executor:
+            for container, objects in zip(expired, executor.map(lambda container: list(list_objects(container)), expired)):
+                self.update_container(container, objects)
+        self.conn.commit()
+        return len(expired)
+
+    def update_container(self, container, objects):
+        '''
+        Replaces the names in a container with a fresh listing
+        :param objects list: A (name, size, etag) tuple for every object in the container
+        '''
+        current = {name: object_id for object_id, name in self.conn.execute('SELECT id, name FROM objects WHERE container = ?', (container,))}
+        listed = {name: (size, etag) for name, size, etag in objects}
+        removed = [current[name] for name in current.keys() - listed.keys()]
+        self.conn.executemany('DELETE FROM grams WHERE object = ?', [(object_id,) for object_id in removed])
+        self.conn.executemany('DELETE FROM objects WHERE id = ?', [(object_id,) for object_id in removed])
+        for name, (size, etag) in listed.items():
+            if name in current:
+                self.conn.execute('UPDATE objects SET size = ?, etag = ? WHERE id = ?', (size, etag, current[name]))
+            else:
+                self.add(container, name, size, etag)
+        self.conn.execute('INSERT OR REPLACE INTO containers (name, listed) VALUES (?, ?)', (container, time.time()))
+
+    def add(self, container, name, size=None, etag=None):
+        folded = name.lower()
+        object_id = self.conn.execute('INSERT INTO objects (container, name, folded, size, etag) VALUES (?, ?, ?, ?, ?)', (container, name, folded, size, etag)).lastrowid
+        self.conn.executemany('INSERT INTO grams (gram, object) VALUES (?, ?)', [(gram, object_id) for gram in grams(folded)])
+
+    def locate(self, name):
+        '''
+        :return: The containers the index has seen an object with exactly this name in, most recently listed first
+        '''
+        rows = self.conn.execute(
+            'SELECT objects.container FROM objects LEFT JOIN containers ON containers.name = objects.container '
+            'WHERE objects.folded = ? AND objects.name = ? ORDER BY containers.listed DESC', (name.lower(), name))
+        return [container for (container,) in rows]
+
+    def remember(self, container, name, size=None, etag=None):
+        '''
+        Records an object found outside of a listing, so it is located straight away next time
+        '''
+        row = self.conn.execute('SELECT id FROM objects WHERE container = ? AND name = ?', (container, name)).fetchone()
+        if row:
+            self.conn.execute('UPDATE objects SET size = ?, etag = ? WHERE id = ?', (size, etag, row[0]))
+        else:
+            self.add(container, name, size, etag)
+        self.conn.commit()
+
+    def forget(self, container, name):
+        '''
+        Removes an object that is no longer in a container
+        '''
+        self.conn.execute('DELETE FROM grams WHERE object IN (SELECT id FROM objects WHERE container = ? AND name = ?)', (container, name))
+        self.conn.execute('DELETE FROM objects WHERE container = ? AND name = ?', (container, name))
+        self.conn.commit()
+
+    def remove_container(self, container):
+        self.conn.execute('DELETE FROM grams WHERE object IN (SELECT id FROM objects WHERE container = ?)', (container,))
+        self.conn.execute('DELETE FROM objects WHERE container = ?', (container,))
+        self.conn.execute('DELETE FROM containers WHERE name = ?', (container,))
+
+    def expire(self, containers=()):
+        '''
+        Marks the list of containers, and the listing of each of the given containers, as expired so the next refresh lists them
+        '''
+        self.conn.execute("DELETE FROM meta WHERE key = 'containers_listed'")
+        self.conn.executemany('UPDATE containers SET listed = NULL WHERE name = ?', [(container,) for container in containers])
+        self.conn.commit()
+
+    def search(self, text, prefix=False):
+        '''
+        Finds the objects whose names contain text, ignoring case
+        :param prefix bool: Only find the names that start with text
+        :return: A list of (container, name) pairs, sorted by container and name
+        '''
+        folded = text.lower()
+        if prefix:
+            rows = self.conn.execute('SELECT container, name FROM objects WHERE folded >= ? AND folded < ? ORDER BY container, name', (folded, folded + max_char))
+        elif len(folded) >= gram_size:
+            #every gram of the text has to be in the name, which leaves only a few names to check
+            text_grams = sorted(grams(folded))[:max_search_grams]
+            rows = self.conn.execute(
+                'SELECT container, name FROM objects WHERE id IN ('
+                'SELECT object FROM grams WHERE gram IN ({}) GROUP BY object HAVING COUNT(*) = ?'
+                ') AND instr(folded, ?) > 0 ORDER BY container, name'.format(', '.join('?' * len(text_grams))),
+                text_grams + [len(text_grams), folded])
+        else:
+            rows = self.conn.execute('SELECT container, name FROM objects WHERE instr(folded, ?) > 0 ORDER BY container, name', (folded,))
+        return rows.fetchall()
@@ -0,0 +1,55 @@
+import threading, queue
+
+# Reads pages of results on a background thread, so the next page is already being fetched while the current one is displayed.
+
+class PageError:
+    '''
+    Carries an exception raised while reading a page back to the thread consuming the pages
+    '''
+    def __init__(self, error):
+        self.error = error
+
+def prefetch(pages, depth=1):
+    '''
+    Yields pages while a background thread reads up to depth pages ahead.
+    Exceptions raised while reading are re-raised when the page they occurred on is reached.
+    If the caller stops early, the background thread stops after the page it is reading.
+    :param pages iterable: The pages of results, each a list
+    :param depth int: The number of pages read ahead of the page being consumed
+    '''
+    ready = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        #give up on the put if the consumer has gone away
+        while not stopped.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+        except Exception as e:
+            put(PageError(e))
+            return
+        put(done)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is done:
+                return
+            if isinstance(item, PageError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
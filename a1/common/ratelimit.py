@@ -0,0 +1,116 @@
+import threading, time, random
+
+# Paces the requests made to a table so that they stay within its provisioned throughput instead of being throttled.
+# Every thread reading or writing a table shares one limiter, and the cost of each request is corrected once the
+# capacity it actually consumed is known.
+
+def backoff(attempt, base=0.05, cap=5.0):
+    '''
+    Exponential backoff with full jitter, so that threads throttled at the same time do not retry at the same time
+    :param attempt int: The number of retries made so far, starting at 1
+    :return: The number of seconds to wait before retrying
+    '''
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class CapacityLimiter:
+    '''
+    A thread-safe token bucket refilled at rate units per second, holding at most burst units.
+    Requests take an estimate of their cost up front and settle the difference once it is known, so the bucket can go
+    into debt and later requests wait until it is paid off.
+    The rate is halved whenever a request is throttled, and recovers a little with every request that is not.
+    '''
+    def __init__(self, rate=None, burst=None, min_fraction=0.1, recovery=0.05):
+        '''
+        :param rate float: The sustainable number of units per second, or None to never wait
+        :param burst float: The most units that can be saved up while idle, one second's worth by default. The bucket
+                            starts with one second's worth, and only builds up to burst while requests are not using it.
+        :param min_fraction float: The lowest fraction of rate that throttling can reduce the rate to
+        :param recovery float: The fraction of rate the rate grows by after every request that is not throttled
+        '''
+        self.lock = threading.Lock()
+        self.min_fraction = min_fraction
+        self.recovery = recovery
+        self.throttles = 0
+        self.waited = 0.0
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst=None):
+        '''
+        Resizes the limiter, used once the table's actual throughput is known.
+        The bucket starts with one second's worth of units rather than full, since a table that was just created (or
+        has just been busy) has no burst capacity saved up yet.
+        '''
+        with self.lock:
+            self.max_rate = rate
+            self.rate = rate
+            self.burst = burst or rate
+            self.tokens = min(self.burst, rate) if rate else 0.0
+            self.updated = time.monotonic()
+
+    def refill(self):
+        #callers hold the lock
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units=1.0):
+        '''
+        Waits until the bucket can cover units (or a full bucket, for requests larger than burst), then takes them
+        :param units float: The estimated cost of the request
+        '''
+        if self.max_rate is None:
+            return
+        while True:
+            with self.lock:
+                self.refill()
+                needed = min(units, self.burst)
+                if self.tokens >= needed:
+                    self.tokens -= units
+                    return
+                wait = (needed - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+    def settle(self, estimated, actual):
+        '''
+        Corrects the bucket once a request's actual cost is known
+        :param estimated float: The units taken by acquire
+        :param actual float: The units the request consumed, or None if the service did not report it
+        '''
+        if self.max_rate is None or actual is None:
+            return
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + estimated - float(actual))
+
+    def throttled(self):
+        '''
+        Records a throttled request, halving the rate and emptying the bucket
+        '''
+        with self.lock:
+            self.throttles += 1
+            if self.max_rate is None:
+                return
+            self.refill()
+            self.rate = max(self.max_rate * self.min_fraction, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        '''
+        Records a request that was not throttled, letting the rate recover towards its maximum
+        '''
+        if self.max_rate is None or self.rate >= self.max_rate:
+            return
+        with self.lock:
+            self.refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
+
+    def report(self, label):
+        '''
+        Prints the limiter's rate, the time threads spent waiting on it, and the number of throttled requests
+        :param label str: Describes the capacity being limited (Write capacity, RUs, etc)
+        '''
+        with self.lock:
+            if self.max_rate is None:
+                print('{} limiter: unlimited, {} throttled request(s)'.format(label, self.throttles))
+            else:
+                print('{} limiter: {:.1f}/{:.1f} units/s, {:.2f}s spent waiting (summed over threads), {} throttled request(s)'.format(label, self.rate, self.max_rate, self.waited, self.throttles))
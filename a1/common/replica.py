@@ -0,0 +1,117 @@
+import sqlite3, decimal, time
+
+# A local SQLite copy of MoviesInfo that answers queries without a round trip to the cloud.
+columns = ['year', 'title', 'directors', 'actors', 'release_date', 'genres', 'image_url', 'running_time_secs', 'plot', 'rank', 'rating']
+column_types = {'year': 'INTEGER', 'running_time_secs': 'INTEGER', 'rank': 'INTEGER', 'rating': 'REAL'}
+indexed_columns = ['title', 'rating', 'rank', 'genres']
+
+sqlite3.register_adapter(decimal.Decimal, float)
+
+def open_replica(filename):
+    '''
+    Opens (creating if needed) the replica database
+    :param filename str: The path of the SQLite file
+    :return: A sqlite3 connection
+    '''
+    conn = sqlite3.connect(filename)
+    conn.row_factory = sqlite3.Row
+    definitions = ['{} {}'.format(column, column_types.get(column, 'TEXT')) for column in columns]
+    conn.execute('CREATE TABLE IF NOT EXISTS movies ({}, PRIMARY KEY (year, title))'.format(', '.join(definitions)))
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    for column in indexed_columns:
+        conn.execute('CREATE INDEX IF NOT EXISTS movies_{0} ON movies ({0})'.format(column))
+    conn.commit()
+    return conn
+
+def begin_rebuild(conn):
+    '''
+    Empties the replica before it is repopulated. Nothing is committed until finish_rebuild is called.
+    '''
+    conn.execute('DELETE FROM movies')
+    conn.execute('DELETE FROM meta')
+
+def insert_rows(conn, rows):
+    '''
+    Inserts rows keyed by column name, ignoring any keys that are not replica columns
+    :param rows iterable: The dicts to insert
+    '''
+    statement = 'INSERT OR REPLACE INTO movies ({}) VALUES ({})'.format(', '.join(columns), ', '.join('?' * len(columns)))
+    conn.executemany(statement, ([row.get(column) for column in columns] for row in rows))
+
+def record(conn, rows, to_row=lambda row: row, batch=500):
+    '''
+    Passes rows through unchanged while copying them into the replica, so it can be built during ingest
+    :param rows iterable: The rows being written to the cloud table
+    :param to_row function: Converts a row into a dict keyed by replica column
+    '''
+    pending = []
+    for row in rows:
+        pending.append(to_row(row))
+        if len(pending) == batch:
+            insert_rows(conn, pending)
+            pending = []
+        yield row
+    insert_rows(conn, pending)
+
+def finish_rebuild(conn, version=None):
+    '''
+    Records the item count and version marker the replica was built from and commits it
+    :param version str: A marker identifying the state of the cloud table, if one is available
+    '''
+    count = conn.execute('SELECT COUNT(*) FROM movies').fetchone()[0]
+    meta = {'item_count': str(count), 'built_at': str(time.time())}
+    if version is not None:
+        meta['version'] = str(version)
+    conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', meta.items())
+    conn.commit()
+    return count
+
+def get_meta(conn, key):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+def is_fresh(conn, version=None, item_count=None):
+    '''
+    Checks the replica against the cloud table's version marker and/or item count
+    :return: True if the replica was built and every provided marker matches
+    '''
+    if get_meta(conn, 'item_count') is None:
+        return False
+    if version is not None and get_meta(conn, 'version') != str(version):
+        return False
+    if item_count is not None and int(get_meta(conn, 'item_count')) != int(item_count):
+        return False
+    return True
+
+def column_name(name, aliases):
+    name = aliases.get(name, name)
+    if name not in columns:
+        raise ValueError('{} is not an attribute in the local replica'.format(name))
+    return name
+
+def select(conn, where, params, to_display, sort=None, aliases={}, limit=None, descending=False):
+    '''
+    Runs a query against the replica
+    :param where str: A SQL condition, or an empty string for every row
+    :param params list: The values bound to the condition
+    :param to_display list: The attributes to return
+    :param sort str: The attribute to sort by
+    :param aliases dict: Maps attribute names used by the caller (such as PartitionKey) to replica columns
+    :param limit int: The maximum number of rows to return
+    :param descending bool: Whether rows are sorted in descending order
+    :return: A list of dicts keyed by the names in to_display, omitting missing attributes
+    '''
+    selected = [column_name(attribute, aliases) for attribute in to_display]
+    statement = 'SELECT {} FROM movies'.format(', '.join(selected))
+    if where:
+        statement += ' WHERE ' + where
+    if sort:
+        statement += ' ORDER BY ' + column_name(sort, aliases)
+        if descending:
+            statement += ' DESC'
+    if limit:
+        statement += ' LIMIT {}'.format(int(limit))
+    results = []
+    for row in conn.execute(statement, params):
+        results.append({attribute: row[i] for i, attribute in enumerate(to_display) if row[i] is not None})
+    return results
@@ -0,0 +1,174 @@
+import sqlite3, threading, re
+
+# An inverted index from the words in a movie's plot, actors, directors, and genres to the keys of the movies they
+# appear in, kept in a local SQLite file. A 'contains' filter on one of these attributes is answered by looking up its
+# words here and reading only the matching movies, instead of scanning the whole table.
+
+indexed_fields = ['plot', 'actors', 'directors', 'genres']
+word_pattern = re.compile(r'\w+')
+#rows inserted (and committed) at a time while the index is built alongside ingest
+batch = 500
+#SQLite limits the number of parameters in a statement
+max_parameters = 500
+
+def tokenize(text):
+    '''
+    Splits text into lowercase words
+    '''
+    return word_pattern.findall(str(text).lower())
+
+def word_patterns(value):
+    '''
+    Converts the value of a 'contains' filter into the words a matching movie has to have.
+    The value can start or end part way through a word, so the first word only has to end a word in the movie, the last
+    word only has to start one, and a value that is a single word only has to appear within one.
+    :return: A list of (word, kind) pairs, kind being 'exact', 'prefix', 'suffix' or 'infix'
+    '''
+    text = str(value).lower()
+    patterns = []
+    for match in word_pattern.finditer(text):
+        open_start = match.start() == 0
+        open_end = match.end() == len(text)
+        if open_start and open_end:
+            kind = 'infix'
+        elif open_start:
+            kind = 'suffix'
+        elif open_end:
+            kind = 'prefix'
+        else:
+            kind = 'exact'
+        patterns.append((match.group(), kind))
+    return patterns
+
+#how the words in the index are matched against each kind of word pattern
+word_conditions = {
+    'exact': 'words.word = ?2',
+    'prefix': 'substr(words.word, 1, length(?2)) = ?2',
+    'suffix': 'substr(words.word, -length(?2)) = ?2',
+    'infix': 'instr(words.word, ?2) > 0'
+}
+
+class TextIndex:
+    '''
+    The inverted index, stored as a table of movie keys, a table of distinct words, and the (word, field, movie) postings.
+    The index is only used once it is ready: built in full for the current version of the table.
+    It may be shared by several query threads, so every statement is run under a lock.
+    '''
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS movies (id INTEGER PRIMARY KEY, partition_key, row_key, UNIQUE (partition_key, row_key))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS words (id INTEGER PRIMARY KEY, word TEXT UNIQUE)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS postings (word INTEGER, field TEXT, movie INTEGER, PRIMARY KEY (word, field, movie)) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+        meta = dict(self.conn.execute('SELECT key, value FROM meta').fetchall())
+        self.version = meta.get('version')
+        self.complete = meta.get('complete') == '1'
+
+    def is_ready(self, version=None):
+        '''
+        :param version str: Identifies the current state of the table, None if it cannot be identified
+        :return: True if the index was built in full for this version of the table
+        '''
+        return self.complete and self.version == (None if version is None else str(version))
+
+    def set_meta(self, **values):
+        #callers hold the lock
+        self.conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [(k, v) for k, v in values.items() if v is not None])
+        for key in [k for k, v in values.items() if v is None]:
+            self.conn.execute('DELETE FROM meta WHERE key = ?', (key,))
+
+    def begin_rebuild(self, version=None):
+        '''
+        Empties the index before it is rebuilt for a version of the table
+        '''
+        with self.lock:
+            for table in ['postings', 'words', 'movies', 'meta']:
+                self.conn.execute('DELETE FROM ' + table)
+            self.version = None if version is None else str(version)
+            self.complete = False
+            self.set_meta(version=self.version, complete='0')
+            self.conn.commit()
+
+    def add(self, entries):
+        '''
+        Indexes movies and commits them
+        :param entries list: (key, movie) pairs, the key being a (partition key, row key) pair and the movie a dict
+        '''
+        with self.lock:
+            for (partition_key, row_key), movie in entries:
+                self.conn.execute('INSERT OR IGNORE INTO movies (partition_key, row_key) VALUES (?, ?)', (partition_key, row_key))
+                movie_id = self.conn.execute('SELECT id FROM movies WHERE partition_key = ? AND row_key = ?', (partition_key, row_key)).fetchone()[0]
+                for field in indexed_fields:
+                    if field not in movie.keys():
+                        continue
+                    words = set(tokenize(movie[field]))
+                    self.conn.executemany('INSERT OR IGNORE INTO words (word) VALUES (?)', [(word,) for word in words])
+                    self.conn.executemany(
+                        'INSERT OR IGNORE INTO postings (word, field, movie) SELECT id, ?, ? FROM words WHERE word = ?',
+                        [(field, movie_id, word) for word in words])
+            self.conn.commit()
+
+    def record(self, movies, to_entry):
+        '''
+        Passes movies through while indexing them, so the index can be built during ingest.
+        Movies are indexed and committed before they are passed on, so the index always covers every movie written.
+        :param movies iterable: The movies being written to the table
+        :param to_entry function: Converts a movie into a (key, movie) pair, see add
+        '''
+        pending = []
+        for movie in movies:
+            pending.append(movie)
+            if len(pending) == batch:
+                self.add([to_entry(m) for m in pending])
+                yield from pending
+                pending = []
+        self.add([to_entry(m) for m in pending])
+        yield from pending
+
+    def finish(self, complete=True):
+        '''
+        Marks the index as built in full, once every movie has been indexed
+        :param complete bool: False if some movies may be missing, so the index is not used
+        '''
+        with self.lock:
+            self.complete = complete
+            self.set_meta(complete='1' if complete else '0')
+            self.conn.commit()
+
+    def count(self):
+        '''
+        :return: The number of movies in the index
+        '''
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM movies').fetchone()[0]
+
+    def lookup(self, field, value):
+        '''
+        Finds the movies that may match a 'contains' filter. Every movie that matches is returned, but matching is done on
+        whole lowercase words, so the results have to be checked against the filter.
+        :param field str: One of indexed_fields
+        :param value str: The value the field has to contain
+        :return: A set of (partition key, row key) pairs, or None if the value has no words to look up
+        '''
+        patterns = word_patterns(value)
+        if field not in indexed_fields or not patterns:
+            return None
+        with self.lock:
+            movie_ids = None
+            for word, kind in patterns:
+                rows = self.conn.execute(
+                    'SELECT DISTINCT postings.movie FROM postings JOIN words ON postings.word = words.id WHERE postings.field = ?1 AND ' + word_conditions[kind],
+                    (field, word)).fetchall()
+                matched = {row[0] for row in rows}
+                movie_ids = matched if movie_ids is None else movie_ids & matched
+                if not movie_ids:
+                    return set()
+            movie_ids = list(movie_ids)
+            keys = set()
+            for start in range(0, len(movie_ids), max_parameters):
+                chunk = movie_ids[start:start + max_parameters]
+                rows = self.conn.execute('SELECT partition_key, row_key FROM movies WHERE id IN ({})'.format(', '.join('?' * len(chunk))), chunk)
+                keys.update((row[0], row[1]) for row in rows)
+            return keys
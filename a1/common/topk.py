@@ -0,0 +1,16 @@
+def take(pages, k):
+    '''
+    Yields pages until k results have been yielded, truncating the last page.
+    No further pages are requested once the limit is reached.
+    :param pages iterable: The pages of results, each a list
+    :param k int: The number of results to yield
+    '''
+    remaining = k
+    if remaining <= 0:
+        return
+    for page in pages:
+        page = page[:remaining]
+        remaining -= len(page)
+        yield page
+        if remaining <= 0:
+            return
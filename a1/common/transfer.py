@@ -0,0 +1,255 @@
+import threading, time, os, json, hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Moves files to and from buckets or containers many at a time, reporting the bytes per second achieved.
+# Each file is itself split into parts sent concurrently by the service's SDK, see the task1 scripts for the settings.
+
+#files transferred at the same time
+default_workers = 8
+#large downloads are fetched in ranges of default_part_size bytes, default_part_workers ranges at a time
+default_part_size = 8 * 1024 * 1024
+default_part_workers = 4
+#bytes read from a response, or from a file being checked, at a time
+chunk_size = 1024 * 1024
+#a download is written to path + partial_suffix, and the ranges completed so far to path + progress_suffix
+partial_suffix = '.partial'
+progress_suffix = '.progress'
+
+class IntegrityError(Exception):
+    '''
+    Raised when a downloaded file does not match the object it was downloaded from
+    '''
+    pass
+
+def format_bytes(count):
+    '''
+    Formats a number of bytes with a binary unit
+    '''
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if count < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(count, unit) if unit != 'B' else '{} B'.format(int(count))
+        count /= 1024
+
+class TransferStats:
+    '''
+    Thread-safe counters shared by every transfer worker
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.end = None
+        self.files = 0
+        self.bytes = 0
+        self.failed = []
+
+    def record_file(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    def record_failure(self, description, error):
+        with self.lock:
+            self.failed.append((description, str(error)))
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def report(self, label='Transfer'):
+        '''
+        Prints the end-of-run throughput report
+        :param label str: Describes the transfers (Upload, Download, etc)
+        '''
+        elapsed = (self.end or time.perf_counter()) - self.start
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+        print('\n{} summary:'.format(label))
+        print('\tFiles: {}'.format(self.files))
+        print('\tBytes: {}'.format(format_bytes(self.bytes)))
+        print('\tThroughput: {}/s over {:.2f}s'.format(format_bytes(rate), elapsed))
+        if self.failed:
+            print('\tFailed files: {}'.format(len(self.failed)))
+            for description, error in self.failed:
+                print('\t\t- {}: {}'.format(description, error))
+
+def run_transfers(jobs, workers=default_workers, label='Transfer'):
+    '''
+    Runs transfers on a thread pool, recording each file's size once it completes and each failure as it happens
+    :param jobs list: (description, path, transfer) tuples, path being the local file read or written and transfer a
+                      function making the transfer, raising an exception if it fails
+    :param workers int: The number of files transferred at the same time
+    :param label str: Describes the transfers in the report
+    :return: The TransferStats for the run, already reported
+    '''
+    stats = TransferStats()
+
+    def run(path, transfer):
+        transfer()
+        stats.record_file(os.path.getsize(path))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(run, path, transfer): description for description, path, transfer in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                stats.record_failure(futures[future], e)
+    stats.finish()
+    stats.report(label)
+    return stats
+
+def file_md5(path):
+    '''
+    :return: The hex MD5 digest of a file, read chunk_size bytes at a time
+    '''
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def multipart_md5(path, part_size):
+    '''
+    :return: The ETag S3 gives an object uploaded from a file in part_size parts: the MD5 of the parts' MD5s followed by
+             the number of parts
+    '''
+    digests = []
+    with open(path, 'rb') as f:
+        for part in iter(lambda: f.read(part_size), b''):
+            digests.append(hashlib.md5(part).digest())
+    return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+class SyncPlan:
+    '''
+    The differences between the local copy of a container's files and its objects: the files to upload, each with the
+    reason it is uploaded, and the objects to delete
+    '''
+    def __init__(self, container):
+        self.container = container
+        self.uploads = []
+        self.deletes = []
+        self.unchanged = 0
+
+    def is_empty(self):
+        return not self.uploads and not self.deletes
+
+    def report(self):
+        print('{}: {} to upload, {} to delete, {} unchanged'.format(self.container, len(self.uploads), len(self.deletes), self.unchanged))
+        for name, reason in self.uploads:
+            print('\t+ {} ({})'.format(name, reason))
+        for name in self.deletes:
+            print('\t- {}'.format(name))
+
+def plan_sync(container, local, remote, local_checksum, delete=False, keep=()):
+    '''
+    Compares local files against a listing of a container, by size and then by checksum.
+    Files are only read when they are the same size as their object and the object's checksum can be compared.
+    :param container str: The name of the container
+    :param local dict: The path of each local file, by the name of its object
+    :param remote dict: The (size, checksum) of each object in the container, by name, the checksum being None if it is not known
+    :param local_checksum function: Called with an object's name, its file's path, and its checksum, returns the file's
+                                    checksum computed the same way, or None if it cannot be
+    :param delete bool: Deletes the objects that have no local file, other than those in keep
+    :param keep iterable: The names of objects that are never deleted, such as files that are expected but missing locally
+    :return: A SyncPlan
+    '''
+    plan = SyncPlan(container)
+    for name, path in sorted(local.items()):
+        if name not in remote:
+            plan.uploads.append((name, 'new'))
+            continue
+        size, checksum = remote[name]
+        if os.path.getsize(path) != size:
+            plan.uploads.append((name, 'size differs'))
+            continue
+        computed = local_checksum(name, path, checksum) if checksum is not None else None
+        if computed is not None and computed != checksum:
+            plan.uploads.append((name, 'content differs'))
+        else:
+            plan.unchanged += 1
+    if delete:
+        plan.deletes = sorted(remote.keys() - local.keys() - set(keep))
+    return plan
+
+def read_progress(path, size, etag, part_size):
+    '''
+    :return: The set of ranges already written to path + partial_suffix, empty unless they were written for the same
+             version of the object in ranges of the same size
+    '''
+    try:
+        with open(path + progress_suffix) as progress_file:
+            progress = json.load(progress_file)
+        if progress['size'] != size or progress['etag'] != etag or progress['part_size'] != part_size:
+            return set()
+        if os.path.getsize(path + partial_suffix) != size:
+            return set()
+        return set(progress['done'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return set()
+
+def write_progress(path, size, etag, part_size, done):
+    #written to a temporary file and moved into place, so an interruption never leaves a half-written progress file
+    with open(path + progress_suffix + '.tmp', 'w') as progress_file:
+        json.dump({'size': size, 'etag': etag, 'part_size': part_size, 'done': sorted(done)}, progress_file)
+    os.replace(path + progress_suffix + '.tmp', path + progress_suffix)
+
+def download_ranges(path, size, etag, fetch, md5=None, part_size=default_part_size, workers=default_part_workers):
+    '''
+    Downloads an object as byte ranges fetched in parallel, each streamed to its offset in a file preallocated to the
+    object's size, so memory use does not grow with the object.
+    The ranges completed are recorded beside the file, and a download that was interrupted resumes from the ranges that
+    are missing as long as the object (its size and ETag) has not changed. The file is only moved to path once every
+    range has been written and checked.
+    :param path str: The file the object is downloaded to
+    :param size int: The size of the object in bytes
+    :param etag str: The object's ETag, fetch should fail rather than return a different version of the object
+    :param fetch function: Called with the first and last offsets of a range (inclusive), returns an iterable of the
+                           bytes in that range
+    :param md5 str: The hex MD5 digest of the object if it is known, which the file is checked against
+    :param part_size int: The number of bytes in each range
+    :param workers int: The number of ranges fetched at the same time
+    :return: The number of bytes fetched, which is less than size if the download was resumed
+    '''
+    part_count = (size + part_size - 1) // part_size
+    done = read_progress(path, size, etag, part_size)
+    if not done:
+        with open(path + partial_suffix, 'wb') as partial:
+            partial.truncate(size)
+    lock = threading.Lock()
+    fetched = [0]
+
+    def download_part(part):
+        first = part * part_size
+        last = min(size, first + part_size) - 1
+        written = 0
+        with open(path + partial_suffix, 'r+b') as partial:
+            partial.seek(first)
+            for chunk in fetch(first, last):
+                partial.write(chunk)
+                written += len(chunk)
+        if written != last - first + 1:
+            raise IntegrityError('Expected {} bytes at offset {} but received {}'.format(last - first + 1, first, written))
+        with lock:
+            done.add(part)
+            fetched[0] += written
+            #a single range has nothing to resume from
+            if part_count > 1:
+                write_progress(path, size, etag, part_size, done)
+
+    remaining = [part for part in range(part_count) if part not in done]
+    if remaining:
+        executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(remaining))))
+        try:
+            for future in as_completed([executor.submit(download_part, part) for part in remaining]):
+                future.result()
+        finally:
+            #once a range fails the download is resumed later, so the ranges still queued are dropped
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    if md5 is not None and file_md5(path + partial_suffix) != md5.lower():
+        os.remove(path + partial_suffix)
+        if os.path.exists(path + progress_suffix):
+            os.remove(path + progress_suffix)
+        raise IntegrityError('{} does not match the MD5 of the object, it will be downloaded again in full'.format(path))
+    os.replace(path + partial_suffix, path)
+    if os.path.exists(path + progress_suffix):
+        os.remove(path + progress_suffix)
+    return fetched[0]
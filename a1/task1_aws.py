@@ -1,5 +1,8 @@
-import boto3, time, os
+import boto3, time, os, re
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+import common.transfer as transfer
+import common.nameindex as nameindex
 
 s3_resource = boto3.resource('s3')
 s3_client = boto3.client('s3')
@@ -9,6 +12,27 @@ buckets = {
         'cis4010-ccorneli': ['4010Lecture1.pdf', '4010Lecture2.pdf', '4010Assignment1.pdf']
 }
 
+#files are uploaded upload_workers at a time, and files over multipart_threshold are split into multipart_chunksize
+#parts with up to max_concurrency parts of each file sent at once
+upload_workers = transfer.default_workers
+multipart_threshold = 8 * 1024 * 1024
+multipart_chunksize = 8 * 1024 * 1024
+max_concurrency = 4
+transfer_config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize, max_concurrency=max_concurrency)
+#objects are downloaded as download_part_size ranges, download_workers ranges at a time, see common/transfer.py
+download_part_size = transfer.default_part_size
+download_workers = transfer.default_part_workers
+#the ETag of an object uploaded in a single part is its MD5, multipart ETags end in -<number of parts>. Neither holds
+#for objects encrypted with SSE-KMS or SSE-C, see etag_is_checksum
+md5_etag = re.compile(r'[0-9a-f]{32}')
+#the most objects DeleteObjects accepts in one request
+delete_batch_size = 1000
+
+#searches are answered from a local index of object names, which relists buckets once their listing is name_index_ttl seconds old
+name_index_filename = 'S3NameIndex.sqlite'
+name_index_ttl = nameindex.default_ttl
+name_index = None
+
 # TODO Ensure using os path functions
 def create_buckets():
     start = time.perf_counter()
@@ -24,15 +48,97 @@ def create_buckets():
             except ClientError as e:
                 print(bucket + ' does not exist. Creating.')
             s3_client.create_bucket(Bucket=bucket)
-            for obj in buckets[bucket]:
-                # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-                s3_client.upload_file(os.path.join('data', obj), bucket, obj)
             print(bucket + ' created successfully.')
+        #existing buckets are brought up to date with data/ rather than assumed to be populated
+        sync_buckets(plan_buckets())
     except ClientError as e:
         print(e)
     end = time.perf_counter()
     print('\nBucket creation completed in ' + str(end - start) + 's')
 
+def object_checksum(bucket_name, obj_name, path, etag):
+    '''
+    :return: The ETag S3 would give the file at path if it was uploaded the way the object with this ETag was, or None
+             if that cannot be worked out
+    '''
+    parts = etag.rpartition('-')[2]
+    if md5_etag.fullmatch(etag):
+        computed = transfer.file_md5(path)
+    #a multipart ETag can only be recomputed if the object was uploaded in parts of multipart_chunksize
+    elif parts.isdigit() and int(parts) == -(-os.path.getsize(path) // multipart_chunksize):
+        computed = transfer.multipart_md5(path, multipart_chunksize)
+    else:
+        return None
+    #listings do not show how an object is encrypted, so only an ETag that does not match is checked with HeadObject
+    if computed != etag and not etag_is_checksum(s3_client.head_object(Bucket=bucket_name, Key=obj_name)):
+        return None
+    return computed
+
+def plan_buckets(delete=False):
+    '''
+    Compares the files in data/ with the objects in each bucket by size and ETag, printing the plan for every bucket.
+    Each bucket is listed once and files are only read when their sizes match.
+    :param delete bool: Also plans to delete the objects that are not listed in buckets
+    :return: A SyncPlan for each bucket
+    '''
+    plans = []
+    for bucket in buckets.keys():
+        local = {}
+        for obj in buckets[bucket]:
+            path = os.path.join('data', obj)
+            if os.path.exists(path):
+                local[obj] = path
+            else:
+                print('WARNING ' + path + ' does not exist, so it is not uploaded to ' + bucket)
+        remote = {name: (size, etag) for name, size, etag in list_object_entries(bucket)}
+        #objects listed in buckets are kept even when their files are missing from data/, as not every file is checked in
+        plan = transfer.plan_sync(bucket, local, remote, lambda name, path, etag, bucket=bucket: object_checksum(bucket, name, path, etag), delete, buckets[bucket])
+        plan.report()
+        plans.append(plan)
+    return plans
+
+def sync_buckets(plans):
+    '''
+    Runs the plans made by plan_buckets, uploading the files that are new or changed and then deleting
+    '''
+    uploads = [(plan.container, name) for plan in plans for name, _ in plan.uploads]
+    deletes = [(plan.container, name) for plan in plans for name in plan.deletes]
+    if not uploads and not deletes:
+        print('Every bucket is up to date')
+        return
+    if uploads:
+        upload_objects(uploads)
+    if deletes:
+        delete_objects(deletes)
+    #the changed buckets are listed by the next search
+    get_name_index().expire({bucket for bucket, _ in uploads + deletes})
+
+def delete_objects(deletes):
+    '''
+    Deletes objects, delete_batch_size per request
+    :param deletes list: (bucket, object name) pairs
+    '''
+    for bucket in sorted({bucket for bucket, _ in deletes}):
+        keys = [name for b, name in deletes if b == bucket]
+        for start in range(0, len(keys), delete_batch_size):
+            response = s3_client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys[start:start + delete_batch_size]], 'Quiet': True})
+            for error in response.get('Errors', []):
+                print('ERROR ' + bucket + '/' + error['Key'] + ' could not be deleted: ' + error['Message'])
+    print('Deleted ' + str(len(deletes)) + ' object(s)')
+
+def upload_objects(uploads):
+    '''
+    Uploads files from data/ to their buckets on a thread pool, large files being sent as concurrent multipart uploads
+    :param uploads list: (bucket, object name) pairs
+    :return: The TransferStats for the uploads
+    '''
+    jobs = []
+    for bucket, obj in uploads:
+        path = os.path.join('data', obj)
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+        jobs.append((bucket + '/' + obj, path, lambda path=path, bucket=bucket, obj=obj: s3_client.upload_file(path, bucket, obj, Config=transfer_config)))
+    return transfer.run_transfers(jobs, upload_workers, 'Upload')
+
 def list_buckets_and_contents():
     start = time.perf_counter()
     try:
@@ -58,43 +164,135 @@ def list_objects(bucket_name, print_stats=False):
     if print_stats:
         print_benchmark(start, end)
 
-# Searches all buckets for objects with names that match an input string
-# NOTE that this matches to lowercase
+def get_name_index():
+    global name_index
+    if name_index is None:
+        name_index = nameindex.NameIndex(name_index_filename, name_index_ttl)
+    return name_index
+
+def list_bucket_names():
+    return [buck['Name'] for buck in s3_client.list_buckets()['Buckets']]
+
+def list_object_entries(bucket_name):
+    '''
+    Lists the name, size, and ETag of every object in a bucket.
+    Buckets are listed on several threads at once, so the (thread-safe) client is used rather than the resource.
+    '''
+    entries = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name):
+        for obj in page.get('Contents', []):
+            entries.append((obj['Key'], obj['Size'], obj['ETag'].strip('"')))
+    return entries
+
+def refresh_name_index(force=False):
+    '''
+    Relists the buckets whose listings in the name index have expired, or every bucket if forced
+    '''
+    listed = get_name_index().refresh(list_bucket_names, list_object_entries, force)
+    if listed:
+        print('Name index: listed {} bucket(s)'.format(listed))
+
+def rebuild_name_index():
+    start = time.perf_counter()
+    try:
+        refresh_name_index(True)
+    except ClientError as e:
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+
+# Searches all buckets for objects with names that match an input string, using the name index
+# NOTE that this matches to lowercase, and a search ending in * only matches names starting with it
 def search_objects(obj_name):
     start = time.perf_counter()
     try:
-        found = False
-        for buck in s3_client.list_buckets()['Buckets']:
-            bucket = s3_resource.Bucket(buck['Name'])
-            for obj in bucket.objects.all():
-                if obj_name.lower() in obj.key.lower():
-                    print('\t- ' + obj.key + ' found in ' + buck['Name'])
-                    found = True
-        if not found:
-            print('No objects have a name containing \'' + obj_name + '\'')
+        refresh_name_index()
+        prefix = obj_name.endswith('*')
+        matches = get_name_index().search(obj_name[:-1] if prefix else obj_name, prefix)
+        for bucket_name, key in matches:
+            print('\t- ' + key + ' found in ' + bucket_name)
+        if not matches:
+            print('No objects have a name ' + ('starting with' if prefix else 'containing') + ' \'' + obj_name.rstrip('*') + '\'')
     except ClientError as e:
         print(e)
     end = time.perf_counter()
     print_benchmark(start, end)
 
-# https://stackoverflow.com/a/34562141
+def is_missing(error):
+    '''
+    :return: True if a ClientError means the object (or its bucket) does not exist
+    '''
+    return error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NoSuchBucket')
+
+def etag_is_checksum(response):
+    '''
+    :param response dict: The response to HeadObject (or GetObject)
+    :return: False if the object is encrypted with SSE-KMS or SSE-C, whose ETags are not computed from the object's content
+    '''
+    return not response.get('ServerSideEncryption', '').startswith('aws:kms') and 'SSECustomerAlgorithm' not in response
+
+def head_object(bucket_name, obj_name):
+    '''
+    :return: The (size, ETag, hex MD5) of an object, the MD5 being None if the ETag is not one, or None if the bucket
+             does not hold it
+    '''
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=obj_name)
+    except ClientError as e:
+        if is_missing(e):
+            return None
+        raise
+    etag = response['ETag'].strip('"')
+    md5 = etag if md5_etag.fullmatch(etag) and etag_is_checksum(response) else None
+    return response['ContentLength'], etag, md5
+
+def locate_object(obj_name):
+    '''
+    Finds the bucket holding an object. The buckets the name index last saw it in are tried first, and if it is not in
+    any of them every bucket is asked at once, the first bucket that holds it being recorded in the name index.
+    :return: A (bucket name, (size, ETag, MD5)) pair, or None if no bucket holds the object
+    '''
+    index = get_name_index()
+    for bucket_name in index.locate(obj_name):
+        found = head_object(bucket_name, obj_name)
+        if found is not None:
+            return bucket_name, found
+        #the object has since moved
+        index.forget(bucket_name, obj_name)
+    located = nameindex.probe(list_bucket_names(), lambda bucket_name: head_object(bucket_name, obj_name))
+    if located is not None:
+        bucket_name, (size, etag, _) = located
+        index.remember(bucket_name, obj_name, size, etag)
+    return located
+
+def save_object(bucket_name, obj_name, size, etag, md5, path):
+    '''
+    Downloads an object in parallel byte ranges, resuming an earlier download of the same version of it.
+    Every range is requested with If-Match, so a download fails rather than mixing versions if the object changes.
+    :return: The number of bytes fetched
+    '''
+    def fetch(first, last):
+        response = s3_client.get_object(Bucket=bucket_name, Key=obj_name, Range='bytes={}-{}'.format(first, last), IfMatch='"' + etag + '"')
+        return response['Body'].iter_chunks(transfer.chunk_size)
+    return transfer.download_ranges(path, size, etag, fetch, md5, download_part_size, download_workers)
+
+# Downloads an object from the bucket the name index last saw it in, or else from the first bucket found to hold it
 def download_object(obj_name):
     start = time.perf_counter()
     try:
-        found = False
-        for buck in s3_client.list_buckets()['Buckets']:
-            bucket = s3_resource.Bucket(buck['Name'])
-            #check if the object exists, and if it does, download it
-            if len(list(bucket.objects.filter(Prefix=obj_name))) == 1:
-                s3_client.download_file(buck['Name'], obj_name, obj_name)
-                print(obj_name + ' downloaded successfully.')
-                found = True
-                break
-
-        if not found:
+        located = locate_object(obj_name)
+        if located is not None:
+            bucket_name, (size, etag, md5) = located
+            fetched = save_object(bucket_name, obj_name, size, etag, md5, obj_name)
+            print(obj_name + ' downloaded successfully from ' + bucket_name + '.')
+            if fetched < size:
+                print('Resumed an earlier download, fetched ' + transfer.format_bytes(fetched) + ' of ' + transfer.format_bytes(size))
+        else:
             print('The object ' + obj_name + ' does not exist in any buckets')
     except ClientError as e:
         print(e)
+    except transfer.IntegrityError as e:
+        print('ERROR ' + str(e))
     end = time.perf_counter()
     print_benchmark(start, end)
         
@@ -104,6 +302,21 @@ def get_bucket_name():
 def get_object_name_list_objects():
     search_objects(input('Enter the full or partial name of the object you wish to search for: '))
 
+def get_sync_options():
+    start = time.perf_counter()
+    try:
+        #every plan is printed before anything is uploaded or deleted
+        plans = plan_buckets(True)
+        deletes = sum(len(plan.deletes) for plan in plans)
+        if deletes and input('Delete the {} object(s) marked with - above? [y/n] '.format(deletes)) != 'y':
+            for plan in plans:
+                plan.deletes = []
+        sync_buckets(plans)
+    except ClientError as e:
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+
 def get_object_and_bucket_names():
     download_object(input('Enter the exact name of the object you wish to download: '))
 
@@ -111,8 +324,10 @@ def prompt():
     return "\nChoose one of the following commands:\n\
         - list objects in (a)ll containers\n\
         - list objects in a (s)pecific container\n\
-        - list objects (w)ith a specific name\n\
+        - list objects (w)ith a specific name (end with * to match the start of names)\n\
+        - (r)efresh the object name index\n\
         - (d)ownload a specific object\n\
+        - (u)pload the files in data/ that are new or changed\n\
         - (q)uit\n>"
 
 def print_benchmark(start, end):
@@ -124,19 +339,22 @@ options = {
     'a': list_buckets_and_contents,
     's': get_bucket_name,
     'w': get_object_name_list_objects,
+    'r': rebuild_name_index,
     'd': get_object_and_bucket_names,
+    'u': get_sync_options,
     'q': exit,
     'quit': exit
 }
 
 
-create_buckets()
-print("\nWelcome to the S3 client wrapper!\n")
-cmd = input(prompt())
+if __name__ == '__main__':
+    create_buckets()
+    print("\nWelcome to the S3 client wrapper!\n")
+    cmd = input(prompt())
 
-while cmd != 'q' or cmd != 'quit':
-    if cmd in options.keys():
-        options[cmd]()
-    else:
-        print('Please enter a valid command')
-    cmd = input(prompt())
\ No newline at end of file
+    while cmd != 'q' or cmd != 'quit':
+        if cmd in options.keys():
+            options[cmd]()
+        else:
+            print('Please enter a valid command')
+        cmd = input(prompt())
\ No newline at end of file
@@ -1,13 +1,34 @@
 import os, time
-from azure.storage.blob import BlobServiceClient
-from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+import common.transfer as transfer
+import common.nameindex as nameindex
 
 if os.getenv('AZURE_STORAGE_CONNECTION_STRING') is None:
     print('ERROR AZURE_STORAGE_CONNECTION_STRING environment variable not set. Exitting')
     exit(0)
 
+#blobs are uploaded upload_workers at a time, and blobs over max_single_put_size are split into max_block_size blocks
+#with up to max_concurrency blocks of each blob sent at once
+upload_workers = transfer.default_workers
+max_single_put_size = 8 * 1024 * 1024
+max_block_size = 4 * 1024 * 1024
+max_concurrency = 4
+#blobs are downloaded as download_part_size ranges, download_workers ranges at a time, see common/transfer.py
+download_part_size = transfer.default_part_size
+download_workers = transfer.default_part_workers
+#the most blobs deleted in one batch request
+delete_batch_size = 256
+
+#searches are answered from a local index of blob names, which relists containers once their listing is name_index_ttl seconds old
+name_index_filename = 'BlobNameIndex.sqlite'
+name_index_ttl = nameindex.default_ttl
+name_index = None
+
 #connection timeout must be specified in order to avoid a deprecation warning in one of the azure libraries
-blob_client = BlobServiceClient.from_connection_string(os.getenv('AZURE_STORAGE_CONNECTION_STRING'), connection_timeout=60)
+blob_client = BlobServiceClient.from_connection_string(os.getenv('AZURE_STORAGE_CONNECTION_STRING'), connection_timeout=60,
+                                                       max_single_put_size=max_single_put_size, max_block_size=max_block_size)
 containers = {
         "cis3110": ['3110Assignment1.pdf', '3110Lecture1.pdf', '3110Lecture2.pdf', '3110Lecture3.pdf'],
         "cis1300": ['1300Assignment1.pdf', '1300Assignment2.pdf', '1300Assignment3.pdf', '1300Assignment4.pdf'],
@@ -20,16 +41,98 @@ def create_containers():
     for container in containers.keys():
         try:
             blob_client.create_container(container)
-            for obj in containers[container]:
-                blob_upload_client = blob_client.get_blob_client(container=container, blob=obj)
-                with open(os.path.join('data', obj), "rb") as data:
-                    blob_upload_client.upload_blob(data)
             print(container + ' created successfully.')
         except ResourceExistsError:
             print('Container ' + container + ' already exists.')
+    #existing containers are brought up to date with data/ rather than assumed to be populated
+    sync_containers(plan_containers())
     end = time.perf_counter()
     print('\nContainer creation completed in ' + str(end - start) + 's')
 
+def upload_blob(container, blob_name, path):
+    '''
+    Uploads a single file, large files being sent as blocks uploaded in parallel.
+    The file's MD5 is stored with the blob, so syncs can tell whether the blob differs from the file.
+    '''
+    content_settings = ContentSettings(content_md5=bytearray.fromhex(transfer.file_md5(path)))
+    with open(path, "rb") as data:
+        blob_client.get_blob_client(container=container, blob=blob_name).upload_blob(data, overwrite=True, max_concurrency=max_concurrency, content_settings=content_settings)
+
+def upload_blobs(uploads):
+    '''
+    Uploads files from data/ to their containers on a thread pool
+    :param uploads list: (container, blob name) pairs
+    :return: The TransferStats for the uploads
+    '''
+    jobs = []
+    for container, obj in uploads:
+        path = os.path.join('data', obj)
+        jobs.append((container + '/' + obj, path, lambda container=container, obj=obj, path=path: upload_blob(container, obj, path)))
+    return transfer.run_transfers(jobs, upload_workers, 'Upload')
+
+def list_blob_checksums(container_name):
+    '''
+    :return: The (size, hex MD5) of every blob in a container by name, the MD5 being None if it was not stored with the blob
+    '''
+    checksums = {}
+    for blob in blob_client.get_container_client(container_name).list_blobs():
+        content_md5 = blob.content_settings.content_md5
+        checksums[blob['name']] = (blob['size'], bytes(content_md5).hex() if content_md5 else None)
+    return checksums
+
+def plan_containers(delete=False):
+    '''
+    Compares the files in data/ with the blobs in each container by size and MD5, printing the plan for every container.
+    Each container is listed once and files are only read when their sizes match.
+    :param delete bool: Also plans to delete the blobs that are not listed in containers
+    :return: A SyncPlan for each container
+    '''
+    plans = []
+    for container in containers.keys():
+        local = {}
+        for obj in containers[container]:
+            path = os.path.join('data', obj)
+            if os.path.exists(path):
+                local[obj] = path
+            else:
+                print('WARNING ' + path + ' does not exist, so it is not uploaded to ' + container)
+        #blobs listed in containers are kept even when their files are missing from data/, as not every file is checked in
+        plan = transfer.plan_sync(container, local, list_blob_checksums(container), lambda name, path, md5: transfer.file_md5(path), delete, containers[container])
+        plan.report()
+        plans.append(plan)
+    return plans
+
+def sync_containers(plans):
+    '''
+    Runs the plans made by plan_containers, uploading the files that are new or changed and then deleting
+    '''
+    uploads = [(plan.container, name) for plan in plans for name, _ in plan.uploads]
+    deletes = [(plan.container, name) for plan in plans for name in plan.deletes]
+    if not uploads and not deletes:
+        print('Every container is up to date')
+        return
+    if uploads:
+        upload_blobs(uploads)
+    if deletes:
+        delete_blobs(deletes)
+    #the changed containers are listed by the next search
+    get_name_index().expire({container for container, _ in uploads + deletes})
+
+def delete_blobs(deletes):
+    '''
+    Deletes blobs, delete_batch_size per batch request
+    :param deletes list: (container, blob name) pairs
+    '''
+    for container in sorted({container for container, _ in deletes}):
+        names = [name for c, name in deletes if c == container]
+        container_client = blob_client.get_container_client(container)
+        for start in range(0, len(names), delete_batch_size):
+            try:
+                container_client.delete_blobs(*names[start:start + delete_batch_size])
+            except HttpResponseError as e:
+                print('ERROR some blobs in ' + container + ' could not be deleted: ' + str(e))
+    print('Deleted ' + str(len(deletes)) + ' blob(s)')
+
 def list_containers_and_blobs():
     '''
     Lists all containers and the blobs in each one.
@@ -52,36 +155,113 @@ def list_blobs(container_name, print_stats=False):
     if print_stats:
         print_benchmark(start, end)
 
+def get_name_index():
+    global name_index
+    if name_index is None:
+        name_index = nameindex.NameIndex(name_index_filename, name_index_ttl)
+    return name_index
+
+def list_container_names():
+    return [container['name'] for container in blob_client.list_containers()]
+
+def list_blob_entries(container_name):
+    '''
+    Lists the name, size, and ETag of every blob in a container
+    '''
+    return [(blob['name'], blob['size'], blob['etag'].strip('"')) for blob in blob_client.get_container_client(container_name).list_blobs()]
+
+def refresh_name_index(force=False):
+    '''
+    Relists the containers whose listings in the name index have expired, or every container if forced
+    '''
+    listed = get_name_index().refresh(list_container_names, list_blob_entries, force)
+    if listed:
+        print('Name index: listed {} container(s)'.format(listed))
+
+def rebuild_name_index():
+    start = time.perf_counter()
+    refresh_name_index(True)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+
 def search_blobs(blob_name):
+    '''
+    Searches every container for blobs whose names contain blob_name (ignoring case) using the name index.
+    A search ending in * only matches names starting with it.
+    '''
     start = time.perf_counter()
-    found = False
-    for container in blob_client.list_containers():
-        for blob in blob_client.get_container_client(container['name']).list_blobs():
-            if blob_name.lower() in blob['name'].lower():
-                print('\t - ' + blob['name'] + ' found in ' + container['name'])
-                found = True
-    if not found:
-        print('No blobs have a name containing \'' + blob_name + '\'')
+    refresh_name_index()
+    prefix = blob_name.endswith('*')
+    matches = get_name_index().search(blob_name[:-1] if prefix else blob_name, prefix)
+    for container_name, name in matches:
+        print('\t - ' + name + ' found in ' + container_name)
+    if not matches:
+        print('No blobs have a name ' + ('starting with' if prefix else 'containing') + ' \'' + blob_name.rstrip('*') + '\'')
     end = time.perf_counter()
     print_benchmark(start, end)
 
+def blob_properties(container_name, blob_name):
+    '''
+    :return: The (size, ETag, hex MD5) of a blob, the MD5 being None if it was not stored with the blob, or None if the
+             container does not hold it
+    '''
+    try:
+        properties = blob_client.get_blob_client(container_name, blob_name).get_blob_properties()
+    except ResourceNotFoundError:
+        return None
+    content_md5 = properties.content_settings.content_md5
+    return properties.size, properties.etag.strip('"'), bytes(content_md5).hex() if content_md5 else None
+
+def locate_blob(blob_name):
+    '''
+    Finds the container holding a blob. The containers the name index last saw it in are tried first, and if it is not in
+    any of them every container is asked at once, the first container that holds it being recorded in the name index.
+    :return: A (container name, (size, ETag, MD5)) pair, or None if no container holds the blob
+    '''
+    index = get_name_index()
+    for container_name in index.locate(blob_name):
+        found = blob_properties(container_name, blob_name)
+        if found is not None:
+            return container_name, found
+        #the blob has since moved
+        index.forget(container_name, blob_name)
+    located = nameindex.probe(list_container_names(), lambda container_name: blob_properties(container_name, blob_name))
+    if located is not None:
+        container_name, (size, etag, _) = located
+        index.remember(container_name, blob_name, size, etag)
+    return located
+
+def save_blob(container_name, blob_name, size, etag, md5, path):
+    '''
+    Downloads a blob in parallel byte ranges, resuming an earlier download of the same version of it.
+    Every range is requested with If-Match, so a download fails rather than mixing versions if the blob changes.
+    :return: The number of bytes fetched
+    '''
+    def fetch(first, last):
+        downloader = blob_client.get_blob_client(container_name, blob_name).download_blob(
+            offset=first, length=last - first + 1, etag='"' + etag + '"', match_condition=MatchConditions.IfNotModified)
+        return downloader.chunks()
+    return transfer.download_ranges(path, size, etag, fetch, md5, download_part_size, download_workers)
+
 def download_blob(blob_name):
     '''
-    Downloads a specific blob
+    Downloads a specific blob from the container the name index last saw it in, or else from the first container found to hold it
     '''
     start = time.perf_counter()
-    found = False
-    for container in blob_client.list_containers():
-        for blob in blob_client.get_container_client(container['name']).list_blobs():
-            if blob_name == blob['name']:
-                found = True
-                with open(blob_name, "wb") as download_file:
-                    download_client = blob_client.get_blob_client(container['name'], blob_name)
-                    download_file.write(download_client.download_blob().readall())
-                print(blob_name + ' downloaded successfully.')
-                break
-    if not found:
-        print('The blob ' + blob_name + ' does not exist in any containers.')
+    try:
+        located = locate_blob(blob_name)
+        if located is not None:
+            container_name, (size, etag, md5) = located
+            fetched = save_blob(container_name, blob_name, size, etag, md5, blob_name)
+            print(blob_name + ' downloaded successfully from ' + container_name + '.')
+            if fetched < size:
+                print('Resumed an earlier download, fetched ' + transfer.format_bytes(fetched) + ' of ' + transfer.format_bytes(size))
+        else:
+            print('The blob ' + blob_name + ' does not exist in any containers.')
+    except HttpResponseError as e:
+        print(e)
+    except transfer.IntegrityError as e:
+        print('ERROR ' + str(e))
     end = time.perf_counter()
     print_benchmark(start, end)
             
@@ -91,6 +271,21 @@ def get_container_name():
 def get_blob_name_list_blobs():
     search_blobs(input('Enter the full or partial name of the blob(s) you wish to search for: '))    
 
+def get_sync_options():
+    start = time.perf_counter()
+    try:
+        #every plan is printed before anything is uploaded or deleted
+        plans = plan_containers(True)
+        deletes = sum(len(plan.deletes) for plan in plans)
+        if deletes and input('Delete the {} blob(s) marked with - above? [y/n] '.format(deletes)) != 'y':
+            for plan in plans:
+                plan.deletes = []
+        sync_containers(plans)
+    except HttpResponseError as e:
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+
 def get_download_name():
     download_blob(input('Enter the name of the blob you wish to download: ')),
     
@@ -99,8 +294,10 @@ def prompt():
     return "\nChoose one of the following commands:\n\
         - list objects in (a)ll containers\n\
         - list objects in a (s)pecific container\n\
-        - list objects (w)ith a specific name\n\
+        - list objects (w)ith a specific name (end with * to match the start of names)\n\
+        - (r)efresh the blob name index\n\
         - (d)ownload a specific blob\n\
+        - (u)pload the files in data/ that are new or changed\n\
         - (q)uit\n>"
             
 def print_benchmark(start, end):
@@ -112,19 +309,22 @@ options = {
     'a': list_containers_and_blobs,
     's': get_container_name,
     'w': get_blob_name_list_blobs,
+    'r': rebuild_name_index,
     'd': get_download_name,
+    'u': get_sync_options,
     'q': exit,
     'quit': exit
 }
 
 
-print("\nWelcome to the Azure client wrapper!\n")
-create_containers()
-cmd = input(prompt())
+if __name__ == '__main__':
+    print("\nWelcome to the Azure client wrapper!\n")
+    create_containers()
+    cmd = input(prompt())
 
-while cmd != 'q' or cmd != 'quit':
-    if cmd in options.keys():
-        options[cmd]()
-    else:
-        print('Please enter a valid command')
-    cmd = input(prompt())
\ No newline at end of file
+    while cmd != 'q' or cmd != 'quit':
+        if cmd in options.keys():
+            options[cmd]()
+        else:
+            print('Please enter a valid command')
+        cmd = input(prompt())
\ No newline at end of file
@@ -1,13 +1,90 @@
-import boto3, time, json, decimal, os
+import boto3, time, json, decimal, os, threading, math
 from botocore.exceptions import ClientError, ParamValidationError
-from boto3.dynamodb.conditions import Attr, And
+from boto3.dynamodb.conditions import Attr, Key
 from prettytable import PrettyTable
+import common.ingest as ingest
+import common.moviedata as moviedata
+import common.replica as replica
+import common.export as export
+import common.topk as topk
+import common.filters as filters
+import common.cache as cache
+import common.checkpoint as checkpoint
+import common.ratelimit as ratelimit
+import common.columns as columns
+import common.textindex as textindex
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 dynamodb_resource = boto3.resource('dynamodb', region_name='us-east-1')
 dynamodb_client = boto3.client('dynamodb', region_name='us-east-1')
 info_keys = ['directors', 'actors', 'release_date', 'genres', 'image_url', 'running_time_secs', 'plot', 'rank', 'rating']
 download_options = ['y', 'n']
 
+#the exceptions reported for a failed query
+query_errors = (ClientError, ParamValidationError)
+#error codes returned when a request exceeds the table's throughput, these are retried after backing off
+throttle_errors = ['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded']
+
+#the provisioned throughput of the table and each of its indexes
+read_capacity_units = 10
+write_capacity_units = 10
+#DynamoDB saves up to 5 minutes of unused capacity for bursts, the limiters start with none saved and build it up while idle
+burst_seconds = 300
+#every read and write is paced to stay within the table's throughput, see size_limiters
+read_limiter = ratelimit.CapacityLimiter(read_capacity_units, read_capacity_units * burst_seconds)
+write_limiter = ratelimit.CapacityLimiter(write_capacity_units, write_capacity_units * burst_seconds)
+
+#BatchWriteItem accepts at most 25 put requests per call
+batch_size = 25
+ingest_workers = 8
+max_batch_retries = 10
+#year ranges spanning at most this many partitions are answered with one Query per year
+max_partition_fanout = 20
+#number of Segments (and threads) used when a full table scan cannot be avoided
+scan_workers = 4
+
+#every item shares this partition, so that the rating and rank indexes hold the whole table in order
+index_partition_attribute = 'catalog'
+index_partition_value = 'movies'
+#attributes copied into every index, plot and image_url are left out to keep the indexes small
+index_projection = ['directors', 'actors', 'release_date', 'genres', 'running_time_secs', 'rank', 'rating']
+global_secondary_indexes = [
+    {'name': 'RatingIndex', 'partition_key': (index_partition_attribute, 'S'), 'sort_key': ('rating', 'N')},
+    {'name': 'RankIndex', 'partition_key': (index_partition_attribute, 'S'), 'sort_key': ('rank', 'N')},
+    {'name': 'GenresRatingIndex', 'partition_key': ('genres', 'S'), 'sort_key': ('rating', 'N')}
+]
+thread_local = threading.local()
+
+#results are held column by column, numbers in typed arrays and repeated strings interned, see common/columns.py
+column_types = {'year': 'int', 'rank': 'int', 'running_time_secs': 'int', 'rating': 'float', 'genres': 'category', 'directors': 'category'}
+
+results_filename = 'AWSQueryResults.csv'
+#results are saved as a CSV unless the file ends in .jsonl, .parquet, or .arrow, see common/export.py
+export_types = column_types
+export_row_group_size = export.default_row_group_size
+movies_filename = os.path.join('.', 'data', 'moviedata.json')
+#records how far population of the table has got, see populate_table
+checkpoint_filename = 'AWSIngestCheckpoint.json'
+
+#full results are cached in memory so that queries rerun with another sort or limit are answered locally
+cache_max_entries = 32
+cache_max_bytes = 64 * 1024 * 1024
+cache_ttl = 300
+result_cache = cache.ResultCache(cache_max_entries, cache_max_bytes, cache_ttl)
+
+#the local replica is opt-in, see the README
+replica_filename = 'AWSMoviesReplica.sqlite'
+replica_conn = None
+
+#an inverted index of the words in each movie's plot, actors, directors, and genres, see common/textindex.py
+text_index_filename = 'AWSTextIndex.sqlite'
+text_index = None
+#a 'contains' filter matching more movies than this is answered with a Scan, which reads fewer capacity units than
+#fetching that many movies by key
+max_index_candidates = 500
+#BatchGetItem accepts at most 100 keys per call
+batch_get_size = 100
+
 def print_benchmark(start, end):
     print('\nTask completed in ' + str(end-start) + 's')
 
@@ -21,137 +98,446 @@ def stringify_list(to_stringify):
     else:
         return to_stringify[0]
 
-def query(filters, table, sort=None, to_display=None, download=False):
+def create_item(movie):
     '''
-    Queries DynamoDB using the input from the user
-    :param filters list: The list of Attr object expressions that will be chained together with '&' to create the filter
-    :param table Table: The table object to be queried upon
-    :param sort string: the key to sort by
+    Flattens a movie from the JSON file into a DynamoDB item
+    :param movie dict: A dictionary containing keys pertaining to movie information
+    :return: A dict with the year, title, index partition, and every info key present on the movie
+    '''
+    item = {}
+    item['year'] = int(movie['year'])
+    item['title'] = movie['title']
+    item[index_partition_attribute] = index_partition_value
+    for key in info_keys:
+        if key in movie['info'].keys():
+            if (type(movie['info'][key]) == list):
+                item[key] = stringify_list(movie['info'][key])
+            else:
+                item[key] = movie['info'][key]
+    return item
+
+def get_thread_resource():
+    '''
+    boto3 resources are not thread-safe, so every writer thread gets its own session and resource
+    '''
+    if not hasattr(thread_local, 'resource'):
+        thread_local.resource = boto3.session.Session().resource('dynamodb', region_name='us-east-1')
+    return thread_local.resource
+
+def write_batch(items, stats):
+    '''
+    Writes up to 25 items with BatchWriteItem, paced by the write limiter.
+    UnprocessedItems and throttled requests are resubmitted after backing off.
+    :param items list: The items to be written
+    :param stats IngestStats: The counters the batch is recorded in
+    :return: True if every item was written
+    '''
+    resource = get_thread_resource()
+    request_items = {'MoviesInfo': [{'PutRequest': {'Item': item}} for item in items]}
+    retries = 0
+    capacity = 0.0
+    while request_items:
+        #each item is assumed to cost 1 WCU until the actual consumption is returned
+        estimate = len(request_items['MoviesInfo'])
+        write_limiter.acquire(estimate)
+        try:
+            response = resource.batch_write_item(RequestItems=request_items, ReturnConsumedCapacity='TOTAL')
+        except ClientError as e:
+            write_limiter.settle(estimate, 0)
+            if not is_throttled(e) or retries >= max_batch_retries:
+                stats.record_failure('{} to {}'.format(items[0]['title'], items[-1]['title']), e)
+                return False
+            retries += 1
+            write_limiter.throttled()
+            time.sleep(ratelimit.backoff(retries))
+            continue
+        used = sum(consumed.get('CapacityUnits', 0) for consumed in response.get('ConsumedCapacity', []))
+        capacity += used
+        write_limiter.settle(estimate, used)
+        request_items = response.get('UnprocessedItems')
+        if request_items:
+            #unprocessed items are returned when the table's throughput is exceeded
+            write_limiter.throttled()
+            retries += 1
+            if retries > max_batch_retries:
+                unprocessed = len(request_items['MoviesInfo'])
+                stats.record_batch(len(items) - unprocessed, retries, capacity)
+                stats.record_failure('{} to {}'.format(items[0]['title'], items[-1]['title']), '{} items left unprocessed'.format(unprocessed))
+                return False
+            time.sleep(ratelimit.backoff(retries))
+        else:
+            write_limiter.succeeded()
+    stats.record_batch(len(items), retries, capacity)
+    return True
+
+def bulk_load(entries, workers=ingest_workers, progress=None):
+    '''
+    Loads items into MoviesInfo in 25-item batches spread over several writer threads
+    :param entries iterable: (offset, item) pairs, the offset being the item's position in the movies json file
+    :param workers int: The number of concurrent writer threads
+    :param progress Checkpoint: If set, every batch that is fully written is recorded in it
+    :return: The IngestStats for the run
+    '''
+    stats = ingest.IngestStats()
+
+    def write(batch):
+        if write_batch([item for _, item in batch], stats) and progress is not None:
+            progress.complete([offset for offset, _ in batch])
+
+    ingest.run_batches(ingest.chunk(entries, batch_size), write, workers)
+    stats.finish()
+    return stats
+
+def build_projection(to_display):
+    '''
+    Builds a ProjectionExpression where every attribute is aliased, since year and rank are reserved words in DynamoDB
     :param to_display str: A comma-separated list of attributes to be displayed
+    :return: The projection expression and its ExpressionAttributeNames
+    '''
+    names = {}
+    for i, attribute in enumerate(to_display.split(',')):
+        names['#p{}'.format(i)] = attribute
+    return ', '.join(names.keys()), names
+
+def iter_pages(operation, params, consumed):
+    '''
+    Runs a Scan or Query, yielding each page as it arrives and following LastEvaluatedKey until every page has been read.
+    Pages are paced by the read limiter, and throttled pages are requested again after backing off.
+    :param operation function: table.scan or table.query
+    :param params dict: The parameters passed to the operation
+    :param consumed dict: Accumulates the CapacityUnits consumed by every page
+    '''
+    # https://stackoverflow.com/questions/36780856/complete-scan-of-dynamodb-with-boto3
+    params = dict(params)
+    retries = 0
+    while True:
+        #the cost of a page is unknown until it is read, so only 1 RCU is taken up front and the rest is settled afterwards
+        read_limiter.acquire(1)
+        try:
+            results = operation(**params)
+        except ClientError as e:
+            read_limiter.settle(1, 0)
+            if not is_throttled(e) or retries >= max_batch_retries:
+                raise
+            retries += 1
+            read_limiter.throttled()
+            time.sleep(ratelimit.backoff(retries))
+            continue
+        used = results.get('ConsumedCapacity', {}).get('CapacityUnits')
+        read_limiter.settle(1, used)
+        read_limiter.succeeded()
+        retries = 0
+        consumed['CapacityUnits'] += used or 0
+        yield results['Items']
+        if not results.get('LastEvaluatedKey'):
+            return
+        params['ExclusiveStartKey'] = results['LastEvaluatedKey']
+
+def fetch_pages(operation, params, consumed):
+    '''
+    Runs a Scan or Query to completion
+    :return: All items returned
+    '''
+    items = []
+    for page in iter_pages(operation, params, consumed):
+        items.extend(page)
+    return items
+
+def scan_segment(params, segment, total_segments):
+    '''
+    Scans a single segment of MoviesInfo on the calling thread
+    :return: The items in the segment and the capacity consumed reading them
+    '''
+    consumed = {'CapacityUnits': 0.0}
+    segment_table = get_thread_resource().Table('MoviesInfo')
+    items = fetch_pages(segment_table.scan, dict(params, Segment=segment, TotalSegments=total_segments), consumed)
+    return items, consumed['CapacityUnits']
+
+def iter_parallel_scan(params, consumed, workers):
+    '''
+    Splits a Scan into Segment/TotalSegments and reads every segment concurrently, yielding each segment as it completes
+    :param params dict: The parameters passed to every segment's scan
+    :param consumed dict: Accumulates the CapacityUnits consumed by every segment
+    :param workers int: The number of segments, each of which is read by its own thread
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scan_segment, params, segment, workers) for segment in range(workers)]
+        for future in as_completed(futures):
+            items, capacity = future.result()
+            consumed['CapacityUnits'] += capacity
+            yield items
+
+def parallel_scan(params, consumed, workers):
+    '''
+    Runs a parallel scan to completion
+    :return: All items returned
     '''
-    start = time.perf_counter()
     movies = []
-    if len(filters) > 1:
-        filters = And(*filters)
-    elif len(filters) is 1:
-        filters = filters[0]
+    for items in iter_parallel_scan(params, consumed, workers):
+        movies.extend(items)
+    return movies
+
+def iter_key_pages(keys, params, consumed):
+    '''
+    Reads items by key with BatchGetItem, 100 keys at a time, yielding each response as a page.
+    Requests are paced by the read limiter, and UnprocessedKeys and throttled requests are resubmitted after backing off.
+    :param keys list: The (year, title) keys of the items to read
+    :param params dict: The ProjectionExpression and ExpressionAttributeNames the items are read with, if any
+    :param consumed dict: Accumulates the CapacityUnits consumed by every request
+    '''
+    resource = get_thread_resource()
+    request = {name: params[name] for name in ['ProjectionExpression', 'ExpressionAttributeNames'] if name in params}
+    for batch in ingest.chunk(keys, batch_get_size):
+        request_items = {'MoviesInfo': dict(request, Keys=[{'year': year, 'title': title} for year, title in batch])}
+        retries = 0
+        while request_items:
+            #the cost of a batch is unknown until it is read, so only 1 RCU is taken up front and the rest is settled afterwards
+            read_limiter.acquire(1)
+            try:
+                response = resource.batch_get_item(RequestItems=request_items, ReturnConsumedCapacity='TOTAL')
+            except ClientError as e:
+                read_limiter.settle(1, 0)
+                if not is_throttled(e) or retries >= max_batch_retries:
+                    raise
+                retries += 1
+                read_limiter.throttled()
+                time.sleep(ratelimit.backoff(retries))
+                continue
+            used = sum(capacity.get('CapacityUnits', 0) for capacity in response.get('ConsumedCapacity', []))
+            read_limiter.settle(1, used)
+            consumed['CapacityUnits'] += used
+            yield response['Responses'].get('MoviesInfo', [])
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                read_limiter.succeeded()
+            elif retries >= max_batch_retries:
+                print('ERROR {} movies could not be read after {} retries.'.format(len(request_items['MoviesInfo']['Keys']), retries))
+                break
+            else:
+                retries += 1
+                read_limiter.throttled()
+                time.sleep(ratelimit.backoff(retries))
+
+def iter_table_pages(plan, table, to_display, workers, consumed, limit=None, descending=False):
+    '''
+    Reads the items matching a plan from DynamoDB, yielding them a page at a time as ResultColumns
+    :param consumed dict: Accumulates the CapacityUnits consumed by the read
+    :param limit int: If set, pushed down as the Limit of each request, and parallel scans are skipped so reading can stop early
+    :param descending bool: Whether partitions and sort keys are read in descending order
+    '''
+    params = {'ReturnConsumedCapacity': 'TOTAL'}
+    client_filter = plan.get('client_filter')
+    if (to_display):
+        projection = to_display.split(',')
+        #attributes evaluated client-side have to be read even if they are not displayed
+        projection += sorted(filters.referenced_attributes(client_filter) - set(projection))
+        params['ProjectionExpression'], params['ExpressionAttributeNames'] = build_projection(','.join(projection))
+    if plan['filter'] is not None:
+        params['FilterExpression'] = filters.to_condition(plan['filter'], Attr)
+    elif limit and client_filter is None:
+        #Limit is applied before any filter, so it is only pushed down when there is no filter
+        params['Limit'] = limit
+
+    if plan['index']:
+        params['IndexName'] = plan['index']
+    if plan['type'] == 'query':
+        key_conditions = plan['key_conditions']
+        if descending:
+            key_conditions = list(reversed(key_conditions))
+        for key_condition in key_conditions:
+            for items in iter_pages(table.query, dict(params, KeyConditionExpression=key_condition, ScanIndexForward=not descending), consumed):
+                page = columns.ResultColumns(column_types, items)
+                if client_filter is not None:
+                    page = filters.select(client_filter, page)
+                yield page
+    elif plan['type'] == 'keys':
+        for items in iter_key_pages(plan['keys'], params, consumed):
+            yield filters.select(client_filter, columns.ResultColumns(column_types, items))
     else:
-        filters = None
+        pages = iter_parallel_scan(params, consumed, workers) if workers > 1 and not limit else iter_pages(table.scan, params, consumed)
+        for items in pages:
+            yield columns.ResultColumns(column_types, items)
+
+def iter_local(pages, sort, limit=None, descending=False):
+    '''
+    Sorts and limits results that are read in full before being displayed.
+    Sorted results are yielded as a single page, and a sorted limit is reduced with a bounded heap as the pages arrive.
+    :param pages iterable: The pages of results, each a ResultColumns or a list
+    '''
+    if limit and sort:
+        yield columns.top_k(pages, limit, sort, descending, column_types)
+    elif limit:
+        yield from topk.take(pages, limit)
+    elif sort:
+        yield sort_movies(columns.concat(pages, column_types), sort, descending)
+    else:
+        yield from pages
+
+def is_key_ordered(plan, sort):
+    '''
+    Checks whether DynamoDB already returns a plan's results in the requested order, see build_query_plan
+    '''
+    return sort is None or sort in plan['ordered_by']
+
+def sort_movies(movies, sort, descending=False):
+    '''
+    Sorts the results of a query by a key or attribute.
+    Missing attributes sort before every value, as NULLs do in the local replica.
+    :param movies ResultColumns: The results, a list of results is decoded first
+    :return: The sorted ResultColumns
+    '''
+    if not isinstance(movies, columns.ResultColumns):
+        movies = columns.ResultColumns(column_types, movies)
+    if sort:
+        if sort in ['PartitionKey', 'RowKey'] + info_keys + ['title', 'year']:
+            movies = movies.sorted(sort, descending)
+    return movies
+
+def query_replica(plan, sort, to_display, limit=None, descending=False):
+    '''
+    Answers a query from the local replica
+    :return: The sorted results, or None if the replica cannot evaluate the filters
+    '''
     try:
-        results = {}
-        to_display_cpy = to_display.replace('year', '#y')
-        to_display_cpy = to_display_cpy.replace('rank', '#r')
-        if (to_display):
-            if ('year' in to_display or 'rank' in to_display):
-                if (filters):
-                    results = table.scan(FilterExpression=filters, ProjectionExpression=to_display_cpy, ExpressionAttributeNames={'#y': 'year', '#r': 'rank'})
-                else:
-                    results = table.scan(ProjectionExpression=to_display_cpy, ExpressionAttributeNames={'#y': 'year', '#r': 'rank'})
+        where, params = filters.to_sql(filters.combine(plan['predicates']))
+        return replica.select(replica_conn, where, params, to_display.split(','), sort, limit=limit, descending=descending)
+    except (ValueError, replica.sqlite3.Error) as e:
+        print('The local replica cannot answer this query, reading from DynamoDB instead. ' + str(e))
+        return None
+
+def iter_results(plan, table, sort, to_display, workers, consumed, limit=None, descending=False):
+    '''
+    Picks where a query's results are read from
+    :return: An iterable of result pages and a description of how they are read
+    '''
+    description = plan['description']
+    if plan['type'] == 'scan' and workers > 1 and not limit:
+        description = '{} over {} parallel segments'.format(plan['description'], workers)
+    if replica_conn is not None:
+        movies = query_replica(plan, sort, to_display, limit, descending)
+        if movies is not None:
+            return [movies], 'Local replica ' + replica_filename
+    #results are cached unsorted, so a query that only changes the sort or limit is answered locally
+    key = cache.cache_key(plan['predicates'], to_display)
+    movies = result_cache.get(key)
+    if movies is not None:
+        return iter_local([movies], sort, limit, descending), 'Result cache ({})'.format(plan['description'])
+    if limit and is_key_ordered(plan, sort):
+        #reading stops early, so these results are not cached
+        description += ', stopping after {} results'.format(limit)
+        return topk.take(iter_table_pages(plan, table, to_display, workers, consumed, limit, descending), limit), description
+    if limit:
+        description += ', top {} kept in a bounded heap'.format(limit)
+    pages = result_cache.record(key, iter_table_pages(plan, table, to_display, workers, consumed), lambda pages: columns.concat(pages, column_types))
+    return iter_local(pages, sort, limit, descending), description
+
+def fetch_movies(plan, table, sort=None, to_display=None, limit=None, descending=False, workers=scan_workers):
+    '''
+    Runs a query without displaying anything, for use outside of the interactive prompt
+    :param limit int: The maximum number of results to return
+    :param descending bool: Whether results are sorted in descending order
+    :return: The list of results
+    '''
+    consumed = {'CapacityUnits': 0.0}
+    pages, _ = iter_results(plan, table, sort, to_display, workers, consumed, limit, descending)
+    movies = []
+    for page in pages:
+        movies.extend(page)
+    return movies
+
+def display_row(movie, keys):
+    '''
+    Builds the row displayed for a movie, leaving missing attributes empty
+    '''
+    row = []
+    for key in keys:
+        if key in movie.keys():
+            if key in ['rank', 'running_time_secs']:
+                row.append(int(movie[key]))
             else:
-                if (filters):
-                    results = table.scan(FilterExpression=filters, ProjectionExpression=to_display)
-                else:
-                    results = table.scan(ProjectionExpression=to_display)
+                row.append(movie[key])
         else:
-            if filters:
-                results = table.scan(FilterExpression=filters)
-            else:
-                results = table.scan()
-        movies = results['Items']
-
-        #if LastEvaluatedKey is set, then we need to continue paginating through the results to get all filter results.
-        # https://stackoverflow.com/questions/36780856/complete-scan-of-dynamodb-with-boto3
-        while (results.get('LastEvaluatedKey')):
-            if (to_display):
-                if ('year' in to_display or 'rank' in to_display):
-                    if (filters):
-                        results = table.scan(FilterExpression=filters, ProjectionExpression=to_display_cpy, ExpressionAttributeNames={'#y': 'year', '#r': 'rank'}, ExclusiveStartKey=results['LastEvaluatedKey'])
-                    else:
-                        results = table.scan(ProjectionExpression=to_display_cpy, ExpressionAttributeNames={'#y': 'year', '#r': 'rank'}, ExclusiveStartKey=results['LastEvaluatedKey'] )
-                else:
-                    if (filters):
-                        results = table.scan(FilterExpression=filters, ProjectionExpression=to_display, ExclusiveStartKey=results['LastEvaluatedKey'])
-                    else:
-                        results = table.scan(ProjectionExpression=to_display, ExclusiveStartKey=results['LastEvaluatedKey'])
-            else:
-                if filters:
-                    results = table.scan(FilterExpression=filters, ExclusiveStartKey=results['LastEvaluatedKey'])
-                else:
-                    results = table.scan(ExclusiveStartKey=results['LastEvaluatedKey']) 
-            movies.extend(results['Items'])
-        if sort:
-            if (sort in ['PartitionKey', 'RowKey']):
-                # https://www.geeksforgeeks.org/ways-sort-list-dictionaries-values-python-using-lambda-function/
-                movies = sorted(movies, key = lambda m : m[sort])
-            else:
-                if sort in info_keys + ['title', 'year']:
-                    #handle the cases where integers need to be handled
-                    if (sort in ['rank', 'running_time_secs']):
-                        movies = sorted(movies, key = lambda m: (int(m[sort])))
-                    else:
-                        movies = sorted(movies, key = lambda m : (m[sort]))
+            row.append('')
+    return row
+
+def query(plan, table, sort=None, to_display=None, download=False, workers=scan_workers, output_path=results_filename, limit=None, descending=False):
+    '''
+    Queries DynamoDB using the input from the user
+    :param plan dict: The plan built by plan_query, describing whether to Query or Scan and with which conditions
+    :param table Table: The table object to be queried upon
+    :param sort string: the key to sort by, or None to stream results in the order they are read
+    :param to_display str: A comma-separated list of attributes to be displayed
+    :param download bool: Whether the results are saved to a CSV
+    :param workers int: The number of parallel segments used if the plan is a scan
+    :param output_path str: The path of the file the results are saved to, its extension picking the format
+    :param limit int: The maximum number of results to display
+    :param descending bool: Whether results are sorted in descending order
+    '''
+    start = time.perf_counter()
+    keys = to_display.split(',')
+    consumed = {'CapacityUnits': 0.0}
+    pages, description = iter_results(plan, table, sort, to_display, workers, consumed, limit, descending)
 
+    table = PrettyTable(keys)
+    exporter = None
+    if (download):
+        print('Downloading results...')
+        exporter = export.open_exporter(output_path, keys, transforms={'title': export.unescape_title}, types=export_types, row_group_size=export_row_group_size)
+    count = 0
+    try:
+        for page in pages:
+            for movie in page:
+                table.add_row(display_row(movie, keys))
+            count += len(page)
+            if exporter:
+                exporter.write_rows(page)
     except ClientError as e:
-        print('ERROR an exception was thrown while attempting to scan the table.')
+        print('ERROR an exception was thrown while attempting to read the table.')
         print(e)
     except ParamValidationError as e:
-        print('ERROR an exception was thrown due to scan paramater violations.')
+        print('ERROR an exception was thrown due to query paramater violations.')
         print(e)
-    table = PrettyTable(to_display.split(','))
-
-    for movie in movies:
-        row = []
-        for key in to_display.split(','):
-            if key in movie.keys():
-                if key in ['rank', 'running_time_secs']:
-                    row.append(int(movie[key]))
-                else:
-                    row.append(movie[key])
-            else:
-                row.append('')
-
-        table.add_row(row)
     print(table)
-    print('{} results returned.'.format(len(movies)))
-    keys = to_display.split(',')
-    if (download):
-        print('Downloading results...')
-        with open('AWSQueryResults.csv', 'w') as fptr:
-            for key in keys:
-                if keys.index(key) == len(keys)-1:
-                    fptr.write(key)
-                else:
-                    fptr.write(key+ ',')
-            fptr.write('\n')
-            for movie in movies:
-                for key in keys:
-                    if (key is 'title'):
-                        to_write = movie[key]
-                        to_write = to_write.replace('!f', '/')
-                        to_write = to_write.replace('!q', '?')
-                        if "," in to_write:
-                            fptr.write('"{}"'.format(to_write))
-                        else:
-                            fptr.write(to_write)
-                    else:
-                        if key in movie.keys():
-                            if "," in str(movie[key]):
-                                fptr.write('"{}"'.format(str(movie[key])))
-                            else:
-                                fptr.write(str(movie[key]))
-                        else:
-                            fptr.write('')
-                    if (keys.index(key) != len(keys)-1):
-                        fptr.write(',')
-                fptr.write('\n')
-
-        print('Download complete! Your results can be found in ' + os.path.join(os.getcwd() , 'AWSQueryResults.csv') + '.')
+    print('{} results returned.'.format(count))
+    if exporter:
+        exporter.close()
+        print('Download complete! Your results can be found in ' + os.path.abspath(output_path) + '.')
     end = time.perf_counter()
     print_benchmark(start, end)
+    print('Plan: ' + description)
+    print('Consumed RCUs: ' + str(consumed['CapacityUnits']))
+    read_limiter.report('Read capacity')
+    result_cache.report()
 
 
-def build_filters(
-    user_filters,
+def run_query(predicates, sort=None, to_display=None, limit=None, descending=False, output_path=None, row_group_size=export_row_group_size):
+    '''
+    Runs a query without prompting or displaying anything, saving the results if output_path is set (see common/export.py).
+    Used by task2_batch.py, which may run several at once, so the table is read through the calling thread's own resource.
+    :param predicates list: The predicates built by build_predicates
+    :param to_display str: A comma-separated list of attributes to read, or None for every attribute
+    :return: The number of results and a description of the plan used
+    '''
+    table = get_thread_resource().Table('MoviesInfo')
+    plan = plan_query(predicates, to_display, sort, active_indexes(table))
+    consumed = {'CapacityUnits': 0.0}
+    pages, description = iter_results(plan, table, sort, to_display, scan_workers, consumed, limit, descending)
+    exporter = None
+    if output_path:
+        keys = to_display.split(',') if to_display else ['year', 'title'] + info_keys
+        exporter = export.open_exporter(output_path, keys, transforms={'title': export.unescape_title}, types=export_types, row_group_size=row_group_size)
+    count = 0
+    try:
+        for page in pages:
+            count += len(page)
+            if exporter:
+                exporter.write_rows(page)
+    finally:
+        if exporter:
+            exporter.close()
+    return count, '{} ({} RCUs)'.format(description, consumed['CapacityUnits'])
+
+def build_key_predicates(
     partition_key_query_type,
     partition_key_indiv_value,
     partition_key_lower_bound,
@@ -161,78 +547,345 @@ def build_filters(
     sort_key_lower_bound,
     sort_key_upper_bound):
     '''
-    Builds the filter to be used for the query using the user's choices and custom filter, if provided
-    :return: The filter to be used.
+    Builds the predicates on the partition and sort keys chosen by the user
+    :raises FilterError: If a year that is not a number was entered
+    :return: A list of predicates
     '''
-    filters = []
+    predicates = []
     #add partition key query options
     if (partition_key_query_type in ['i', 'individual']):
-        filters.append(Attr('year').eq(int(partition_key_indiv_value)))
+        predicates.append(filters.Comparison('year', 'eq', filters.coerce_value('year', partition_key_indiv_value)))
     else:
-        if (partition_key_lower_bound and partition_key_upper_bound):
-            filters.append(Attr('year').gt(int(partition_key_lower_bound)) & Attr('year').lt(int(partition_key_upper_bound)))
-        elif (partition_key_upper_bound):
-            filters.append(Attr('year').lt(int(partition_key_upper_bound)))
-        elif (partition_key_lower_bound):
-            filters.append(Attr('year').gt(int(partition_key_lower_bound)))
+        if (partition_key_lower_bound):
+            predicates.append(filters.Comparison('year', 'gt', filters.coerce_value('year', partition_key_lower_bound)))
+        if (partition_key_upper_bound):
+            predicates.append(filters.Comparison('year', 'lt', filters.coerce_value('year', partition_key_upper_bound)))
 
     #add sort key query options
     if (sort_key_query_type in ['i', 'individual']):
-        filters.append(Attr('title').eq(sort_key_indiv_value))
+        predicates.append(filters.Comparison('title', 'eq', sort_key_indiv_value))
     else:
-        if (sort_key_lower_bound and sort_key_upper_bound):
-            filters.append(Attr('title').lt(sort_key_upper_bound))
-            filters.append(Attr('title').gt(sort_key_lower_bound))
-        elif (sort_key_lower_bound):
-            filters.append(Attr('title').gt(sort_key_lower_bound))
-        elif (sort_key_upper_bound):
-            filters.append(Attr('title').lt(sort_key_upper_bound))
-    
-    if user_filters is not '':
-        user_filters_list = []
-        if 'and' in user_filters:
-            user_filters_list = user_filters.split('and')
+        if (sort_key_lower_bound):
+            predicates.append(filters.Comparison('title', 'gt', sort_key_lower_bound))
+        if (sort_key_upper_bound):
+            predicates.append(filters.Comparison('title', 'lt', sort_key_upper_bound))
+    return predicates
+
+def build_user_predicates(user_filters):
+    '''
+    Parses the user's custom filter, splitting it on its top-level 'and's so that each part can be planned separately
+    :param user_filters str: The custom filter entered by the user
+    :raises FilterError: If the custom filter cannot be parsed
+    :return: A list of predicates
+    '''
+    return filters.conjuncts(filters.parse(user_filters))
+
+def build_predicates(
+    user_filters,
+    partition_key_query_type,
+    partition_key_indiv_value,
+    partition_key_lower_bound,
+    partition_key_upper_bound,
+    sort_key_query_type,
+    sort_key_indiv_value,
+    sort_key_lower_bound,
+    sort_key_upper_bound):
+    '''
+    Builds the predicates to be used for the query using the user's choices and custom filter, if provided
+    :raises FilterError: If a year or the custom filter cannot be read
+    :return: A list of predicates, all of which must match
+    '''
+    key_predicates = build_key_predicates(partition_key_query_type, partition_key_indiv_value, partition_key_lower_bound, partition_key_upper_bound, sort_key_query_type, sort_key_indiv_value, sort_key_lower_bound, sort_key_upper_bound)
+    return key_predicates + build_user_predicates(user_filters)
+
+def plan_partitions(predicates):
+    '''
+    Works out which years the predicates pin the partition key to
+    :return: The sorted list of years (None if they are not pinned), and the predicates on the year that the list fully accounts for
+    '''
+    candidates = None
+    lower = None
+    upper = None
+    handled = []
+    for predicate in predicates:
+        if not isinstance(predicate, (filters.Comparison, filters.Between, filters.In)) or predicate.attribute != 'year':
+            continue
+        if isinstance(predicate, filters.In) or (isinstance(predicate, filters.Comparison) and predicate.operator == 'eq'):
+            values = predicate.values if isinstance(predicate, filters.In) else [predicate.value]
+            values = {int(value) for value in values if value == int(value)}
+            candidates = values if candidates is None else candidates & values
+        elif isinstance(predicate, filters.Between):
+            lower = max(lower, math.ceil(predicate.low)) if lower is not None else math.ceil(predicate.low)
+            upper = min(upper, math.floor(predicate.high)) if upper is not None else math.floor(predicate.high)
+        elif isinstance(predicate, filters.Comparison) and predicate.operator in filters.lower_bounds:
+            #years are whole numbers, so every lower bound becomes an inclusive one
+            bound = math.floor(predicate.value) + 1 if predicate.operator == 'gt' else math.ceil(predicate.value)
+            lower = bound if lower is None else max(lower, bound)
+        elif isinstance(predicate, filters.Comparison) and predicate.operator in filters.upper_bounds:
+            bound = math.ceil(predicate.value) - 1 if predicate.operator == 'lt' else math.floor(predicate.value)
+            upper = bound if upper is None else min(upper, bound)
+        else:
+            continue
+        handled.append(predicate)
+
+    if candidates is not None:
+        years = sorted(year for year in candidates if (lower is None or year >= lower) and (upper is None or year <= upper))
+    elif lower is not None and upper is not None and upper - lower < max_partition_fanout:
+        years = list(range(lower, upper + 1))
+    else:
+        return None, []
+    return years, handled
+
+def plan_sort_key(predicates, attribute='title'):
+    '''
+    Picks the predicates on a sort key that are sent to DynamoDB as the sort key condition.
+    Two bounds are sent as an inclusive BETWEEN, so non-inclusive bounds are also kept to be checked once the results arrive.
+    :param attribute str: The sort key of the table or index being queried
+    :return: The sort key condition (None if there is none), the predicate describing it, and the predicates it fully accounts for
+    '''
+    bounds = [p for p in predicates if isinstance(p, (filters.Comparison, filters.Between)) and p.attribute == attribute]
+    equal = [p for p in bounds if isinstance(p, filters.Comparison) and p.operator == 'eq']
+    between = [p for p in bounds if isinstance(p, filters.Between)]
+    lowers = [p for p in bounds if isinstance(p, filters.Comparison) and p.operator in filters.lower_bounds]
+    uppers = [p for p in bounds if isinstance(p, filters.Comparison) and p.operator in filters.upper_bounds]
+    if equal:
+        return filters.to_condition(equal[0], Key), equal[0], [equal[0]]
+    if between:
+        return filters.to_condition(between[0], Key), between[0], [between[0]]
+    if lowers and uppers:
+        #DynamoDB rejects a BETWEEN whose bounds are out of order
+        if lowers[0].value > uppers[0].value:
+            return None, None, None
+        condition = filters.Between(attribute, lowers[0].value, uppers[0].value)
+        handled = [p for p in [lowers[0], uppers[0]] if p.operator in ['ge', 'le']]
+        return filters.to_condition(condition, Key), filters.And([lowers[0], uppers[0]]), handled
+    if lowers or uppers:
+        bound = (lowers or uppers)[0]
+        return filters.to_condition(bound, Key), bound, [bound]
+    return None, None, []
+
+def requires_attribute(predicates, attribute):
+    '''
+    Checks whether the predicates only match items that have an attribute, as items missing it are left out of an index keyed on it
+    '''
+    for p in predicates:
+        if isinstance(p, (filters.Between, filters.In, filters.Contains)) and p.attribute == attribute:
+            return True
+        if isinstance(p, filters.Comparison) and p.operator != 'ne' and p.attribute == attribute:
+            return True
+    return False
+
+def plan_index_partitions(predicates, attribute):
+    '''
+    Works out which partitions of an index the predicates pin its partition key to
+    :return: The list of partition values (None if they are not pinned), and the predicates the list fully accounts for
+    '''
+    if attribute == index_partition_attribute:
+        return [index_partition_value], []
+    values = None
+    handled = []
+    for p in predicates:
+        if isinstance(p, filters.In) and p.attribute == attribute:
+            candidates = list(p.values)
+        elif isinstance(p, filters.Comparison) and p.operator == 'eq' and p.attribute == attribute:
+            candidates = [p.value]
         else:
-            user_filters_list.append(user_filters)
-
-        op_map = {
-            'gte': 'gte',
-            'gt': 'gt',
-            'lte': 'lte',
-            'le': 'lte',
-            'ge': 'gte',
-            'lt': 'lt',
-            'eq': 'eq',
-            'lte': 'lte'
-        }
-        for fil in user_filters_list:
-            f = fil.strip()
-            for op in op_map.keys():
-                if op in f:
-                    tokens = f.split(op)
-                    print(tokens)
-                    #skip poorly-formatted queries
-                    if (len(tokens) != 2):
-                        continue
-                    else:
-                        token_1 = ''
-                        if (tokens[0].strip() in ['rating', 'rank', 'running_time_secs', 'year']):
-                            token_1 = int(tokens[1].strip())
-                        else:
-                            token_1 = tokens[1].strip()
-                        filters.append(Attr(tokens[0].strip()).__getattribute__(op_map[op])(token_1))
-                    break
-
-    return filters
-
-def create_table():
+            continue
+        values = candidates if values is None else [value for value in values if value in candidates]
+        handled.append(p)
+    if values is None or len(values) > max_partition_fanout:
+        return None, []
+    return values, handled
+
+def plan_index(predicates, to_display, sort, indexes):
+    '''
+    Picks the global secondary index best suited to the predicates and sort, if any can answer the query.
+    An index can only be used when it projects every attribute that is displayed or filtered on, and the predicates
+    exclude every item missing one of its key attributes. Indexes pinned to a partition, then indexes with a sort key
+    condition, then indexes already sorted in the requested order are preferred.
+    :param indexes list: The names of the indexes that are active on the table
+    :return: The plan, or None if no index can be used
+    '''
+    if not to_display:
+        return None
+    needed = set(to_display.split(',')) | filters.referenced_attributes(filters.combine(predicates))
+    best = None
+    for index in global_secondary_indexes:
+        if index['name'] not in indexes:
+            continue
+        partition_attribute = index['partition_key'][0]
+        sort_attribute = index['sort_key'][0]
+        if not needed <= {'year', 'title', partition_attribute, sort_attribute} | set(index_projection):
+            continue
+        if partition_attribute != index_partition_attribute and not requires_attribute(predicates, partition_attribute):
+            continue
+        if not requires_attribute(predicates, sort_attribute):
+            continue
+        partitions, handled = plan_index_partitions(predicates, partition_attribute)
+        if partitions is None:
+            continue
+        sort_condition = plan_sort_key(predicates, sort_attribute)[0]
+        score = (len(handled) > 0, sort_condition is not None, sort == sort_attribute)
+        if best is None or score > best[0]:
+            best = (score, index, partitions, handled)
+    if best is None:
+        return None
+    _, index, partitions, handled = best
+    rest = [p for p in predicates if p not in handled]
+    return build_query_plan(predicates, rest, index['partition_key'][0], partitions, index['sort_key'][0], index['name'])
+
+def build_query_plan(predicates, rest, partition_attribute, partitions, sort_attribute, index=None):
+    '''
+    Builds a plan that queries one partition of the table or an index at a time
+    :param rest list: The predicates not already accounted for by the choice of partitions
+    :param partitions list: The partition key values to query
+    :param index str: The name of the index to query, or None to query the table
+    :return: A dict describing the plan, consumed by query
+    '''
+    sort_condition, sort_predicate, sort_handled = plan_sort_key(rest, sort_attribute)
+    if sort_handled is None:
+        #the sort key bounds cannot match anything
+        partitions = []
+        sort_handled = rest
+    residual = [p for p in rest if p not in sort_handled]
+    #a Query's FilterExpression cannot reference the key attributes of what is being queried
+    key_attributes = {partition_attribute, sort_attribute}
+    server = [p for p in residual if not filters.referenced_attributes(p) & key_attributes]
+    client = [p for p in residual if filters.referenced_attributes(p) & key_attributes]
+
+    key_conditions = []
+    for partition in partitions:
+        key_condition = Key(partition_attribute).eq(partition)
+        if sort_condition is not None:
+            key_condition = key_condition & sort_condition
+        key_conditions.append(key_condition)
+    #each partition is returned in sort key order, and the partitions of the table are read in year order
+    ordered_by = [sort_attribute] if len(key_conditions) <= 1 else []
+    if index is None:
+        ordered_by.append('year')
+    description = 'Query on {} ({} partition(s)'.format(index or 'MoviesInfo', len(key_conditions))
+    if sort_predicate is not None:
+        description += ', sort key condition ' + str(sort_predicate)
+    if client:
+        description += ', {} predicate(s) evaluated client-side'.format(len(client))
+    return {
+        'type': 'query',
+        'index': index,
+        'key_conditions': key_conditions,
+        'ordered_by': ordered_by,
+        'predicates': predicates,
+        'filter': filters.combine(server),
+        'client_filter': filters.combine(client),
+        'description': description + ')'
+    }
+
+def plan_query(predicates, to_display=None, sort=None, indexes=()):
+    '''
+    Decides whether the request can be answered with Query or has to Scan the whole table.
+    A Query on the table is used when the year is pinned to a single value, or to a set of years small enough to query one
+    partition at a time, with predicates on the title becoming the sort key condition where possible. Otherwise a global
+    secondary index is queried if one matches the predicates and sort, or the movies found in the text index are read by
+    key if a 'contains' predicate narrows them down far enough. Any other predicate on a key attribute of what is
+    being queried is evaluated once the results arrive.
+    :param predicates list: The predicates built by build_predicates
+    :param to_display str: A comma-separated list of attributes to be displayed, needed to check what an index projects
+    :param sort str: The attribute results are sorted by
+    :param indexes list: The names of the indexes that are active on the table, see active_indexes
+    :return: A dict describing the plan, consumed by query
+    '''
+    years, year_handled = plan_partitions(predicates)
+    if years is not None:
+        rest = [p for p in predicates if p not in year_handled]
+        return build_query_plan(predicates, rest, 'year', years, 'title')
+    plan = plan_index(predicates, to_display, sort, indexes)
+    if plan is not None:
+        return plan
+    plan = plan_text_index(predicates)
+    if plan is not None:
+        return plan
+    return {
+        'type': 'scan',
+        'index': None,
+        'ordered_by': [],
+        'predicates': predicates,
+        'filter': filters.combine(predicates),
+        'client_filter': None,
+        'description': 'Scan on MoviesInfo (partition key (year) is not pinned)'
+    }
+
+def plan_text_index(predicates):
+    '''
+    Looks up the 'contains' predicates on the attributes in the text index, intersecting the movies each may match
+    :return: A plan reading only those movies with BatchGetItem, or None if the index is not ready or does not narrow the
+             movies down to max_index_candidates
+    '''
+    if text_index is None or not text_index.complete:
+        return None
+    keys = None
+    for predicate in predicates:
+        if not isinstance(predicate, filters.Contains):
+            continue
+        matched = text_index.lookup(predicate.attribute, predicate.value)
+        if matched is not None:
+            keys = matched if keys is None else keys & matched
+    if keys is None or len(keys) > max_index_candidates:
+        return None
+    return {
+        'type': 'keys',
+        'index': None,
+        'keys': sorted((int(year), title) for year, title in keys),
+        'ordered_by': [],
+        'predicates': predicates,
+        'filter': None,
+        'client_filter': filters.combine(predicates),
+        'description': 'Text index lookup ({} candidate(s) read with BatchGetItem, every predicate evaluated client-side)'.format(len(keys))
+    }
+
+def build_index_definitions(indexes):
+    '''
+    Builds the GlobalSecondaryIndexes and the AttributeDefinitions for their keys passed to create_table
+    :param indexes list: Index descriptions, see global_secondary_indexes
+    :return: The index definitions and attribute definitions
+    '''
+    definitions = []
+    attributes = {}
+    for index in indexes:
+        definitions.append({
+            'IndexName': index['name'],
+            'KeySchema': [
+                {'AttributeName': index['partition_key'][0], 'KeyType': 'HASH'},
+                {'AttributeName': index['sort_key'][0], 'KeyType': 'RANGE'}
+            ],
+            'Projection': {
+                'ProjectionType': 'INCLUDE',
+                'NonKeyAttributes': [a for a in index_projection if a not in [index['partition_key'][0], index['sort_key'][0]]]
+            },
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': read_capacity_units,
+                'WriteCapacityUnits': write_capacity_units
+            }
+        })
+        for name, attribute_type in [index['partition_key'], index['sort_key']]:
+            attributes[name] = attribute_type
+    return definitions, [{'AttributeName': name, 'AttributeType': attribute_type} for name, attribute_type in attributes.items()]
+
+def active_indexes(table):
+    '''
+    :return: The names of the global secondary indexes on the table that can be queried
+    '''
+    return [index['IndexName'] for index in (table.global_secondary_indexes or []) if index.get('IndexStatus') == 'ACTIVE']
+
+def create_table(indexes=global_secondary_indexes):
     '''
     Creates the table in DynamoDB from the movies json file
+    :param indexes list: The global secondary indexes to create along with the table, see global_secondary_indexes
     :ret: Returns a table object connected to DynamoDB
     '''
     start = time.perf_counter()
     print('Creating database...')
     table = None
+    created = False
+    index_definitions, index_attributes = build_index_definitions(indexes)
     try:
         table = dynamodb_resource.create_table(
         TableName='MoviesInfo',
@@ -255,42 +908,241 @@ def create_table():
                 'AttributeName': 'title',
                 'AttributeType': 'S'
             },
-        ],
+        ] + index_attributes,
+        **({'GlobalSecondaryIndexes': index_definitions} if index_definitions else {}),
         ProvisionedThroughput={
-            'ReadCapacityUnits': 10,
-            'WriteCapacityUnits': 10
+            'ReadCapacityUnits': read_capacity_units,
+            'WriteCapacityUnits': write_capacity_units
         })
         print("Table status: {} {}".format(table.table_status, table.table_name))
         print("Awaiting table to be active...")
         #ensure that table is active before adding data to it
         while (dynamodb_client.describe_table(TableName='MoviesInfo')['Table']['TableStatus'] != 'ACTIVE'):
             time.sleep(2)
-
-        with open(os.path.join(".", "data", "moviedata.json")) as json_file:
-            movies = json.load(json_file, parse_float = decimal.Decimal)
-            for movie in movies:
-                year = int(movie['year'])
-                title = movie['title']
-                # print("Adding movie:", year, title)
-                to_put_dict = {}
-                to_put_dict['year'] = year
-                to_put_dict['title'] = title
-                for key in info_keys:
-                    if key in movie['info'].keys():
-                        if (type(movie['info'][key]) == list):
-                            to_put_dict[key] = stringify_list(movie['info'][key])
-                        else:
-                            to_put_dict[key] = movie['info'][key]
-                table.put_item(Item=to_put_dict)
-        print("Table created and populated successfully!")
+        created = True
     except ClientError as e:
-        table = dynamodb_resource.Table('MoviesInfo')
-        print('Table already exists!')
-        print("{} status: {}".format(table.table_name, table.table_status))
+        if e.response['Error']['Code'] == 'ResourceInUseException':
+            table = dynamodb_resource.Table('MoviesInfo')
+            print('Table already exists!')
+            print("{} status: {}".format(table.table_name, table.table_status))
+        else:
+            print('ERROR the table could not be created.')
+            print(e)
+            table = None
+
+    if table is not None:
+        #population runs outside of the handlers above, so its errors are not mistaken for the table already existing
+        try:
+            size_limiters()
+            if created:
+                if not populate_table().failed:
+                    print("Table created and populated successfully!")
+            else:
+                state = ingest_checkpoint().read()
+                if state is not None and not state['complete']:
+                    print('Population of the table was interrupted. Resuming from movie {}...'.format(state['offset']))
+                    if not populate_table(state['offset']).failed:
+                        print("Table populated successfully!")
+        except ClientError as e:
+            print('ERROR an exception was thrown while populating the table.')
+            print(e)
     end = time.perf_counter()
     print_benchmark(start, end)
     return table
 
+def size_limiters():
+    '''
+    Sizes the read and write limiters from the table's provisioned throughput.
+    Writes are reported with the capacity consumed by the indexes included, so the indexes' write capacity is added to the table's.
+    On-demand tables report no throughput, and are not limited.
+    '''
+    description = dynamodb_client.describe_table(TableName='MoviesInfo')['Table']
+    reads = description.get('ProvisionedThroughput', {}).get('ReadCapacityUnits', 0)
+    writes = description.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)
+    for index in description.get('GlobalSecondaryIndexes', []):
+        writes += index.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)
+    read_limiter.configure(reads or None, reads * burst_seconds)
+    write_limiter.configure(writes or None, writes * burst_seconds)
+
+def is_throttled(error):
+    '''
+    :return: True if a ClientError was raised because the request exceeded the table's throughput
+    '''
+    return error.response.get('Error', {}).get('Code') in throttle_errors
+
+def ingest_checkpoint():
+    '''
+    The checkpoint is tied to the table's creation time, so it is ignored once the table is recreated
+    '''
+    return checkpoint.Checkpoint(checkpoint_filename, movies_filename, table_version()[0])
+
+def populate_table(offset=0):
+    '''
+    Loads the movies json file into MoviesInfo, recording progress in the ingest checkpoint so an interrupted load can be resumed
+    :param offset int: The position in the file to start from, every movie before it has already been written
+    :return: The IngestStats for the load
+    '''
+    progress = ingest_checkpoint()
+    progress.start(offset)
+    #movies are parsed, flattened, and written as they stream out of the file
+    movies = moviedata.stream_movies(movies_filename)
+    entries = ((position, create_item(movie)) for position, movie in checkpoint.enumerate_from(movies, offset))
+    #the replica is only built alongside a full load, a resumed load leaves it to check_replica
+    rebuild_replica = replica_conn is not None and offset == 0
+    if rebuild_replica:
+        replica.begin_rebuild(replica_conn)
+        entries = replica.record(replica_conn, entries, lambda entry: entry[1])
+    #the text index is also rebuilt alongside a full load, and kept up to date by a resumed load it was built alongside
+    version = table_version()[0]
+    if text_index is not None and offset == 0:
+        text_index.begin_rebuild(version)
+    record_text = text_index is not None and text_index.version == version
+    if record_text:
+        entries = text_index.record(entries, lambda entry: ((entry[1]['year'], entry[1]['title']), entry[1]))
+    stats = bulk_load(entries, progress=progress)
+    stats.report('Consumed WCUs')
+    write_limiter.report('Write capacity')
+    #any cached results predate the write
+    result_cache.clear()
+    progress.finish(not stats.failed)
+    if rebuild_replica:
+        replica.finish_rebuild(replica_conn, version)
+    if record_text:
+        text_index.finish(not stats.failed)
+    if stats.failed:
+        print('Some batches could not be written. Run the script again to resume from movie {}, or (v)erify the table.'.format(progress.offset))
+    return stats
+
+def partition_titles(year):
+    '''
+    Reads the titles stored in a single year of MoviesInfo on the calling thread
+    :return: The set of titles and the capacity consumed reading them
+    '''
+    consumed = {'CapacityUnits': 0.0}
+    params = {
+        'KeyConditionExpression': Key('year').eq(year),
+        'ProjectionExpression': '#t',
+        'ExpressionAttributeNames': {'#t': 'title'},
+        'ReturnConsumedCapacity': 'TOTAL'
+    }
+    items = fetch_pages(get_thread_resource().Table('MoviesInfo').query, params, consumed)
+    return {item['title'] for item in items}, consumed['CapacityUnits']
+
+def verify_table():
+    '''
+    Compares the titles in every year of MoviesInfo against the movies json file, and writes only the movies that are missing
+    '''
+    start = time.perf_counter()
+    print('Verifying MoviesInfo against ' + movies_filename + '...')
+    expected = checkpoint.collect_keys((int(movie['year']), movie['title']) for movie in moviedata.stream_movies(movies_filename))
+    years = sorted(expected.keys())
+    capacity = 0.0
+    try:
+        missing = {}
+        with ThreadPoolExecutor(max_workers=scan_workers) as executor:
+            for year, (titles, consumed) in zip(years, executor.map(partition_titles, years)):
+                capacity += consumed
+                if expected[year] - titles:
+                    missing[year] = expected[year] - titles
+                    print('\t{}: {} of {} movies present'.format(year, len(expected[year]) - len(missing[year]), len(expected[year])))
+        if not missing:
+            print('All {} years are complete.'.format(len(years)))
+        else:
+            print('Backfilling {} movies in {} years...'.format(sum(len(titles) for titles in missing.values()), len(missing)))
+            movies = moviedata.stream_movies(movies_filename)
+            items = (create_item(movie) for movie in movies if movie['title'] in missing.get(int(movie['year']), ()))
+            if replica_conn is not None:
+                items = replica.record(replica_conn, items)
+            if text_index is not None:
+                items = text_index.record(items, lambda item: ((item['year'], item['title']), item))
+            stats = bulk_load(enumerate(items))
+            stats.report('Consumed WCUs')
+            write_limiter.report('Write capacity')
+            result_cache.clear()
+            if replica_conn is not None:
+                replica.finish_rebuild(replica_conn, table_version()[0])
+    except ClientError as e:
+        print('ERROR an exception was thrown while verifying the table.')
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+    print('Consumed RCUs: ' + str(capacity))
+    read_limiter.report('Read capacity')
+
+def table_version():
+    '''
+    The table's creation time is used as the replica's version marker, since it changes whenever the table is rebuilt
+    :return: The version marker and DynamoDB's (periodically updated) item count
+    '''
+    description = dynamodb_client.describe_table(TableName='MoviesInfo')['Table']
+    return str(description['CreationDateTime']), description['ItemCount']
+
+def sync_replica():
+    '''
+    Rebuilds the local replica from a full parallel scan of MoviesInfo
+    '''
+    start = time.perf_counter()
+    print('Syncing local replica...')
+    consumed = {'CapacityUnits': 0.0}
+    try:
+        items = parallel_scan({'ReturnConsumedCapacity': 'TOTAL'}, consumed, scan_workers)
+        replica.begin_rebuild(replica_conn)
+        replica.insert_rows(replica_conn, items)
+        count = replica.finish_rebuild(replica_conn, table_version()[0])
+        print('Local replica {} rebuilt with {} items.'.format(replica_filename, count))
+    except ClientError as e:
+        print('ERROR an exception was thrown while syncing the local replica.')
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+    print('Consumed RCUs: ' + str(consumed['CapacityUnits']))
+
+def check_replica():
+    '''
+    Rebuilds the local replica if its version marker or item count does not match the table
+    '''
+    version, item_count = table_version()
+    #DynamoDB only refreshes ItemCount every few hours, so a count of 0 is not trusted
+    if replica.is_fresh(replica_conn, version, item_count or None):
+        print('Local replica {} is up to date.'.format(replica_filename))
+    else:
+        print('Local replica {} is stale.'.format(replica_filename))
+        sync_replica()
+
+def sync_text_index():
+    '''
+    Rebuilds the text index from a full parallel scan of MoviesInfo, reading only the keys and the indexed attributes
+    '''
+    start = time.perf_counter()
+    print('Building text index...')
+    consumed = {'CapacityUnits': 0.0}
+    try:
+        params = {'ReturnConsumedCapacity': 'TOTAL'}
+        params['ProjectionExpression'], params['ExpressionAttributeNames'] = build_projection(','.join(['year', 'title'] + textindex.indexed_fields))
+        text_index.begin_rebuild(table_version()[0])
+        count = 0
+        for items in iter_parallel_scan(params, consumed, scan_workers):
+            text_index.add([((int(item['year']), item['title']), item) for item in items])
+            count += len(items)
+        text_index.finish()
+        print('Text index {} rebuilt with {} items.'.format(text_index_filename, count))
+    except ClientError as e:
+        print('ERROR an exception was thrown while building the text index.')
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+    print('Consumed RCUs: ' + str(consumed['CapacityUnits']))
+
+def check_text_index():
+    '''
+    Rebuilds the text index if it was not built in full for the current table
+    '''
+    if text_index.is_ready(table_version()[0]):
+        print('Text index {} is up to date.'.format(text_index_filename))
+    else:
+        print('Text index {} is stale.'.format(text_index_filename))
+        sync_text_index()
+
 def prompt(download_results, table):
     '''
     Prompts the user for all query specifications.
@@ -303,7 +1155,6 @@ def prompt(download_results, table):
     sort_key_indiv_value = None
     sort_key_lower_bound = None
     sort_key_upper_bound = None
-    filters = None
     sort = None
     to_display = None
 
@@ -344,29 +1195,57 @@ def prompt(download_results, table):
         else:
             sort_key_indiv_value = input('Individual value for row key: >')
 
+    try:
+        key_predicates = build_key_predicates(partition_key_query_type, partition_key_indiv_value, partition_key_lower_bound, partition_key_upper_bound, sort_key_query_type, sort_key_indiv_value, sort_key_lower_bound, sort_key_upper_bound)
+    except filters.FilterError as e:
+        print('ERROR ' + str(e))
+        return
+
     #get filters
-    filters = input('Filters (specify exact syntax) >')
+    user_filters = input('Filters (specify exact syntax) >')
+    user_predicates = None
+    while user_predicates is None:
+        try:
+            user_predicates = build_user_predicates(user_filters)
+        except filters.FilterError as e:
+            print('ERROR the filter could not be read. ' + str(e))
+            user_filters = input('Please enter a valid filter.\nFilters (specify exact syntax) >')
 
     #get sort keys
-    sort = input('Sort [(p)rimary key/(s)econdary key/(o)ther attribute] >')
-    while sort not in ['p', 'primary', 's', 'secondary', 'o', 'other']:
-        sort = input('Please enter a valid option.\nSort [(p)rimary key/(s)econdary key/(o)ther attribute] >')
+    sort = input('Sort [(p)rimary key/(s)econdary key/(o)ther attribute/(n)one] >')
+    while sort not in ['p', 'primary', 's', 'secondary', 'o', 'other', 'n', 'none']:
+        sort = input('Please enter a valid option.\nSort [(p)rimary key/(s)econdary key/(o)ther attribute/(n)one] >')
     if sort in ['o', 'other']:
         sort = input('Attribute to sort by >')
     if sort in ['p', 'primary']:
         sort = 'year'
     elif sort in ['s', 'secondary']:
         sort = 'title'
+    #results are streamed in the order they are read when no sort is requested
+    if sort in ['n', 'none']:
+        sort = None
     #default to primary key if bad input
-    if sort not in ['title', 'year'] + info_keys:
+    elif sort not in ['title', 'year'] + info_keys:
         sort = 'year'
 
+    #get sort order and limit
+    descending = False
+    if sort:
+        order = input('Sort order [(a)scending/(d)escending] >')
+        while order not in ['a', 'ascending', 'd', 'descending']:
+            order = input('Please enter a valid option.\nSort order [(a)scending/(d)escending] >')
+        descending = order in ['d', 'descending']
+    limit = input('Maximum number of results to display (press Enter for no limit) >')
+    while limit and not (limit.isdigit() and int(limit) > 0):
+        limit = input('Please enter a positive number.\nMaximum number of results to display (press Enter for no limit) >')
+    limit = int(limit) if limit else None
+
     #get fields to display
     to_display_str = 'Fields/Attributes to display - valid options are:\n\t' + '\n\t'.join(['year', 'title'] + info_keys) + '\n(separate multiple fields with a comma) >'
     to_display = input(to_display_str)
     to_display_check = to_display.split(',')
     to_display_not_valid = True
-    sort_key_present = False
+    sort_key_present = sort is None
     while to_display_not_valid:
         valid_so_far = True    
         for s in to_display.split(','):
@@ -382,9 +1261,23 @@ def prompt(download_results, table):
             to_display = input('Please enter only valid fields to display. Ensure that the key being used to sort is going to be displayed!' + to_display_str)
         else:
             to_display = input('Please enter only valid fields to display.' + to_display_str)
-    query_filters = build_filters(filters, partition_key_query_type, partition_key_indiv_value, partition_key_lower_bound, partition_key_upper_bound, sort_key_query_type, sort_key_indiv_value, sort_key_lower_bound, sort_key_upper_bound)
-    print(query_filters)
-    query(query_filters, table, sort, to_display, download_results)
+    plan = plan_query(key_predicates + user_predicates, to_display, sort, active_indexes(table))
+    output_path = results_filename
+    if download_results:
+        output_path = prompt_output_path()
+    query(plan, table, sort, to_display, download_results, output_path=output_path, limit=limit, descending=descending)
+
+def prompt_output_path():
+    '''
+    Prompts for the file results are saved to, whose extension picks the format (.csv, .jsonl, .parquet, or .arrow)
+    '''
+    while True:
+        output_path = input('File to save the results to (.csv, .jsonl, .parquet, or .arrow) [{}] >'.format(results_filename)) or results_filename
+        try:
+            export.export_format(output_path)
+            return output_path
+        except export.ExportError as e:
+            print(e)
 
 def download_prompt():
     '''
@@ -394,6 +1287,18 @@ def download_prompt():
     while (cmd not in download_options):
         if cmd is 'q':
             exit(0)
+        if cmd == 's' and replica_conn is not None:
+            sync_replica()
+            cmd = input("Would you like to download the results of your query? [y/n] Or, press q to quit! > ")
+            continue
+        if cmd == 'v':
+            verify_table()
+            cmd = input("Would you like to download the results of your query? [y/n] Or, press q to quit! > ")
+            continue
+        if cmd == 't' and text_index is not None:
+            sync_text_index()
+            cmd = input("Would you like to download the results of your query? [y/n] Or, press q to quit! > ")
+            continue
         print('Please enter a valid option.')
         cmd = input("Would you like to download the results of your query? [y/n] Or, press q to quit! > ")
     if cmd is 'y':
@@ -401,9 +1306,16 @@ def download_prompt():
     else:
         return False
 
-print('Welcome to the DynamoDB client wrapper!')
-table = create_table()
+if __name__ == '__main__':
+    print('Welcome to the DynamoDB client wrapper!')
+    if os.getenv('MOVIES_LOCAL_REPLICA') is not None:
+        replica_conn = replica.open_replica(replica_filename)
+    text_index = textindex.TextIndex(text_index_filename)
+    table = create_table()
+    if replica_conn is not None:
+        check_replica()
+    check_text_index()
 
-while True:
-    download_results = download_prompt()
-    prompt(download_results, table)
\ No newline at end of file
+    while True:
+        download_results = download_prompt()
+        prompt(download_results, table)
\ No newline at end of file
@@ -1,7 +1,21 @@
-import os, json, decimal, time
+import os, json, decimal, time, threading
 from azure.cosmosdb.table.tableservice import TableService, AzureHttpError
 from azure.cosmosdb.table.models import Entity, EntityProperty, EdmType
+from azure.cosmosdb.table.tablebatch import TableBatch
 from prettytable import PrettyTable
+from concurrent.futures import ThreadPoolExecutor
+import common.ingest as ingest
+import common.moviedata as moviedata
+import common.replica as replica
+import common.export as export
+import common.topk as topk
+import common.filters as filters
+import common.cache as cache
+import common.paging as paging
+import common.checkpoint as checkpoint
+import common.ratelimit as ratelimit
+import common.columns as columns
+import common.textindex as textindex
 # https://docs.microsoft.com/en-ca/python/api/azure-cosmosdb-table/azure.cosmosdb.table.tableservice.tableservice?view=azure-python#create-table-table-name--fail-on-exist-false--timeout-none-
 # https://docs.microsoft.com/en-us/azure/cosmos-db/table-storage-how-to-use-python
 
@@ -16,9 +30,81 @@ download_results = False
 
 info_keys = ['directors', 'actors', 'release_date', 'genres', 'image_url', 'running_time_secs', 'plot', 'rank', 'rating']
 
+#entity group transactions accept at most 100 entities, all sharing a PartitionKey
+batch_size = 100
+ingest_workers = 8
+max_batch_retries = 10
+thread_local = threading.local()
+
+#the exceptions reported for a failed query
+query_errors = (AzureHttpError,)
+#429 is returned when a request exceeds the table's request units, 503 when the service is briefly unavailable
+throttle_statuses = [429, 503]
+
+#the request units per second provisioned for the table, 400 is the least Cosmos DB can be provisioned with
+default_request_unit_budget = 400
+try:
+    request_unit_budget = float(os.getenv('AZURE_COSMOS_RU_BUDGET', default_request_unit_budget))
+except ValueError:
+    print('ERROR AZURE_COSMOS_RU_BUDGET must be a number of request units per second, using {} instead.'.format(default_request_unit_budget))
+    request_unit_budget = default_request_unit_budget
+#the request units a request is assumed to cost until Cosmos DB returns its actual charge
+entity_write_charge = 10
+page_read_charge = 10
+#a point read of a single entity costs 1 RU per KB
+entity_read_charge = 1
+#every request is paced to stay within the budget, see limited_request
+request_limiter = ratelimit.CapacityLimiter(request_unit_budget or None)
+
+#query_entities returns at most 1000 entities per request
+page_size = 1000
+#pages read in the background while an unsorted query is being displayed
+prefetch_pages = 1
+results_filename = 'AzureQueryResults.csv'
+movies_filename = os.path.join('data', 'moviedata.json')
+#records how far population of the table has got, see populate_table
+checkpoint_filename = 'AzureIngestCheckpoint.json'
+
+#full results are cached in memory so that queries rerun with another sort or limit are answered locally
+cache_max_entries = 32
+cache_max_bytes = 64 * 1024 * 1024
+cache_ttl = 300
+result_cache = cache.ResultCache(cache_max_entries, cache_max_bytes, cache_ttl)
+
+#the local replica is opt-in, see the README
+replica_filename = 'AzureMoviesReplica.sqlite'
+replica_conn = None
+replica_aliases = {'PartitionKey': 'year', 'RowKey': 'title'}
+#the names the keys are stored under in the table
+property_names = {'year': 'PartitionKey', 'title': 'RowKey'}
+
+#an inverted index of the words in each movie's plot, actors, directors, and genres, see common/textindex.py
+text_index_filename = 'AzureTextIndex.sqlite'
+text_index = None
+#a 'contains' filter matching more movies than this is answered with a query over the whole table, which costs fewer
+#request units than reading that many movies one at a time
+max_index_candidates = 500
+#results are held column by column, numbers in typed arrays and repeated strings interned, see common/columns.py
+#PartitionKeys are strings in Azure Tables, and years are kept as strings so results match the entities they were read from
+column_types = {'PartitionKey': 'category', 'rank': 'int', 'running_time_secs': 'int', 'rating': 'float', 'genres': 'category', 'directors': 'category'}
+#results are saved as a CSV unless the file ends in .jsonl, .parquet, or .arrow, see common/export.py
+#the PartitionKey is exported as the year it holds
+export_types = dict(column_types, PartitionKey='int')
+export_row_group_size = export.default_row_group_size
+
 def print_benchmark(start, end):
     print('\nTask completed in ' + str(end-start) + 's')
 
+def clean_title(title):
+    '''
+    Cleans chars that are not allowed in the row key out of a title
+    '''
+    if "/" in title:
+        title = title.replace("/", "!f")
+    elif "?" in title:
+        title = title.replace("?", "!q")
+    return str(title)
+
 def create_entity(movie):
     '''
     Creates an entity based on a dictionary of movie information
@@ -26,14 +112,8 @@ def create_entity(movie):
     :return: An Entity object populated with row, partition, and additional keys
     '''
     entity = Entity()
-    title = movie['title']
-    #clean chars that are not allowed in the partition key out of the title
-    if "/" in title:
-        title = title.replace("/", "!f")
-    elif "?" in title:
-        title = title.replace("?", "!q")
     entity.PartitionKey = str(movie['year'])
-    entity.RowKey = str(title)
+    entity.RowKey = clean_title(movie['title'])
     #create info as entity properties whenever they are present
     for info_key in info_keys:
         if info_key in movie['info'].keys():
@@ -60,6 +140,88 @@ def stringify_list(to_stringify):
     else:
         return to_stringify[0]
 
+def get_thread_client():
+    '''
+    Every writer or query thread gets its own TableService so that connections are not shared between threads
+    '''
+    if not hasattr(thread_local, 'client'):
+        thread_local.client = TableService(connection_string=os.getenv('AZURE_COSMOS_CONNECTION_STRING'))
+        thread_local.client.response_callback = record_request_charge
+    return thread_local.client
+
+def record_request_charge(response):
+    '''
+    Keeps the request units charged for the calling thread's latest request, which Cosmos DB returns in a header
+    '''
+    charge = response.headers.get('x-ms-request-charge')
+    thread_local.request_charge = float(charge) if charge is not None else None
+
+def limited_request(request, estimate):
+    '''
+    Makes a request paced by the request unit limiter, retrying throttled requests after backing off
+    :param request function: Makes the request using the calling thread's client
+    :param estimate float: The request units the request is assumed to cost until its charge is returned
+    :return: The result of the request and the number of times it was retried
+    '''
+    retries = 0
+    while True:
+        request_limiter.acquire(estimate)
+        thread_local.request_charge = None
+        try:
+            result = request()
+        except AzureHttpError as e:
+            request_limiter.settle(estimate, thread_local.request_charge)
+            if e.status_code not in throttle_statuses or retries >= max_batch_retries:
+                raise
+            retries += 1
+            request_limiter.throttled()
+            time.sleep(ratelimit.backoff(retries))
+            continue
+        request_limiter.settle(estimate, thread_local.request_charge)
+        request_limiter.succeeded()
+        return result, retries
+
+def commit_partition_batch(entities, stats):
+    '''
+    Commits up to 100 entities from a single partition as one entity group transaction, paced by the request unit limiter.
+    Throttled (429) and unavailable (503) responses are retried after backing off.
+    :param entities list: The entities to be inserted, all sharing a PartitionKey
+    :param stats IngestStats: The counters the batch is recorded in
+    :return: True if the transaction was committed
+    '''
+    partition = entities[0].PartitionKey
+    batch = TableBatch()
+    for entity in entities:
+        batch.insert_or_replace_entity(entity)
+    start = time.perf_counter()
+    try:
+        _, retries = limited_request(lambda: get_thread_client().commit_batch('MoviesInfo', batch), len(entities) * entity_write_charge)
+    except AzureHttpError as e:
+        stats.record_failure('PartitionKey {} ({} entities)'.format(partition, len(entities)), e)
+        return False
+    stats.record_batch(len(entities), retries)
+    stats.record_partition(partition, len(entities), time.perf_counter() - start)
+    return True
+
+def bulk_load(entries, workers=ingest_workers, progress=None):
+    '''
+    Loads entities into MoviesInfo as 100-entity transactions, committing many partitions at the same time
+    :param entries iterable: (offset, entity) pairs, the offset being the movie's position in the movies json file
+    :param workers int: The number of concurrent writer threads
+    :param progress Checkpoint: If set, every transaction that is committed is recorded in it
+    :return: The IngestStats for the run
+    '''
+    stats = ingest.IngestStats()
+
+    def commit(batch):
+        if commit_partition_batch([entity for _, entity in batch], stats) and progress is not None:
+            progress.complete([offset for offset, _ in batch])
+
+    batches = ingest.group_by_partition(entries, batch_size, lambda entry: entry[1].PartitionKey)
+    ingest.run_batches(batches, commit, workers)
+    stats.finish()
+    return stats
+
 def create_table():
     '''
     Creates the database and populates it. Checks to see if the database exists.
@@ -74,28 +236,232 @@ def create_table():
                 exit(0)
             print("Created table successfully!")
             print("Populating table...")
-            with open(os.path.join('data', 'moviedata.json')) as json_file:
-                movies = json.load(json_file, parse_float = decimal.Decimal)
-                for movie in movies:
-                    entity = create_entity(movie)
-                    # print("Adding movie {} {}".format(entity.PartitionKey, entity.RowKey))
-                    client.insert_entity('MoviesInfo', entity)
-            print("\nTable population complete!")
+            if not populate_table().failed:
+                print("\nTable population complete!")
         else:
             print("Table already exists!")
+            state = ingest_checkpoint().read()
+            if state is not None and not state['complete']:
+                print('Population of the table was interrupted. Resuming from movie {}...'.format(state['offset']))
+                if not populate_table(state['offset']).failed:
+                    print("\nTable population complete!")
     except AzureHttpError as e:
-        print("Database already exists.")
+        print('ERROR an exception was thrown while creating or populating the table.')
+        print(e)
+        #progress is checkpointed as movies are written, so the next run picks up where this one stopped
+        state = ingest_checkpoint().read()
+        if state is not None and not state['complete']:
+            print('Run the script again to resume populating the table from movie {}.'.format(state['offset']))
     except Exception as e:
         print("ERROR An unknown error occurred. Please ensure all credentials are configured correctly.")
         print(e)
     end = time.perf_counter()
     print_benchmark(start, end)
 
-def stringify_query_value(string):
-    return "'{}'".format(string)
+def ingest_checkpoint():
+    '''
+    Azure Tables do not expose a creation time, so the checkpoint is only tied to the movies json file
+    '''
+    return checkpoint.Checkpoint(checkpoint_filename, movies_filename)
 
-def build_filters(
-    user_filters,
+def populate_table(offset=0):
+    '''
+    Loads the movies json file into MoviesInfo, recording progress in the ingest checkpoint so an interrupted load can be resumed.
+    Movies are committed in per-partition transactions, so the saved offset trails behind partitions that fill slowly.
+    :param offset int: The position in the file to start from, every movie before it has already been written
+    :return: The IngestStats for the load
+    '''
+    progress = ingest_checkpoint()
+    progress.start(offset)
+    #movies are parsed, flattened, and written as they stream out of the file
+    movies = moviedata.stream_movies(movies_filename)
+    entries = ((position, create_entity(movie)) for position, movie in checkpoint.enumerate_from(movies, offset))
+    #the replica is only built alongside a full load, a resumed load leaves it to check_replica
+    rebuild_replica = replica_conn is not None and offset == 0
+    if rebuild_replica:
+        replica.begin_rebuild(replica_conn)
+        entries = replica.record(replica_conn, entries, lambda entry: entity_to_row(entry[1]))
+    #the text index is rebuilt alongside a full load and kept up to date by a resumed one, since movies are indexed before they are written
+    if text_index is not None:
+        if offset == 0:
+            text_index.begin_rebuild()
+        entries = text_index.record(entries, lambda entry: ((entry[1].PartitionKey, entry[1].RowKey), entry[1]))
+    stats = bulk_load(entries, progress=progress)
+    stats.report()
+    request_limiter.report('Request unit')
+    #any cached results predate the write
+    result_cache.clear()
+    progress.finish(not stats.failed)
+    if rebuild_replica:
+        replica.finish_rebuild(replica_conn)
+    if text_index is not None:
+        text_index.finish(not stats.failed)
+    if stats.failed:
+        print('Some transactions could not be committed. Run the script again to resume from movie {}, or (v)erify the table.'.format(progress.offset))
+    return stats
+
+def partition_row_keys(partition):
+    '''
+    Reads the RowKeys stored in a single partition of MoviesInfo on the calling thread
+    '''
+    row_keys = set()
+    for page in iter_entity_pages("PartitionKey eq '{}'".format(partition), 'RowKey'):
+        row_keys.update(entity.RowKey for entity in page)
+    return row_keys
+
+def verify_table():
+    '''
+    Compares the RowKeys in every partition of MoviesInfo against the movies json file, and inserts only the entities that are missing
+    '''
+    start = time.perf_counter()
+    print('Verifying MoviesInfo against ' + movies_filename + '...')
+    expected = checkpoint.collect_keys((str(movie['year']), clean_title(movie['title'])) for movie in moviedata.stream_movies(movies_filename))
+    partitions = sorted(expected.keys())
+    try:
+        missing = {}
+        with ThreadPoolExecutor(max_workers=ingest_workers) as executor:
+            for partition, row_keys in zip(partitions, executor.map(partition_row_keys, partitions)):
+                if expected[partition] - row_keys:
+                    missing[partition] = expected[partition] - row_keys
+                    print('\t{}: {} of {} movies present'.format(partition, len(expected[partition]) - len(missing[partition]), len(expected[partition])))
+        if not missing:
+            print('All {} partitions are complete.'.format(len(partitions)))
+        else:
+            print('Backfilling {} movies in {} partitions...'.format(sum(len(row_keys) for row_keys in missing.values()), len(missing)))
+            entities = (create_entity(movie) for movie in moviedata.stream_movies(movies_filename))
+            entities = (entity for entity in entities if entity.RowKey in missing.get(entity.PartitionKey, ()))
+            if replica_conn is not None:
+                entities = replica.record(replica_conn, entities, entity_to_row)
+            if text_index is not None:
+                entities = text_index.record(entities, lambda entity: ((entity.PartitionKey, entity.RowKey), entity))
+            stats = bulk_load(enumerate(entities))
+            stats.report()
+            request_limiter.report('Request unit')
+            result_cache.clear()
+            if replica_conn is not None:
+                replica.finish_rebuild(replica_conn)
+    except AzureHttpError as e:
+        print('ERROR an exception was thrown while verifying the table.')
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+
+def entity_to_row(entity):
+    '''
+    Converts an entity into a row of the local replica
+    :param entity Entity: The entity, either created locally or returned by a query
+    :return: A dict keyed by replica column
+    '''
+    row = {'year': int(entity['PartitionKey']), 'title': entity['RowKey']}
+    for key in info_keys:
+        if key in entity.keys():
+            value = entity[key]
+            row[key] = value.value if isinstance(value, EntityProperty) else value
+    return row
+
+def sync_replica():
+    '''
+    Rebuilds the local replica from every entity in MoviesInfo
+    '''
+    start = time.perf_counter()
+    print('Syncing local replica...')
+    try:
+        replica.begin_rebuild(replica_conn)
+        #read a page at a time through the request limiter, like every other query
+        entities = (entity for page in iter_entity_pages(None, None) for entity in page)
+        replica.insert_rows(replica_conn, (entity_to_row(entity) for entity in entities))
+        count = replica.finish_rebuild(replica_conn)
+        print('Local replica {} rebuilt with {} entities.'.format(replica_filename, count))
+    except AzureHttpError as e:
+        replica_conn.rollback()
+        print('ERROR an exception was thrown while syncing the local replica.')
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+
+def check_replica():
+    '''
+    Rebuilds the local replica if its entity count does not match the table.
+    Only the PartitionKey of each entity is read to count them.
+    '''
+    global replica_conn
+    try:
+        item_count = count_entities()
+    except AzureHttpError as e:
+        print('ERROR an exception was thrown while checking the local replica, it will not be used.')
+        print(e)
+        #only for this run, the replica is checked again next time
+        replica_conn = None
+        return
+    if replica.is_fresh(replica_conn, item_count=item_count):
+        print('Local replica {} is up to date.'.format(replica_filename))
+    else:
+        print('Local replica {} is stale.'.format(replica_filename))
+        sync_replica()
+
+def sync_text_index():
+    '''
+    Rebuilds the text index from every entity in MoviesInfo, selecting only the keys and the indexed attributes
+    '''
+    start = time.perf_counter()
+    print('Building text index...')
+    try:
+        text_index.begin_rebuild()
+        count = 0
+        for page in iter_entity_pages(None, ','.join(['PartitionKey', 'RowKey'] + textindex.indexed_fields)):
+            text_index.add([((entity.PartitionKey, entity.RowKey), entity) for entity in page])
+            count += len(page)
+        text_index.finish()
+        print('Text index {} rebuilt with {} entities.'.format(text_index_filename, count))
+    except AzureHttpError as e:
+        print('ERROR an exception was thrown while building the text index.')
+        print(e)
+    end = time.perf_counter()
+    print_benchmark(start, end)
+
+def count_entities():
+    '''
+    Counts the entities in MoviesInfo, reading only their PartitionKeys a page at a time through the request limiter
+    '''
+    return sum(len(page) for page in iter_entity_pages(None, 'PartitionKey'))
+
+def check_text_index():
+    '''
+    Rebuilds the text index if it was not built in full, or if the number of movies in it does not match the table.
+    Azure Tables do not expose a creation time, so (as for the local replica) the entity count is what shows that the
+    table was recreated or written to from elsewhere since the index was built.
+    '''
+    try:
+        item_count = count_entities()
+    except AzureHttpError as e:
+        print('ERROR an exception was thrown while checking the text index, it will not be used.')
+        print(e)
+        #only for this run, the index is checked again next time
+        text_index.complete = False
+        return
+    if text_index.is_ready() and text_index.count() == item_count:
+        print('Text index {} is up to date.'.format(text_index_filename))
+    else:
+        print('Text index {} is stale.'.format(text_index_filename))
+        sync_text_index()
+
+def query_replica(predicates, sort, to_display, limit=None, descending=False):
+    '''
+    Answers a query from the local replica
+    :return: The sorted results, or None if the replica cannot evaluate the filter
+    '''
+    try:
+        where, params = filters.to_sql(filters.combine(predicates))
+        movies = replica.select(replica_conn, where, params, to_display.split(','), sort, replica_aliases, limit, descending)
+    except (ValueError, replica.sqlite3.Error) as e:
+        print('The local replica cannot answer this query, querying CosmosDB instead. ' + str(e))
+        return None
+    for movie in movies:
+        if 'PartitionKey' in movie:
+            movie['PartitionKey'] = str(movie['PartitionKey'])
+    return movies
+
+def build_key_predicates(
     partition_key_query_type,
     partition_key_indiv_value,
     partition_key_lower_bound,
@@ -105,127 +471,347 @@ def build_filters(
     row_key_lower_bound,
     row_key_upper_bound):
     '''
-    Builds the filter to be used for the query using the user's choices and custom filter, if provided
-    :return: The filter to be used.
+    Builds the predicates on the partition and row keys chosen by the user
+    :raises FilterError: If a year that is not a number was entered
+    :return: A list of predicates
     '''
-    filters = ""
+    predicates = []
     #add partition key query options
     if (partition_key_query_type in ['i', 'individual']):
-        filters = "PartitionKey eq " + stringify_query_value(partition_key_indiv_value)
+        predicates.append(filters.Comparison('year', 'eq', filters.coerce_value('year', partition_key_indiv_value)))
     else:
-        if (partition_key_lower_bound and partition_key_upper_bound):
-            filters = "PartitionKey gt " + stringify_query_value(partition_key_lower_bound) + " and PartitionKey lt " + stringify_query_value(partition_key_upper_bound)
-        elif (partition_key_upper_bound):
-            filters = "PartitionKey lt " + stringify_query_value(partition_key_upper_bound)
-        elif (partition_key_lower_bound):
-            filters = "PartitionKey gt " + stringify_query_value(partition_key_lower_bound)
-    
-    if (partition_key_query_type and row_key_query_type):
-        filters += " and "
+        if (partition_key_lower_bound):
+            predicates.append(filters.Comparison('year', 'gt', filters.coerce_value('year', partition_key_lower_bound)))
+        if (partition_key_upper_bound):
+            predicates.append(filters.Comparison('year', 'lt', filters.coerce_value('year', partition_key_upper_bound)))
 
+    #add row key query options
     if (row_key_query_type in ['i', 'individual']):
-        filters += "RowKey eq " + stringify_query_value(row_key_indiv_value)
+        predicates.append(filters.Comparison('title', 'eq', clean_title(row_key_indiv_value)))
     else:
-        if (row_key_lower_bound and row_key_upper_bound):
-            filters += "RowKey lt " + stringify_query_value(row_key_upper_bound) + " and RowKey gt " + stringify_query_value(row_key_lower_bound)
-        elif (row_key_lower_bound):
-            filters = "RowKey gt " + stringify_query_value(row_key_lower_bound)
-        elif (row_key_upper_bound):
-            filters = "RowKey lt " + stringify_query_value(row_key_upper_bound)
-    
-    if user_filters is not '':
-        if (partition_key_query_type or row_key_query_type):
-            filters += " and " + user_filters
-        else:
-            filters = user_filters
+        if (row_key_lower_bound):
+            predicates.append(filters.Comparison('title', 'gt', clean_title(row_key_lower_bound)))
+        if (row_key_upper_bound):
+            predicates.append(filters.Comparison('title', 'lt', clean_title(row_key_upper_bound)))
+    return predicates
 
-    return filters
-    
-def query(filters, sort = None, to_display = None, download = False):
+def build_user_predicates(user_filters):
     '''
-    Queries the database and prints a table containing results
-    :param sort str: The string representing the column to sort on
-    :param to_display str: The string representing the columns to display
+    Parses the user's custom filter, splitting it on its top-level 'and's.
+    Titles are cleaned the same way as the RowKeys they are compared against.
+    :param user_filters str: The custom filter entered by the user
+    :raises FilterError: If the custom filter cannot be parsed
+    :return: A list of predicates
     '''
-    start = time.perf_counter()
-    movies = []
-    if (to_display):
-        movies = client.query_entities('MoviesInfo', filter=filters, select=to_display)
+    return filters.conjuncts(filters.map_values(filters.parse(user_filters), {'title': clean_title}))
+
+def build_predicates(
+    user_filters,
+    partition_key_query_type,
+    partition_key_indiv_value,
+    partition_key_lower_bound,
+    partition_key_upper_bound,
+    row_key_query_type,
+    row_key_indiv_value,
+    row_key_lower_bound,
+    row_key_upper_bound):
+    '''
+    Builds the predicates to be used for the query using the user's choices and custom filter, if provided
+    :raises FilterError: If a year or the custom filter cannot be read
+    :return: A list of predicates, all of which must match
+    '''
+    key_predicates = build_key_predicates(partition_key_query_type, partition_key_indiv_value, partition_key_lower_bound, partition_key_upper_bound, row_key_query_type, row_key_indiv_value, row_key_lower_bound, row_key_upper_bound)
+    return key_predicates + build_user_predicates(user_filters)
+
+def compile_filters(predicates):
+    '''
+    Compiles predicates into an OData filter. Azure Tables cannot evaluate 'contains', so any predicate using it is evaluated once the results arrive.
+    :return: The OData filter and the filter evaluated client-side (None if there is none)
+    '''
+    #the PartitionKey is a string, so years are compared as strings
+    return filters.split_odata(predicates, property_names, ['year'])
+
+def iter_entity_pages(odata, to_display, limit=None):
+    '''
+    Queries MoviesInfo a page at a time, following the continuation marker until every page has been read
+    :param odata str: The OData filter
+    :param to_display str: The attributes to select, or None for every attribute
+    :param limit int: If set, no more than limit entities are requested in total
+    '''
+    marker = None
+    remaining = limit
+    while True:
+        num_results = page_size if remaining is None else min(page_size, remaining)
+        #queries may run on several threads at once (see task2_batch.py), so each thread uses its own client.
+        #Only the segment this request returned is read: iterating the generator would fetch the next segments itself,
+        #outside of the limiter, so each continuation is requested here instead.
+        page, _ = limited_request(lambda: get_thread_client().query_entities('MoviesInfo', filter=odata, select=to_display, num_results=num_results, marker=marker), page_read_charge)
+        entities = list(page.items)
+        yield entities
+        marker = page.next_marker
+        if remaining is not None:
+            remaining -= len(entities)
+        if not marker or remaining == 0:
+            return
+
+def iter_filtered_pages(odata, client_filter, to_display, limit=None):
+    '''
+    Reads the pages matching an OData filter as ResultColumns, dropping the entities that do not match the client-side filter
+    :param client_filter: The filter evaluated client-side, or None
+    :param limit int: If set, reading stops once limit entities have matched
+    '''
+    if client_filter is None:
+        for entities in iter_entity_pages(odata, to_display, limit):
+            yield columns.ResultColumns(column_types, entities)
+        return
+    to_display = filter_selection(to_display, client_filter)
+    pages = (filters.select(client_filter, columns.ResultColumns(column_types, entities), property_names) for entities in iter_entity_pages(odata, to_display))
+    if limit:
+        pages = topk.take(pages, limit)
+    yield from pages
+
+def filter_selection(to_display, client_filter):
+    '''
+    Attributes evaluated client-side have to be selected even if they are not displayed
+    :return: The attributes to select, or None for every attribute
+    '''
+    if not to_display:
+        return to_display
+    selected = to_display.split(',')
+    selected += sorted({property_names.get(a, a) for a in filters.referenced_attributes(client_filter)} - set(selected))
+    return ','.join(selected)
+
+def plan_text_index(predicates):
+    '''
+    Looks up the 'contains' predicates on the attributes in the text index, intersecting the movies each may match
+    :return: The sorted (PartitionKey, RowKey) keys of those movies, or None if the index is not ready or does not narrow
+             the movies down to max_index_candidates
+    '''
+    if text_index is None or not text_index.complete:
+        return None
+    keys = None
+    for predicate in predicates:
+        if not isinstance(predicate, filters.Contains):
+            continue
+        matched = text_index.lookup(predicate.attribute, predicate.value)
+        if matched is not None:
+            keys = matched if keys is None else keys & matched
+    if keys is None or len(keys) > max_index_candidates:
+        return None
+    return sorted(keys)
+
+def read_entity(key, to_display):
+    '''
+    Reads a single entity with a point read on the calling thread
+    :param key tuple: The entity's PartitionKey and RowKey
+    :return: The entity, or None if it no longer exists
+    '''
+    partition, row = key
+    try:
+        entity, _ = limited_request(lambda: get_thread_client().get_entity('MoviesInfo', partition, row, select=to_display), entity_read_charge)
+    except AzureHttpError as e:
+        if e.status_code == 404:
+            return None
+        raise
+    return entity
+
+def iter_key_pages(keys, client_filter, to_display, limit=None):
+    '''
+    Reads entities by key with concurrent point reads as ResultColumns, dropping the entities that do not match the client-side filter
+    :param keys list: The (PartitionKey, RowKey) keys to read, page_size of which are read at a time
+    :param limit int: If set, reading stops once limit entities have matched
+    '''
+    to_display = filter_selection(to_display, client_filter)
+
+    def read_pages(executor):
+        for batch in ingest.chunk(keys, page_size):
+            entities = [entity for entity in executor.map(lambda key: read_entity(key, to_display), batch) if entity is not None]
+            yield filters.select(client_filter, columns.ResultColumns(column_types, entities), property_names)
+
+    with ThreadPoolExecutor(max_workers=ingest_workers) as executor:
+        pages = read_pages(executor)
+        if limit:
+            pages = topk.take(pages, limit)
+        yield from pages
+
+def iter_local(pages, sort, limit=None, descending=False):
+    '''
+    Sorts and limits results that are read in full before being displayed.
+    Sorted results are yielded as a single page, and a sorted limit is reduced with a bounded heap as the pages arrive.
+    :param pages iterable: The pages of results, each a ResultColumns or a list
+    '''
+    if limit and sort:
+        yield columns.top_k(pages, limit, sort, descending, column_types)
+    elif limit:
+        yield from topk.take(pages, limit)
+    elif sort:
+        yield sort_movies(columns.concat(pages, column_types), sort, descending)
     else:
-        movies = client.query_entities('MoviesInfo', filter=filters)
+        yield from pages
 
+def sort_movies(movies, sort, descending=False):
+    '''
+    Sorts the results of a query by a key or attribute.
+    Missing attributes sort before every value, as NULLs do in the local replica.
+    :param movies ResultColumns: The results, a list of results is decoded first
+    :return: The sorted ResultColumns
+    '''
+    if not isinstance(movies, columns.ResultColumns):
+        movies = columns.ResultColumns(column_types, movies)
     if sort:
-        if (sort in ['PartitionKey', 'RowKey']):
-            # https://www.geeksforgeeks.org/ways-sort-list-dictionaries-values-python-using-lambda-function/
-            movies = sorted(movies, key = lambda m : m[sort])
-        else:
-            if sort in info_keys:
-                #handle the cases where integers need to be handled
-                if (sort in ['rank', 'running_time_secs']):
-                    movies = sorted(movies, key = lambda m: (int(m[sort])))
-                else:
-                    movies = sorted(movies, key = lambda m : (m[sort]))
+        if sort in ['PartitionKey', 'RowKey'] + info_keys:
+            movies = movies.sorted(sort, descending)
+    return movies
+
+def iter_results(predicates, sort, to_display, limit=None, descending=False):
+    '''
+    Picks where a query's results are read from, without printing anything so it can be run on several threads at once
+    :return: An iterable of result pages and a description of where they are read from
+    '''
+    if replica_conn is not None:
+        movies = query_replica(predicates, sort, to_display, limit, descending)
+        if movies is not None:
+            return [movies], 'Local replica ' + replica_filename
+    #results are cached unsorted, so a query that only changes the sort or limit is answered locally
+    key = cache.cache_key(predicates, to_display)
+    movies = result_cache.get(key)
+    if movies is not None:
+        return iter_local([movies], sort, limit, descending), 'Result cache'
+    keys = plan_text_index(predicates)
+    if keys is not None:
+        description = 'Text index lookup ({} candidate(s) read by key), evaluating {} client-side'.format(len(keys), filters.combine(predicates))
+        read = lambda limit=None: iter_key_pages(keys, filters.combine(predicates), to_display, limit)
+    else:
+        odata, client_filter = compile_filters(predicates)
+        description = 'Query on MoviesInfo with filter: ' + (odata or 'none')
+        if client_filter is not None:
+            description += ', evaluating {} client-side'.format(client_filter)
+        read = lambda limit=None: iter_filtered_pages(odata, client_filter, to_display, limit)
+    if limit and sort is None:
+        #Cosmos DB does not return entities in key order, so only unsorted requests can stop reading early, and these results are not cached
+        return read(limit), description + ', stopping after {} results'.format(limit)
+    pages = result_cache.record(key, read(), lambda pages: columns.concat(pages, column_types))
+    return iter_local(pages, sort, limit, descending), description
 
-    to_display_cpy = to_display
-    to_display_cpy = to_display_cpy.replace('PartitionKey', 'year')
-    to_display_cpy = to_display_cpy.replace('RowKey', 'title')
-    table = PrettyTable(to_display_cpy.split(','))
+def fetch_movies(predicates, sort=None, to_display=None, limit=None, descending=False):
+    '''
+    Runs a query without displaying anything, for use outside of the interactive prompt
+    :param predicates list: The predicates built by build_predicates
+    :param limit int: The maximum number of results to return
+    :param descending bool: Whether results are sorted in descending order
+    :return: The list of results
+    '''
+    movies = []
+    pages, _ = iter_results(predicates, sort, to_display, limit, descending)
+    for page in pages:
+        movies.extend(page)
+    return movies
 
-    movies_cnt = 0
-    for movie in movies:
-        movies_cnt += 1
-        row = []
-        for key in to_display.split(','):
-            if key in movie.keys():
-                if key in ['rank', 'running_time_secs']:
-                    row.append(int(movie[key]))
-                else:
-                    row.append(movie[key])
+def display_row(movie, keys):
+    '''
+    Builds the row displayed for a movie, leaving missing attributes empty
+    '''
+    row = []
+    for key in keys:
+        if key in movie.keys():
+            if key in ['rank', 'running_time_secs']:
+                row.append(int(movie[key]))
             else:
-                row.append('')
+                row.append(movie[key])
+        else:
+            row.append('')
+    return row
+
+def query(predicates, sort = None, to_display = None, download = False, output_path = results_filename, limit = None, descending = False, stream = True):
+    '''
+    Queries the database and prints a table containing results
+    :param predicates list: The predicates built by build_predicates, all of which must match
+    :param sort str: The string representing the column to sort on, or None to stream results in the order they are read
+    :param to_display str: The string representing the columns to display
+    :param download bool: Whether the results are saved to a CSV
+    :param output_path str: The path of the file the results are saved to, its extension picking the format
+    :param limit int: The maximum number of results to display
+    :param descending bool: Whether results are sorted in descending order
+    :param stream bool: When no sort is requested, print each page as soon as it arrives while the next page is read in the background
+    '''
+    start = time.perf_counter()
+    pages, description = iter_results(predicates, sort, to_display, limit, descending)
+    print('Plan: ' + description)
+    streaming = stream and sort is None
+    if streaming:
+        pages = paging.prefetch(pages, prefetch_pages)
 
-        table.add_row(row)
-    print(table)
-    print('{} results returned.'.format(movies_cnt))
-    display_keys = to_display_cpy.split(',')
     access_keys = to_display.split(',')
+    display_keys = [replica_aliases.get(key, key) for key in access_keys]
+    table = PrettyTable(display_keys)
+    exporter = None
     if (download):
         print('Downloading results...')
-        with open('AzureQueryResults.csv', 'w') as fptr:
-            for key in display_keys:
-                if display_keys.index(key) == len(display_keys)-1:
-                    fptr.write(key)
-                else:
-                    fptr.write(key+ ',')
-            fptr.write('\n')
-            for movie in movies:
-                for key in access_keys:
-                    if (key is 'year'):
-                        fptr.write(movie['PartitionKey'])
-                    elif (key is 'title'):
-                        to_write = movie['RowKey']
-                        to_write = to_write.replace('!f', '/')
-                        to_write = to_write.replace('!q', '?')
-                        if "," in to_write:
-                            fptr.write('"{}"'.format(to_write))
-                        else:
-                            fptr.write(to_write)
-                    else:
-                        if key in movie.keys():
-                            if "," in str(movie[key]):
-                                fptr.write('"{}"'.format(str(movie[key])))
-                            else:
-                                fptr.write(str(movie[key]))
-                        else:
-                            fptr.write('')
-                    if (access_keys.index(key) != len(access_keys)-1):
-                        fptr.write(',')
-                fptr.write('\n')
-
-        print('Download complete! Your results can be found in ' + os.path.join(os.getcwd() , 'AzureQueryResults.csv') + '.')
+        exporter = export.open_exporter(output_path, access_keys, display_keys, {'RowKey': export.unescape_title}, export_types, export_row_group_size)
+
+    movies_cnt = 0
+    page_cnt = 0
+    first_page = None
+    try:
+        for page in pages:
+            if first_page is None and page:
+                first_page = time.perf_counter()
+            if streaming:
+                #each page gets its own table so it can be printed as soon as it arrives
+                table = PrettyTable(display_keys)
+            for movie in page:
+                table.add_row(display_row(movie, access_keys))
+            movies_cnt += len(page)
+            page_cnt += 1
+            if streaming and page:
+                print(table)
+                print('Page {}: {} results ({} so far)'.format(page_cnt, len(page), movies_cnt))
+            if exporter:
+                exporter.write_rows(page)
+    except AzureHttpError as e:
+        print('ERROR an exception was thrown while attempting to query the table.')
+        print(e)
+    if not streaming:
+        print(table)
+    print('{} results returned.'.format(movies_cnt))
+    if exporter:
+        exporter.close()
+        print('Download complete! Your results can be found in ' + os.path.abspath(output_path) + '.')
     end = time.perf_counter()
     print_benchmark(start, end)
+    if streaming and first_page is not None:
+        print('First results shown after ' + str(first_page - start) + 's')
+    request_limiter.report('Request unit')
+    result_cache.report()
+
 
+def run_query(predicates, sort=None, to_display=None, limit=None, descending=False, output_path=None, row_group_size=export_row_group_size):
+    '''
+    Runs a query without prompting or displaying anything, saving the results if output_path is set (see common/export.py).
+    Used by task2_batch.py, which may run several at once.
+    :param predicates list: The predicates built by build_predicates
+    :param sort str: The attribute to sort by, year and title may be used for PartitionKey and RowKey
+    :param to_display str: A comma-separated list of attributes to read, or None for every attribute
+    :return: The number of results and a description of how they were read
+    '''
+    sort = property_names.get(sort, sort)
+    if to_display:
+        to_display = ','.join(property_names.get(key, key) for key in to_display.split(','))
+    access_keys = to_display.split(',') if to_display else ['PartitionKey', 'RowKey'] + info_keys
+    exporter = None
+    if output_path:
+        exporter = export.open_exporter(output_path, access_keys, [replica_aliases.get(key, key) for key in access_keys], {'RowKey': export.unescape_title}, export_types, row_group_size)
+    pages, description = iter_results(predicates, sort, to_display, limit, descending)
+    count = 0
+    try:
+        for page in pages:
+            count += len(page)
+            if exporter:
+                exporter.write_rows(page)
+    finally:
+        if exporter:
+            exporter.close()
+    return count, description
 
 def prompt(download_results):
     '''
@@ -239,7 +825,6 @@ def prompt(download_results):
     row_key_indiv_value = None
     row_key_lower_bound = None
     row_key_upper_bound = None
-    filters = None
     sort = None
     to_display = None
 
@@ -280,27 +865,55 @@ def prompt(download_results):
         else:
             row_key_indiv_value = input('Individual value for row key: >')
 
+    try:
+        key_predicates = build_key_predicates(partition_key_query_type, partition_key_indiv_value, partition_key_lower_bound, partition_key_upper_bound, row_key_query_type, row_key_indiv_value, row_key_lower_bound, row_key_upper_bound)
+    except filters.FilterError as e:
+        print('ERROR ' + str(e))
+        return
+
     #get filters
-    filters = input('Filters (specify exact syntax)>')
+    user_filters = input('Filters (specify exact syntax)>')
+    user_predicates = None
+    while user_predicates is None:
+        try:
+            user_predicates = build_user_predicates(user_filters)
+        except filters.FilterError as e:
+            print('ERROR the filter could not be read. ' + str(e))
+            user_filters = input('Please enter a valid filter.\nFilters (specify exact syntax)>')
 
     #get sort keys
-    sort = input('Sort [(p)rimary key/(s)econdary key/(o)ther attribute] >')
-    while sort not in ['p', 'primary', 's', 'secondary', 'o', 'other']:
-        sort = input('Please enter a valid option.\nSort [(p)rimary key/(s)econdary key/(o)ther attribute] >')
+    sort = input('Sort [(p)rimary key/(s)econdary key/(o)ther attribute/(n)one] >')
+    while sort not in ['p', 'primary', 's', 'secondary', 'o', 'other', 'n', 'none']:
+        sort = input('Please enter a valid option.\nSort [(p)rimary key/(s)econdary key/(o)ther attribute/(n)one] >')
     if sort in ['o', 'other']:
         sort = input('Attribute to sort by >')
     if sort in ['p', 'primary']:
         sort = 'PartitionKey'
     elif sort in ['s', 'secondary']:
         sort = 'RowKey'
-    if sort not in ['RowKey', 'PartitionKey'] + info_keys:
+    #results are streamed in the order they are read when no sort is requested
+    if sort in ['n', 'none']:
+        sort = None
+    elif sort not in ['RowKey', 'PartitionKey'] + info_keys:
         sort = 'PartitionKey'
 
+    #get sort order and limit
+    descending = False
+    if sort:
+        order = input('Sort order [(a)scending/(d)escending] >')
+        while order not in ['a', 'ascending', 'd', 'descending']:
+            order = input('Please enter a valid option.\nSort order [(a)scending/(d)escending] >')
+        descending = order in ['d', 'descending']
+    limit = input('Maximum number of results to display (press Enter for no limit) >')
+    while limit and not (limit.isdigit() and int(limit) > 0):
+        limit = input('Please enter a positive number.\nMaximum number of results to display (press Enter for no limit) >')
+    limit = int(limit) if limit else None
+
     #get fields to display
     to_display_str = 'Fields/Attributes to display - valid options are:\n\t' + '\n\t'.join(['year', 'title'] + info_keys) + '\n(separate multiple fields with a comma) >'
     to_display = input(to_display_str)
     to_display_not_valid = True
-    sort_key_present = False
+    sort_key_present = sort is None
     while to_display_not_valid:
         valid_so_far = True    
         for s in to_display.split(','):
@@ -323,8 +936,22 @@ def prompt(download_results):
             to_display = input('Please enter only valid fields to display.' + to_display_str)
     to_display = to_display.replace('title', 'RowKey')
     to_display = to_display.replace('year', 'PartitionKey')
-    query_filters = build_filters(filters, partition_key_query_type, partition_key_indiv_value, partition_key_lower_bound, partition_key_upper_bound, row_key_query_type, row_key_indiv_value, row_key_lower_bound, row_key_upper_bound)
-    query(query_filters, sort=sort, to_display=to_display, download=download_results)
+    output_path = results_filename
+    if download_results:
+        output_path = prompt_output_path()
+    query(key_predicates + user_predicates, sort=sort, to_display=to_display, download=download_results, output_path=output_path, limit=limit, descending=descending)
+
+def prompt_output_path():
+    '''
+    Prompts for the file results are saved to, whose extension picks the format (.csv, .jsonl, .parquet, or .arrow)
+    '''
+    while True:
+        output_path = input('File to save the results to (.csv, .jsonl, .parquet, or .arrow) [{}] >'.format(results_filename)) or results_filename
+        try:
+            export.export_format(output_path)
+            return output_path
+        except export.ExportError as e:
+            print(e)
 
 def download_prompt():
     '''
@@ -334,6 +961,18 @@ def download_prompt():
     while (cmd not in download_options):
         if cmd is 'q':
             exit(0)
+        if cmd == 's' and replica_conn is not None:
+            sync_replica()
+            cmd = input("Would you like to download the results of your query? [y/n] Or, press q to quit! > ")
+            continue
+        if cmd == 'v':
+            verify_table()
+            cmd = input("Would you like to download the results of your query? [y/n] Or, press q to quit! > ")
+            continue
+        if cmd == 't' and text_index is not None:
+            sync_text_index()
+            cmd = input("Would you like to download the results of your query? [y/n] Or, press q to quit! > ")
+            continue
         print('Please enter a valid option.')
         cmd = input("Would you like to download the results of your query? [y/n] Or, press q to quit! > ")
     if cmd is 'y':
@@ -341,9 +980,16 @@ def download_prompt():
     else:
         return False
 
-print('Welcome to the CosmosDB client wrapper!')
+if __name__ == '__main__':
+    print('Welcome to the CosmosDB client wrapper!')
 
-create_table()
-while True:
-    download_results = download_prompt()
-    prompt(download_results)
+    if os.getenv('MOVIES_LOCAL_REPLICA') is not None:
+        replica_conn = replica.open_replica(replica_filename)
+    text_index = textindex.TextIndex(text_index_filename)
+    create_table()
+    if replica_conn is not None:
+        check_replica()
+    check_text_index()
+    while True:
+        download_results = download_prompt()
+        prompt(download_results)
@@ -0,0 +1,187 @@
+import argparse, importlib, json, os, time, csv
+from concurrent.futures import ThreadPoolExecutor
+from prettytable import PrettyTable
+import common.filters as filters
+import common.export as export
+
+# Runs a file of query specifications against either task2 backend without prompting, for scripting and benchmarking.
+# See the README for the format of the specifications.
+
+#YAML specifications are optional, JSON needs nothing beyond the standard library
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+backends = {'aws': 'task2_aws', 'azure': 'task2_azure'}
+default_workers = 4
+summary_filename = 'BatchSummary.csv'
+summary_columns = ['name', 'status', 'rows', 'latency_secs', 'plan', 'output']
+
+def load_specs(filename):
+    '''
+    Reads the query specifications from a JSON or YAML file
+    :param filename str: The path of the file, read as YAML if it ends in .yaml or .yml
+    :return: A list of specification dicts
+    '''
+    with open(filename) as spec_file:
+        if filename.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError('PyYAML must be installed to read YAML specifications, install it with pip install pyyaml')
+            specs = yaml.safe_load(spec_file)
+        else:
+            specs = json.load(spec_file)
+    if isinstance(specs, dict):
+        specs = specs.get('queries', [])
+    if not isinstance(specs, list):
+        raise ValueError('The specifications must be a list of queries, or an object with a "queries" list')
+    return specs
+
+def key_args(spec, key):
+    '''
+    Converts the year or title of a specification into the arguments the prompts would have produced
+    :param spec dict: The query specification
+    :param key str: year or title
+    :return: The query type, individual value, lower bound, and upper bound
+    '''
+    value = spec.get(key)
+    if value is None:
+        return None, None, None, None
+    if not isinstance(value, dict):
+        return 'i', str(value), None, None
+    if 'value' in value:
+        return 'i', str(value['value']), None, None
+    lower = value.get('lower')
+    upper = value.get('upper')
+    return 'r', None, None if lower is None else str(lower), None if upper is None else str(upper)
+
+def spec_error(spec):
+    '''
+    Checks the types of a specification's fields before it is run
+    :return: A description of the first problem found, or None if the specification is valid
+    '''
+    if not isinstance(spec, dict):
+        return 'each query must be an object, not {}'.format(json.dumps(spec))
+    for field in ['name', 'filter', 'order', 'sort', 'output']:
+        if spec.get(field) is not None and not isinstance(spec[field], str):
+            return '{} must be a string'.format(field)
+    display = spec.get('display')
+    if display is not None and not isinstance(display, str) and not (isinstance(display, list) and all(isinstance(d, str) for d in display)):
+        return 'display must be a string or a list of strings'
+    for field in ['limit', 'row_group_size']:
+        value = spec.get(field)
+        #bool is a subclass of int, but true is not a limit
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+            return '{} must be a positive whole number'.format(field)
+    return None
+
+def run_spec(backend, spec, number):
+    '''
+    Runs a single query specification, timing it
+    :param backend module: task2_aws or task2_azure
+    :param number int: The position of the specification in the file, used when it has no name
+    :return: A dict holding the summary columns
+    '''
+    result = {
+        'name': 'query {}'.format(number),
+        'status': 'OK',
+        'rows': 0,
+        'latency_secs': 0.0,
+        'plan': '',
+        'output': ''
+    }
+    error = spec_error(spec)
+    if isinstance(spec, dict):
+        result['name'] = str(spec.get('name') or result['name'])
+        result['output'] = str(spec.get('output') or '')
+    if error is not None:
+        result['status'] = 'ERROR invalid spec: ' + error
+        return result
+    display = spec.get('display')
+    if isinstance(display, list):
+        display = ','.join(display)
+    order = spec.get('order', 'ascending')
+    start = time.perf_counter()
+    try:
+        predicates = backend.build_predicates(spec.get('filter', ''), *(key_args(spec, 'year') + key_args(spec, 'title')))
+        result['rows'], result['plan'] = backend.run_query(
+            predicates,
+            sort=spec.get('sort'),
+            to_display=display,
+            limit=spec.get('limit'),
+            descending=order in ['d', 'desc', 'descending'],
+            output_path=spec.get('output'),
+            row_group_size=spec.get('row_group_size', backend.export_row_group_size))
+    except filters.FilterError as e:
+        result['status'] = 'ERROR invalid filter: ' + str(e)
+    except export.ExportError as e:
+        result['status'] = 'ERROR could not write the results: ' + str(e)
+    except backend.query_errors as e:
+        result['status'] = 'ERROR ' + str(e)
+    except OSError as e:
+        result['status'] = 'ERROR could not write the results: ' + str(e)
+    except Exception as e:
+        #anything else is reported against this query, so it does not stop the rest of the batch
+        result['status'] = 'ERROR {}: {}'.format(type(e).__name__, e)
+    result['latency_secs'] = round(time.perf_counter() - start, 4)
+    return result
+
+def run_batch(backend, specs, workers=default_workers):
+    '''
+    Runs every specification, at most workers at a time
+    :return: The summary of each query, in the order they were specified
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_spec, backend, spec, i + 1) for i, spec in enumerate(specs)]
+        return [future.result() for future in futures]
+
+def write_summary(results, filename):
+    '''
+    Saves the summary as JSON if the filename ends in .json, and as a CSV otherwise
+    '''
+    with open(filename, 'w', newline='') as summary_file:
+        if filename.endswith('.json'):
+            json.dump(results, summary_file, indent=4)
+        else:
+            writer = csv.DictWriter(summary_file, fieldnames=summary_columns)
+            writer.writeheader()
+            writer.writerows(results)
+
+def print_summary(results, elapsed):
+    table = PrettyTable(summary_columns)
+    for result in results:
+        table.add_row([result[column] for column in summary_columns])
+    print(table)
+    latencies = sorted(result['latency_secs'] for result in results)
+    if latencies:
+        print('{} queries ({} failed) in {:.3f}s. Latency: min {:.3f}s, median {:.3f}s, max {:.3f}s'.format(
+            len(results),
+            sum(1 for result in results if result['status'] != 'OK'),
+            elapsed,
+            latencies[0],
+            latencies[len(latencies) // 2],
+            latencies[-1]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a file of queries against MoviesInfo without prompting.')
+    parser.add_argument('backend', choices=sorted(backends.keys()), help='The service to query')
+    parser.add_argument('specs', help='A JSON or YAML file of query specifications')
+    parser.add_argument('--workers', type=int, default=default_workers, help='The number of queries run at the same time')
+    parser.add_argument('--summary', default=summary_filename, help='The file the summary is saved to (.json or .csv)')
+    args = parser.parse_args()
+
+    try:
+        specs = load_specs(args.specs)
+    except (OSError, ValueError) as e:
+        print('ERROR the query specifications could not be read. ' + str(e))
+        exit(1)
+    backend = importlib.import_module(backends[args.backend])
+    #'contains' filters are answered from the text index, which is rebuilt first if the table has changed since it was built
+    backend.text_index = backend.textindex.TextIndex(backend.text_index_filename)
+    backend.check_text_index()
+    start = time.perf_counter()
+    results = run_batch(backend, specs, max(1, args.workers))
+    elapsed = time.perf_counter() - start
+    print_summary(results, elapsed)
+    write_summary(results, args.summary)
+    print('Summary saved to ' + os.path.abspath(args.summary) + '.')
@@ -0,0 +1,253 @@
+import argparse, contextlib, importlib, io, itertools, json, os, random, shutil, tempfile, time
+from datetime import datetime, timezone
+from prettytable import PrettyTable
+import common.cache as cache
+import common.moviedata as moviedata
+
+# Benchmarks the task1 and task2 operations of both services against local stand-ins instead of the cloud, so that
+# the comparison made for Task 3 can be rerun and tracked for regressions. See the README for how to run the stand-ins.
+
+#moto is only needed to benchmark AWS in-process, without a DynamoDB Local or moto server to point at
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+backends = ['aws', 'azure']
+default_sizes = [500, 2000]
+default_iterations = 20
+default_seed = 4010
+results_filename = 'BenchmarkResults.json'
+percentiles = [50, 95, 99]
+#the well-known development account Azurite accepts, used when no connection strings are set
+azurite_account = 'AccountName=devstoreaccount1;AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBk==;'
+azurite_storage = 'DefaultEndpointsProtocol=http;' + azurite_account + 'BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;'
+azurite_tables = 'DefaultEndpointsProtocol=http;' + azurite_account + 'TableEndpoint=http://127.0.0.1:10002/devstoreaccount1;'
+#the task1 object searched for and downloaded, present in both services
+search_term = 'lecture'
+download_name = '3110Lecture1.pdf'
+
+def percentile(samples, p):
+    '''
+    Linearly interpolates the pth percentile of a list of samples
+    :param samples list: The samples, in any order
+    :param p float: The percentile, between 0 and 100
+    '''
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(backend, operation, size, samples, units=1):
+    '''
+    Summarizes the latencies of an operation
+    :param samples list: The number of seconds each run of the operation took
+    :param units int: The number of items each run handled, throughput is measured in items rather than runs if set
+    :return: A dict of the result columns
+    '''
+    total = sum(samples)
+    result = {'backend': backend, 'operation': operation, 'dataset': size, 'samples': len(samples)}
+    for p in percentiles:
+        result['p{}_ms'.format(p)] = round(percentile(samples, p) * 1000, 3)
+    result['throughput'] = round(len(samples) * units / total, 2) if total > 0 else 0.0
+    result['unit'] = 'items/s' if units > 1 else 'ops/s'
+    return result
+
+def time_operation(operation, iterations):
+    '''
+    Runs an operation iterations times with its output suppressed
+    :param operation function: Called with the number of the run
+    :return: The number of seconds each run took
+    '''
+    samples = []
+    for i in range(iterations):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            operation(i)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+def write_dataset(size, filename):
+    '''
+    Writes the first size movies of moviedata.json to a file, repeating the file with numbered titles if it holds fewer
+    :return: The (year, title) key of every movie written
+    '''
+    keys = []
+    with open(filename, 'w') as dataset:
+        dataset.write('[')
+        for copy in itertools.count():
+            for movie in moviedata.stream_movies(os.path.join('data', 'moviedata.json')):
+                if len(keys) == size:
+                    dataset.write(']')
+                    return keys
+                if copy:
+                    movie['title'] = '{} ({})'.format(movie['title'], copy + 1)
+                dataset.write(',\n' if keys else '\n')
+                json.dump(movie, dataset, default=float)
+                keys.append((int(movie['year']), movie['title']))
+
+def prepare_task2(module, backend, directory):
+    '''
+    Points a task2 module at the benchmark's files and turns off everything that would hide the cost of a query
+    '''
+    module.checkpoint_filename = os.path.join(directory, 'IngestCheckpoint.json')
+    #a cache that holds nothing, so every run reads the table
+    module.result_cache = cache.ResultCache(max_entries=0)
+    #local stand-ins do not enforce throughput, so pacing requests would only measure the limiter
+    if backend == 'aws':
+        module.read_limiter.configure(None)
+        module.write_limiter.configure(None)
+    else:
+        module.request_limiter.configure(None)
+
+def drop_table(module, backend):
+    '''
+    Deletes MoviesInfo so that the next dataset is loaded into an empty table
+    '''
+    try:
+        if backend == 'aws':
+            module.dynamodb_client.delete_table(TableName='MoviesInfo')
+            module.dynamodb_client.get_waiter('table_not_exists').wait(TableName='MoviesInfo')
+        else:
+            module.client.delete_table('MoviesInfo')
+    except Exception:
+        #the table did not exist
+        pass
+
+def benchmark_task2(module, backend, size, iterations, rng, directory):
+    '''
+    Times loading a dataset into MoviesInfo, then point lookups, year range queries, and full scans on it
+    :return: A list of summaries
+    '''
+    module.movies_filename = os.path.join(directory, 'movies-{}.json'.format(size))
+    keys = write_dataset(size, module.movies_filename)
+    years = sorted({year for year, _ in keys})
+    lookups = [rng.choice(keys) for _ in range(iterations)]
+    ranges = [rng.choice(years) for _ in range(iterations)]
+    drop_table(module, backend)
+
+    results = [summarize(backend, 'ingest', size, time_operation(lambda i: module.create_table(), 1), size)]
+    operations = [
+        ('point lookup', lambda i: module.run_query(
+            module.build_predicates('', 'i', str(lookups[i][0]), None, None, 'i', lookups[i][1], None, None),
+            to_display='year,title,rating')),
+        ('range query', lambda i: module.run_query(
+            module.build_predicates('', 'r', None, str(ranges[i] - 1), str(ranges[i] + 5), None, None, None, None),
+            to_display='year,title,rating')),
+        ('full scan', lambda i: module.run_query([], to_display='year,title,rating'))
+    ]
+    for name, operation in operations:
+        results.append(summarize(backend, name, size, time_operation(operation, iterations)))
+    drop_table(module, backend)
+    return results
+
+def benchmark_task1(module, backend, iterations, directory):
+    '''
+    Times listing, searching, and downloading objects once the task1 buckets or containers have been created
+    :return: A list of summaries
+    '''
+    groups = module.buckets if backend == 'aws' else module.containers
+    #searches build a fresh name index rather than reading one left by an earlier run
+    module.name_index_filename = os.path.join(directory, 'NameIndex.sqlite')
+    for group, names in groups.items():
+        #not every PDF is checked in to data/, and each one missing would be warned about when the buckets are synced
+        groups[group] = [name for name in names if os.path.exists(os.path.join('data', name))]
+    with contextlib.redirect_stdout(io.StringIO()):
+        if backend == 'aws':
+            module.create_buckets()
+        else:
+            module.create_containers()
+    list_all = module.list_buckets_and_contents if backend == 'aws' else module.list_containers_and_blobs
+    search = module.search_objects if backend == 'aws' else module.search_blobs
+    download = module.download_object if backend == 'aws' else module.download_blob
+
+    def download_in(i):
+        #downloads are written to the working directory, which is the benchmark's scratch directory for the run
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            download(download_name)
+        finally:
+            os.chdir(cwd)
+
+    operations = [('list', lambda i: list_all()), ('search', lambda i: search(search_term)), ('download', download_in)]
+    return [summarize(backend, name, 'task1', time_operation(operation, iterations)) for name, operation in operations]
+
+def run_backend(backend, sizes, iterations, seed, skip_task1=False):
+    '''
+    Runs every benchmark for one service
+    :return: A list of summaries
+    '''
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        suffix = '_aws' if backend == 'aws' else '_azure'
+        results = []
+        if not skip_task1:
+            results += benchmark_task1(importlib.import_module('task1' + suffix), backend, iterations, directory)
+        module = importlib.import_module('task2' + suffix)
+        prepare_task2(module, backend, directory)
+        for size in sizes:
+            print('Benchmarking {} with {} movies...'.format(backend, size))
+            results += benchmark_task2(module, backend, size, iterations, rng, directory)
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def print_results(results):
+    columns = ['backend', 'operation', 'dataset', 'samples'] + ['p{}_ms'.format(p) for p in percentiles] + ['throughput', 'unit']
+    table = PrettyTable(columns)
+    for result in results:
+        table.add_row([result[column] for column in columns])
+    print(table)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the task1 and task2 operations against local stand-ins for AWS and Azure.')
+    parser.add_argument('backends', nargs='*', choices=backends, default=backends, help='The services to benchmark (both by default)')
+    parser.add_argument('--sizes', default=','.join(map(str, default_sizes)), help='Comma-separated numbers of movies to load and query')
+    parser.add_argument('--iterations', type=int, default=default_iterations, help='The number of times each query is run')
+    parser.add_argument('--seed', type=int, default=default_seed, help='Seeds the choice of keys and ranges queried')
+    parser.add_argument('--output', default=results_filename, help='The JSON file the results are saved to')
+    parser.add_argument('--skip-task1', action='store_true', help='Only benchmark the task2 operations')
+    args = parser.parse_args()
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(',')]
+    except ValueError:
+        print('ERROR --sizes must be a comma-separated list of numbers')
+        exit(1)
+    iterations = max(1, args.iterations)
+
+    results = []
+    for backend in args.backends:
+        if backend == 'aws':
+            if os.getenv('AWS_ENDPOINT_URL'):
+                #DynamoDB Local or a moto server, boto3 sends every request to AWS_ENDPOINT_URL
+                results += run_backend(backend, sizes, iterations, args.seed, args.skip_task1)
+                continue
+            if mock_aws is None:
+                print('ERROR moto must be installed (pip install moto), or AWS_ENDPOINT_URL set, to benchmark AWS')
+                exit(1)
+            #moto intercepts every boto3 call in-process, and needs credentials and a region to sign them with
+            for key, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'), ('AWS_DEFAULT_REGION', 'us-east-1')]:
+                os.environ.setdefault(key, value)
+            with mock_aws():
+                results += run_backend(backend, sizes, iterations, args.seed, args.skip_task1)
+        else:
+            os.environ.setdefault('AZURE_STORAGE_CONNECTION_STRING', azurite_storage)
+            os.environ.setdefault('AZURE_COSMOS_CONNECTION_STRING', azurite_tables)
+            results += run_backend(backend, sizes, iterations, args.seed, args.skip_task1)
+
+    print_results(results)
+    with open(args.output, 'w') as output_file:
+        json.dump({
+            'created': datetime.now(timezone.utc).isoformat(),
+            'sizes': sizes,
+            'iterations': iterations,
+            'seed': args.seed,
+            'results': results
+        }, output_file, indent=4)
+    print('Results saved to ' + os.path.abspath(args.output) + '.')